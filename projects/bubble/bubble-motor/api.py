@@ -13,12 +13,26 @@ class BubbleAPI(ABC):
     _spec: Optional['BubbleSpec'] = None
     _device: Optional[str] = None
     request_timeout: Optional[float] = None
+    # part of the result cache key, bump it when the model changes
+    model_version: Optional[str] = None
+    # define as `size_key(self, request) -> int`, e.g. a token count, to batch requests of similar size
+    size_key: Optional[callable] = None
+    # read-only arrays returned by `load_weights`, set in every worker before `setup`
+    weights: Optional[dict] = None
 
     @abstractmethod
     async def setup(self, device):
         """Set-up the model so it can be called in `predict`."""
         pass
 
+    def load_weights(self):
+        """Load the model weights once in the server process, as a dict of arrays or CPU tensors.
+
+        Every worker then finds them in `self.weights` when `setup` runs, as read-only NumPy arrays
+        over the same shared memory.
+        """
+        return None
+
     def decode_request(self, request, **kwargs):
         """Convert the request payload to your model input."""
         if self._spec:
@@ -40,6 +54,22 @@ class BubbleAPI(ABC):
         """Run the model on the input and return or yield the output."""
         pass
 
+    def step(self, states, **kwargs):
+        """Advance every active sequence by one step and return one output per sequence.
+
+        Used instead of `predict` with continuous batching. `states` are the decoded requests of the
+        sequences in the batch, in the order they joined it.
+        """
+        raise NotImplementedError("Continuous batching requires `bubble_api.step`.")
+
+    def is_finished(self, state) -> bool:
+        """Whether a sequence has produced its last output, checked after every `step`."""
+        raise NotImplementedError("Continuous batching requires `bubble_api.is_finished`.")
+
+    def release(self, state):
+        """Free what a sequence holds, such as its cache slot, once it left the batch."""
+        pass
+
     def _unbatch_no_stream(self, output):
         return list(output)
 
@@ -80,12 +110,19 @@ class BubbleAPI(ABC):
     def device(self, value):
         self._device = value
 
-    def _sanitize(self, max_batch_size: int, spec: Optional['BubbleSpec']):
+    def _sanitize(self, max_batch_size: int, spec: Optional['BubbleSpec'], continuous: bool = False):
         if self.stream:
             self._default_unbatch = self._unbatch_stream
         else:
             self._default_unbatch = self._unbatch_no_stream
 
+        if continuous:
+            if self.step.__code__ is BubbleAPI.step.__code__ or self.is_finished.__code__ is BubbleAPI.is_finished.__code__:
+                raise ValueError("Continuous batching requires `bubble_api.step` and `bubble_api.is_finished`.")
+            if inspect.isgeneratorfunction(self.encode_response):
+                raise ValueError("With continuous batching `bubble_api.encode_response` encodes one output and must return it.")
+            return
+
         if spec:
             self._spec = spec
             return
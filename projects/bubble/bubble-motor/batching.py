@@ -0,0 +1,186 @@
+import logging
+import math
+from typing import Dict, Optional, Tuple, Union
+
+from .metrics import RATE_WINDOW, RateMeter
+
+logger = logging.getLogger(__name__)
+
+# z-score of the 99th percentile of a normal distribution
+_P99_Z = 2.326
+
+
+class BatchPolicy:
+    """Decides how large a batch the worker forms and how long it waits for it.
+
+    The arrival rate of requests at the worker is measured for every policy. With `stop_early`, the
+    worker stops waiting for a batch to fill when, at a measured rate, no further request is expected
+    before the timeout.
+    """
+
+    def __init__(self, max_batch_size: int, batch_timeout: float, stop_early: bool = False):
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.stop_early = stop_early
+        self.arrivals = RateMeter()
+
+    @property
+    def arrival_rate(self) -> float:
+        return self.arrivals.rate
+
+    def collation_arrival_rate(self) -> Optional[float]:
+        """Arrival rate the worker may stop waiting on, None to always wait out the timeout."""
+        return self.arrival_rate if self.stop_early else None
+
+    def next_batch(self) -> Tuple[int, float]:
+        """Return `(max_batch_size, batch_timeout)` for the next collation."""
+        return self.max_batch_size, self.batch_timeout
+
+    def observe_arrivals(self, num_requests: int):
+        """Called after every collation with the number of requests it picked up."""
+        self.arrivals.add(num_requests)
+
+    def observe_predict(self, batch_size: int, latency: float):
+        """Called after every `predict` with the batch size and its latency in seconds."""
+
+    def metrics(self) -> Dict[str, float]:
+        batch_size, timeout = self.next_batch()
+        return {
+            "batch_policy_batch_size": batch_size,
+            "batch_policy_timeout_seconds": timeout,
+            "batch_policy_arrival_rate": self.arrival_rate,
+        }
+
+
+class FixedBatchPolicy(BatchPolicy):
+    """Always uses the configured `max_batch_size` and `batch_timeout`."""
+
+
+class _LatencyStats:
+    def __init__(self, smoothing: float):
+        self.smoothing = smoothing
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            return
+        delta = value - self.mean
+        self.mean += self.smoothing * delta
+        self.var = (1 - self.smoothing) * (self.var + self.smoothing * delta * delta)
+
+    @property
+    def p99(self) -> float:
+        return self.mean + _P99_Z * math.sqrt(self.var)
+
+
+class AdaptiveBatchPolicy(BatchPolicy):
+    """Picks batch size and wait time online so that queueing plus `predict` stays within a p99 SLO.
+
+    The arrival rate and the `predict` latency for each batch size are tracked with exponentially
+    weighted averages. The policy picks the smallest batch size whose throughput keeps up with the
+    arrival rate (with `headroom`) and whose p99 latency leaves room in the SLO, and waits at most
+    the remaining SLO budget or the time it takes that many requests to arrive. When no size keeps up,
+    the largest one that still meets the SLO is used. `max_batch_size` is the upper bound and
+    `batch_timeout` is used until enough batches have been observed. It stops waiting early by default.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int,
+        batch_timeout: float,
+        latency_slo: float,
+        smoothing: float = 0.1,
+        warmup_batches: int = 10,
+        rate_window: float = RATE_WINDOW,
+        headroom: float = 1.2,
+        stop_early: bool = True,
+    ):
+        super().__init__(max_batch_size, batch_timeout, stop_early)
+        if latency_slo <= 0:
+            raise ValueError("latency_slo must be greater than 0")
+        self.latency_slo = latency_slo
+        self.smoothing = smoothing
+        self.warmup_batches = warmup_batches
+        self.headroom = headroom
+        self.arrivals = RateMeter(rate_window, smoothing)
+        self._latencies: Dict[int, _LatencyStats] = {}
+        self._num_batches = 0
+        self._decision = (max_batch_size, batch_timeout)
+        self._predicted_p99 = 0.0
+
+    def observe_arrivals(self, num_requests: int):
+        if self.arrivals.add(num_requests):
+            self._decide()
+
+    def observe_predict(self, batch_size: int, latency: float):
+        stats = self._latencies.get(batch_size)
+        if stats is None:
+            stats = self._latencies[batch_size] = _LatencyStats(self.smoothing)
+        stats.add(latency)
+        self._num_batches += 1
+        self._decide()
+
+    def _estimate(self, batch_size: int, attr: str) -> float:
+        stats = self._latencies.get(batch_size)
+        if stats is not None and stats.count >= 3:
+            return getattr(stats, attr)
+        # interpolate from the closest observed sizes, assuming latency grows linearly with size
+        observed = sorted((size, s) for size, s in self._latencies.items())
+        below = [(size, s) for size, s in observed if size < batch_size]
+        above = [(size, s) for size, s in observed if size > batch_size]
+        if below and above:
+            (lo, lo_stats), (hi, hi_stats) = below[-1], above[0]
+            frac = (batch_size - lo) / (hi - lo)
+            return getattr(lo_stats, attr) + frac * (getattr(hi_stats, attr) - getattr(lo_stats, attr))
+        if stats is not None:
+            # too few samples, but still closer than any other size
+            return getattr(stats, attr)
+        size, nearest = below[-1] if below else above[0]
+        return getattr(nearest, attr) * batch_size / size
+
+    def _decide(self):
+        if self._num_batches < self.warmup_batches or not self._latencies:
+            return
+        best = None
+        for batch_size in range(1, self.max_batch_size + 1):
+            p99 = self._estimate(batch_size, "p99")
+            budget = self.latency_slo - p99
+            if budget < 0:
+                break
+            fill_time = (batch_size - 1) / self.arrival_rate if self.arrival_rate > 0 else 0.0
+            best = (batch_size, min(budget, fill_time), p99)
+            mean = self._estimate(batch_size, "mean")
+            if mean <= 0 or batch_size / mean >= self.arrival_rate * self.headroom:
+                break
+        if best is None:
+            best = (1, 0.0, self._estimate(1, "p99"))
+        best, self._predicted_p99 = best[:2], best[2]
+        if best != self._decision:
+            logger.debug(f"Adaptive batching: max_batch_size={best[0]} batch_timeout={best[1]:.4f}s")
+        self._decision = best
+
+    def next_batch(self) -> Tuple[int, float]:
+        return self._decision
+
+    def metrics(self) -> Dict[str, float]:
+        metrics = super().metrics()
+        metrics["batch_policy_predicted_p99_seconds"] = self._predicted_p99
+        return metrics
+
+
+def create_batch_policy(
+    batching: Union[str, BatchPolicy], max_batch_size: int, batch_timeout: float, latency_slo: Optional[float] = None
+) -> BatchPolicy:
+    if isinstance(batching, BatchPolicy):
+        return batching
+    if batching == "fixed":
+        return FixedBatchPolicy(max_batch_size, batch_timeout)
+    if batching == "adaptive":
+        if latency_slo is None:
+            raise ValueError("batching='adaptive' requires a latency_slo")
+        return AdaptiveBatchPolicy(max_batch_size, batch_timeout, latency_slo)
+    raise ValueError("batching must be one of 'fixed' or 'adaptive'")
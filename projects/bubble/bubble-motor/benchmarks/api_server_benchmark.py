@@ -0,0 +1,122 @@
+"""Requests per second of a trivial model for a growing number of API server processes.
+
+JSON parsing, validation and response encoding run in the API servers, so with a model this cheap
+they are the bottleneck and throughput should grow with `num_api_servers` up to the number of
+cores. Each setting starts a `BubbleServer` in a child process and loads it from
+`--client-processes` processes with `--concurrency` connections each, so the client doesn't cap the
+result.
+
+    python -m bubble-motor.benchmarks.api_server_benchmark --api-servers 1 2 4 8 --seconds 10
+"""
+
+import argparse
+import asyncio
+import multiprocessing as mp
+import os
+import time
+
+import httpx
+
+from ..api import BubbleAPI
+from ..server import BubbleServer
+
+
+class EchoAPI(BubbleAPI):
+    async def setup(self, device):
+        pass
+
+    def decode_request(self, request):
+        return request["input"]
+
+    def predict(self, x):
+        return x
+
+    def encode_response(self, output):
+        return {"output": output}
+
+
+def serve(num_api_servers: int, port: int, workers: int, max_batch_size: int):
+    server = BubbleServer(
+        EchoAPI(),
+        accelerator="cpu",
+        workers_per_device=workers,
+        max_batch_size=max_batch_size,
+        batch_timeout=0.001,
+    )
+    asyncio.run(
+        server.run(port=port, num_api_servers=num_api_servers, log_level="warning", generate_client_file=False)
+    )
+
+
+async def load(port: int, seconds: float, concurrency: int) -> int:
+    url = f"http://127.0.0.1:{port}/predict"
+    payload = {"input": {"text": "hello", "values": list(range(16))}}
+    completed = 0
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        deadline = time.monotonic() + seconds
+
+        async def worker():
+            nonlocal completed
+            while time.monotonic() < deadline:
+                response = await client.post(url, json=payload)
+                response.raise_for_status()
+                completed += 1
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return completed
+
+
+def client(port: int, seconds: float, concurrency: int, results):
+    results.put(asyncio.run(load(port, seconds, concurrency)))
+
+
+def wait_ready(port: int, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError("server did not become ready")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--api-servers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--client-processes", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--concurrency", type=int, default=16, help="connections per client process")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+    print(f"{os.cpu_count()} cores, {args.client_processes} client processes x {args.concurrency} connections")
+    ctx = mp.get_context("spawn")
+    for num_api_servers in args.api_servers:
+        server = ctx.Process(target=serve, args=(num_api_servers, args.port, args.workers, args.max_batch_size))
+        server.start()
+        try:
+            wait_ready(args.port)
+            # warm up connections in every API server
+            asyncio.run(load(args.port, 1.0, args.concurrency))
+            results = ctx.Queue()
+            clients = [
+                ctx.Process(target=client, args=(args.port, args.seconds, args.concurrency, results))
+                for _ in range(args.client_processes)
+            ]
+            for process in clients:
+                process.start()
+            completed = sum(results.get() for _ in clients)
+            for process in clients:
+                process.join()
+            print(f"{num_api_servers:>3} API servers: {completed / args.seconds:8.0f} req/s")
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
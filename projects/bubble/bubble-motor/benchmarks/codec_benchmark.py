@@ -0,0 +1,99 @@
+"""Request/response time and body size of float32 arrays sent as JSON, msgpack, npy and raw bytes.
+
+Each request goes through an in-process FastAPI app using `NegotiatedRoute`, and the endpoint does
+what `/predict` does with a `Request` input: read the decoded body, turn it into an array and answer
+in the negotiated format. Timings include encoding on the client and decoding the answer.
+
+    python -m bubble-motor.benchmarks.codec_benchmark --sizes 1000 100000 1000000 --repeat 20
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+import numpy as np
+from fastapi import FastAPI, Request, Response
+
+from ..content import (
+    JSON,
+    MSGPACK,
+    NPY,
+    OCTET_STREAM,
+    NegotiatedRoute,
+    decode_body,
+    encode_body,
+    negotiate,
+)
+
+
+def create_app() -> FastAPI:
+    app = FastAPI()
+    app.router.route_class = NegotiatedRoute
+
+    @app.post("/predict")
+    async def predict(request: Request):
+        payload = await request.json()
+        if isinstance(payload, dict):
+            payload = payload["input"]
+        if isinstance(payload, bytes):
+            x = np.frombuffer(payload, dtype=np.float32)
+        else:
+            x = np.asarray(payload, dtype=np.float32)
+        accept = negotiate(request.headers.get("Accept"))
+        if accept:
+            return Response(content=encode_body(accept, x), media_type=accept)
+        return {"output": x.tolist()}
+
+    return app
+
+
+def encode_request(fmt: str, array: np.ndarray) -> bytes:
+    if fmt == JSON:
+        return json.dumps({"input": array.tolist()}).encode()
+    if fmt == MSGPACK:
+        return encode_body(MSGPACK, {"input": array})
+    return encode_body(fmt, array)
+
+
+def decode_response(fmt: str, content: bytes) -> np.ndarray:
+    if fmt == JSON:
+        return np.asarray(json.loads(content)["output"], dtype=np.float32)
+    if fmt == OCTET_STREAM:
+        return np.frombuffer(content, dtype=np.float32)
+    return np.asarray(decode_body(fmt, content))
+
+
+async def run(sizes, repeat: int):
+    transport = httpx.ASGITransport(app=create_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for size in sizes:
+            array = np.random.rand(size).astype(np.float32)
+            for fmt in (JSON, MSGPACK, NPY, OCTET_STREAM):
+                headers = {"Content-Type": fmt, "Accept": fmt}
+                timings = []
+                for _ in range(repeat + 1):
+                    start = time.perf_counter()
+                    body = encode_request(fmt, array)
+                    response = await client.post("/predict", content=body, headers=headers)
+                    result = decode_response(fmt, response.content)
+                    timings.append(time.perf_counter() - start)
+                assert response.status_code == 200 and result.shape == array.shape
+                timings = sorted(timings[1:])
+                print(
+                    f"{size:>9} floats {fmt:>24}: p50 {timings[len(timings) // 2] * 1000:8.2f} ms, "
+                    f"request {len(body) / 1024:10.1f} KiB"
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
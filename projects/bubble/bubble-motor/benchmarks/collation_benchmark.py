@@ -0,0 +1,145 @@
+"""Idle CPU, first-request latency and loaded throughput of the batch collation loop.
+
+Compares the previous 1 ms polling loop with a 10 ms back-off when no batch was formed, the
+event-driven `collate_requests` that always waits out `batch_timeout` ("event"), and the same loop
+given the measured arrival rate, which stops waiting when no other request is expected ("early").
+
+The idle phase sends `--probes` requests spread over `--idle` seconds. The load phase sends
+`--rate` requests per second for `--load-seconds`, and reports throughput, mean batch size and
+latency percentiles. Every batch takes `--predict-time` seconds in the simulated `predict`.
+
+    python -m bubble-motor.benchmarks.collation_benchmark --idle 5 --probes 20 --rate 2000
+"""
+
+import argparse
+import asyncio
+import multiprocessing as mp
+import threading
+import time
+from queue import Empty
+
+from ..loops import collate_requests
+from ..metrics import RateMeter
+from ..transport import create_transport
+
+
+def polling_collate_requests(request_queue, max_batch_size, batch_timeout):
+    payloads = []
+    end_time = time.monotonic() + batch_timeout
+    while time.monotonic() < end_time and len(payloads) < max_batch_size:
+        remaining_time = end_time - time.monotonic()
+        if remaining_time <= 0:
+            break
+        try:
+            response_queue_id, uid, timestamp, x_enc = request_queue.get(timeout=min(remaining_time, 0.001))
+            payloads.append((response_queue_id, uid, x_enc))
+        except Empty:
+            continue
+    return payloads
+
+
+async def _worker_loop(mode, request_queue, response_queue, max_batch_size, batch_timeout, predict_time):
+    arrivals = RateMeter()
+    while True:
+        if mode == "polling":
+            batch = polling_collate_requests(request_queue, max_batch_size, batch_timeout)
+        else:
+            arrival_rate = arrivals.rate if mode == "early" else None
+            batch = collate_requests(request_queue, max_batch_size, batch_timeout, arrival_rate=arrival_rate)
+        arrivals.add(len(batch))
+        if not batch:
+            if mode == "polling":
+                await asyncio.sleep(0.01)
+            continue
+        time.sleep(predict_time)
+        for _, uid, x in batch:
+            response_queue.put((uid, time.process_time(), len(batch)))
+            if x is None:
+                return
+
+
+def worker(mode, request_queue, response_queue, max_batch_size, batch_timeout, predict_time):
+    asyncio.run(_worker_loop(mode, request_queue, response_queue, max_batch_size, batch_timeout, predict_time))
+
+
+def _percentile(values, q):
+    return values[min(int(len(values) * q), len(values) - 1)] * 1000
+
+
+def _send_at_rate(request_queue, rate: float, seconds: float, sent_at: dict):
+    start = time.perf_counter()
+    for uid in range(int(rate * seconds)):
+        delay = start + uid / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        sent_at[uid] = time.perf_counter()
+        request_queue.put((0, uid, time.monotonic(), "x"))
+
+
+def run(mode: str, args):
+    transport = create_transport("shm")
+    request_queue = transport.queue()
+    response_queue = transport.queue()
+    process = mp.get_context("spawn").Process(
+        target=worker,
+        args=(mode, request_queue, response_queue, args.max_batch_size, args.batch_timeout, args.predict_time),
+    )
+    process.start()
+    request_queue.put((0, -1, time.monotonic(), "warmup"))
+    _, cpu_start, _ = response_queue.get()
+
+    # first request after an idle period
+    latencies = []
+    for uid in range(args.probes):
+        time.sleep(args.idle / args.probes)
+        sent_at = time.perf_counter()
+        request_queue.put((0, uid, time.monotonic(), "x"))
+        _, cpu_end, _ = response_queue.get()
+        latencies.append(time.perf_counter() - sent_at)
+    cpu_seconds = cpu_end - cpu_start
+    latencies.sort()
+    print(
+        f"{mode:>7}: idle CPU {cpu_seconds / args.idle * 100:6.2f}%  "
+        f"first-request p50 {_percentile(latencies, 0.5):7.3f} ms  p99 {_percentile(latencies, 0.99):7.3f} ms"
+    )
+
+    # open-loop load
+    sent, latencies, batch_sizes = {}, [], []
+    sender = threading.Thread(target=_send_at_rate, args=(request_queue, args.rate, args.load_seconds, sent))
+    start = time.perf_counter()
+    sender.start()
+    for _ in range(int(args.rate * args.load_seconds)):
+        uid, _, batch_size = response_queue.get()
+        latencies.append(time.perf_counter() - sent[uid])
+        batch_sizes.append(batch_size)
+    elapsed = time.perf_counter() - start
+    sender.join()
+
+    request_queue.put((0, -1, time.monotonic(), None))
+    response_queue.get()
+    process.join()
+    transport.shutdown()
+
+    latencies.sort()
+    print(
+        f"{'':>7}  load {len(latencies) / elapsed:8.0f} req/s  mean batch {sum(batch_sizes) / len(batch_sizes):5.2f}  "
+        f"p50 {_percentile(latencies, 0.5):7.3f} ms  p99 {_percentile(latencies, 0.99):7.3f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--idle", type=float, default=5.0, help="seconds of idle time spread over the probes")
+    parser.add_argument("--probes", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=2000, help="requests per second of the load phase")
+    parser.add_argument("--load-seconds", type=float, default=3.0)
+    parser.add_argument("--predict-time", type=float, default=0.002, help="seconds per batch")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--batch-timeout", type=float, default=0.005)
+    args = parser.parse_args()
+    for mode in ("polling", "event", "early"):
+        run(mode, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Throughput of one inference worker whose async `predict` waits on a simulated remote backend,
+with one and with several batches in flight.
+
+The worker is an `InferenceEngine` on a thread, its `predict` awaits `--backend-latency` seconds
+per batch. A fixed number of clients keep one request each in flight.
+
+    python -m bubble-motor.benchmarks.concurrency_benchmark --requests 2000 --concurrency 64
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+from queue import Queue
+
+from ..api import BubbleAPI
+from ..loops import InferenceEngine
+from ..transport import get_many
+
+
+class RemoteAPI(BubbleAPI):
+    def __init__(self, backend_latency: float):
+        self.backend_latency = backend_latency
+
+    async def setup(self, device):
+        pass
+
+    async def predict(self, x, **kwargs):
+        await asyncio.sleep(self.backend_latency)
+        return x
+
+
+async def run(concurrent_batches: int, args):
+    loop = asyncio.get_running_loop()
+    request_queue, response_queue = Queue(), Queue()
+    api = RemoteAPI(args.backend_latency)
+    api.request_timeout = -1
+    api._sanitize(args.max_batch_size, spec=None)
+    engine = InferenceEngine(
+        api,
+        None,
+        request_queue,
+        [response_queue],
+        args.max_batch_size,
+        args.batch_timeout,
+        False,
+        concurrent_batches=concurrent_batches,
+    )
+    worker = threading.Thread(target=asyncio.run, args=(engine.run(),), daemon=True)
+    worker.start()
+
+    waiters = {}
+
+    def deliver(responses):
+        for uid, _ in responses:
+            waiters.pop(uid).set_result(None)
+
+    def read_responses():
+        while True:
+            loop.call_soon_threadsafe(deliver, get_many(response_queue, 256))
+
+    threading.Thread(target=read_responses, daemon=True).start()
+
+    latencies = []
+    uids = iter(range(args.requests))
+
+    async def client():
+        for uid in uids:
+            waiters[uid] = loop.create_future()
+            start = time.perf_counter()
+            request_queue.put_nowait((0, uid, time.monotonic(), uid))
+            await waiters[uid]
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    engine.stop()
+    worker.join()
+    latencies.sort()
+    p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+    print(
+        f"{concurrent_batches:>3} in flight: {args.requests / elapsed:7.0f} req/s, "
+        f"p50 {p50 * 1000:6.1f} ms, p99 {p99 * 1000:6.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--batch-timeout", type=float, default=0.002)
+    parser.add_argument("--backend-latency", type=float, default=0.02, help="seconds the backend takes per batch")
+    parser.add_argument("--concurrent-batches", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+    for concurrent_batches in args.concurrent_batches:
+        asyncio.run(run(concurrent_batches, args))
+
+
+if __name__ == "__main__":
+    main()
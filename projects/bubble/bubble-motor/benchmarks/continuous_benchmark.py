@@ -0,0 +1,163 @@
+"""Time to first token and tokens per second of batched streaming against continuous batching, for
+generations of mixed lengths.
+
+Both modes run an `InferenceEngine` on a thread whose model step sleeps `--step-time` seconds per
+token whatever the batch size, like a memory-bound decoder. Static batching runs every batch until
+its longest generation is done; continuous batching lets requests join and leave between steps.
+Each request asks for a random number of tokens between `--min-tokens` and `--max-tokens`.
+
+    python -m bubble-motor.benchmarks.continuous_benchmark --requests 256 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import random
+import threading
+import time
+from queue import Queue
+
+from ..api import BubbleAPI
+from ..loops import InferenceEngine
+from ..transport import get_many
+from ..utils import BubbleAPIStatus
+
+
+class StaticAPI(BubbleAPI):
+    def __init__(self, step_time: float):
+        self.step_time = step_time
+
+    async def setup(self, device):
+        pass
+
+    def predict(self, lengths):
+        for i in range(max(lengths)):
+            time.sleep(self.step_time)
+            # finished generations are padding until the longest one is done
+            yield [i if i < length else None for length in lengths]
+
+    def encode_response(self, outputs):
+        for output in outputs:
+            yield output
+
+
+class Generation:
+    __slots__ = ("length", "produced")
+
+    def __init__(self, length: int):
+        self.length = length
+        self.produced = 0
+
+
+class ContinuousAPI(BubbleAPI):
+    def __init__(self, step_time: float):
+        self.step_time = step_time
+
+    async def setup(self, device):
+        pass
+
+    def decode_request(self, length):
+        return Generation(length)
+
+    def predict(self, x):
+        pass
+
+    def step(self, states):
+        time.sleep(self.step_time)
+        outputs = []
+        for state in states:
+            outputs.append(state.produced)
+            state.produced += 1
+        return outputs
+
+    def is_finished(self, state) -> bool:
+        return state.produced >= state.length
+
+    def encode_response(self, output):
+        return output
+
+
+def start_engine(mode: str, args, request_queue, response_queue):
+    continuous = mode == "continuous"
+    api = ContinuousAPI(args.step_time) if continuous else StaticAPI(args.step_time)
+    api.request_timeout = -1
+    api.stream = True
+    api._sanitize(args.max_batch_size, spec=None, continuous=continuous)
+    engine = InferenceEngine(
+        api, None, request_queue, [response_queue], args.max_batch_size, args.batch_timeout, True, continuous=continuous
+    )
+    worker = threading.Thread(target=asyncio.run, args=(engine.run(),), daemon=True)
+    worker.start()
+    return engine, worker
+
+
+async def run(mode: str, args):
+    loop = asyncio.get_running_loop()
+    request_queue, response_queue = Queue(), Queue()
+    engine, worker = start_engine(mode, args, request_queue, response_queue)
+
+    streams = {}
+
+    def deliver(responses):
+        now = time.perf_counter()
+        for uid, (data, status) in responses:
+            streams[uid].put_nowait((now, data, status))
+
+    def read_responses():
+        while True:
+            loop.call_soon_threadsafe(deliver, get_many(response_queue, 256))
+
+    threading.Thread(target=read_responses, daemon=True).start()
+
+    rng = random.Random(0)
+    lengths = [rng.randint(args.min_tokens, args.max_tokens) for _ in range(args.requests)]
+    uids = iter(range(args.requests))
+    ttfts, tokens = [], 0
+
+    async def client():
+        nonlocal tokens
+        for uid in uids:
+            streams[uid] = asyncio.Queue()
+            start = time.perf_counter()
+            request_queue.put_nowait((0, uid, time.monotonic(), lengths[uid]))
+            first = None
+            while True:
+                received, data, status = await streams[uid].get()
+                if status != BubbleAPIStatus.OK:
+                    break
+                if data is None:
+                    continue
+                tokens += 1
+                if first is None:
+                    first = received - start
+            ttfts.append(first)
+            del streams[uid]
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    engine.stop()
+    worker.join()
+    ttfts.sort()
+    p50, p99 = ttfts[len(ttfts) // 2], ttfts[int(len(ttfts) * 0.99)]
+    print(
+        f"{mode:>10}: {tokens / elapsed:7.0f} tokens/s, "
+        f"time to first token p50 {p50 * 1000:7.1f} ms, p99 {p99 * 1000:7.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--batch-timeout", type=float, default=0.002)
+    parser.add_argument("--step-time", type=float, default=0.005, help="seconds per decoding step")
+    parser.add_argument("--min-tokens", type=int, default=4)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    args = parser.parse_args()
+    for mode in ("static", "continuous"):
+        asyncio.run(run(mode, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Latency and throughput of a shared request queue against the least-loaded `Dispatcher` with work
+stealing, on two inference workers where one is `--slowdown` times slower than the other.
+
+Workers are `InferenceEngine`s on threads and their `predict` sleeps without holding the GIL. A
+fixed number of clients keep one request each in flight.
+
+    python -m bubble-motor.benchmarks.dispatch_benchmark --requests 2000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+from queue import Queue
+
+from ..api import BubbleAPI
+from ..dispatcher import Dispatcher, steal_from
+from ..loops import InferenceEngine
+from ..transport import get_many
+
+
+class SimulatedAPI(BubbleAPI):
+    def __init__(self, predict_time: float):
+        self.predict_time = predict_time
+
+    async def setup(self, device):
+        pass
+
+    async def predict(self, x, **kwargs):
+        time.sleep(self.predict_time)
+        return x
+
+
+def start_worker(predict_time, request_queue, response_queue, max_batch_size, batch_timeout, steal_queues):
+    api = SimulatedAPI(predict_time)
+    api.request_timeout = -1
+    api._sanitize(max_batch_size, spec=None)
+    engine = InferenceEngine(
+        api, None, request_queue, [response_queue], max_batch_size, batch_timeout, False, steal_queues=steal_queues
+    )
+    worker = threading.Thread(target=asyncio.run, args=(engine.run(),), daemon=True)
+    worker.start()
+    return engine, worker
+
+
+async def run(mode: str, args):
+    loop = asyncio.get_running_loop()
+    response_queue = Queue()
+    predict_times = [args.predict_time, args.predict_time * args.slowdown]
+    if mode == "shared":
+        request_queue = Queue()
+        dispatcher = None
+        workers = [
+            start_worker(predict_time, request_queue, response_queue, args.max_batch_size, args.batch_timeout, None)
+            for predict_time in predict_times
+        ]
+    else:
+        queues = [Queue() for _ in predict_times]
+        request_queue = dispatcher = Dispatcher(queues)
+        workers = [
+            start_worker(
+                predict_time,
+                queues[worker_id],
+                response_queue,
+                args.max_batch_size,
+                args.batch_timeout,
+                steal_from(queues, worker_id),
+            )
+            for worker_id, predict_time in enumerate(predict_times)
+        ]
+
+    waiters = {}
+
+    def deliver(responses):
+        for uid, _ in responses:
+            if dispatcher:
+                dispatcher.complete(uid)
+            waiters.pop(uid).set_result(None)
+
+    def read_responses():
+        while True:
+            loop.call_soon_threadsafe(deliver, get_many(response_queue, 256))
+
+    threading.Thread(target=read_responses, daemon=True).start()
+
+    latencies = []
+    uids = iter(range(args.requests))
+
+    async def client():
+        for uid in uids:
+            waiters[uid] = loop.create_future()
+            start = time.perf_counter()
+            request_queue.put_nowait((0, uid, time.monotonic(), uid))
+            await waiters[uid]
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    for engine, _ in workers:
+        engine.stop()
+    for _, worker in workers:
+        worker.join()
+    latencies.sort()
+    p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+    print(f"{mode:>10}: {args.requests / elapsed:7.0f} req/s, p50 {p50 * 1000:6.1f} ms, p99 {p99 * 1000:6.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--batch-timeout", type=float, default=0.002)
+    parser.add_argument("--predict-time", type=float, default=0.01, help="seconds per predict on the fast worker")
+    parser.add_argument("--slowdown", type=float, default=3.0)
+    args = parser.parse_args()
+    for mode in ("shared", "dispatcher"):
+        asyncio.run(run(mode, args))
+
+
+if __name__ == "__main__":
+    main()
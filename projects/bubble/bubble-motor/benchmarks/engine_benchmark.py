@@ -0,0 +1,129 @@
+"""Throughput of the pipelined InferenceEngine against the two loops it replaced.
+
+`server` is the former synchronous `inference_worker` loop from server.py and `loops` is the former
+`run_batched_loop` with one executor hop per queued item. The model is simulated by a `predict`
+that sleeps without holding the GIL, like a GPU kernel or a native CPU library, while decode and
+encode do pure-Python work.
+
+    python -m bubble-motor.benchmarks.engine_benchmark --requests 2000 --max-batch-size 8
+"""
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+from queue import Empty, Queue
+
+from ..api import BubbleAPI
+from ..loops import InferenceEngine
+from ..utils import BubbleAPIStatus
+
+
+class SimulatedAPI(BubbleAPI):
+    def __init__(self, codec_size: int, predict_time: float):
+        self.codec_size = codec_size
+        self.predict_time = predict_time
+
+    async def setup(self, device):
+        pass
+
+    def decode_request(self, request, **kwargs):
+        return json.loads(json.dumps([request] * self.codec_size))[0]
+
+    async def predict(self, x, **kwargs):
+        time.sleep(self.predict_time)
+        return x
+
+    def encode_response(self, output, **kwargs):
+        return json.loads(json.dumps([output] * self.codec_size))[0]
+
+
+def _legacy_collate_blocking(request_queue, max_batch_size, batch_timeout):
+    payloads = []
+    end_time = time.monotonic() + batch_timeout
+    while time.monotonic() < end_time and len(payloads) < max_batch_size:
+        try:
+            response_queue_id, uid, _, x_enc = request_queue.get(timeout=min(end_time - time.monotonic(), 0.001))
+            payloads.append((response_queue_id, uid, x_enc))
+        except (Empty, ValueError):
+            continue
+    return payloads
+
+
+async def _legacy_collate_executor(request_queue, max_batch_size, batch_timeout):
+    loop = asyncio.get_event_loop()
+    payloads = []
+    end_time = loop.time() + batch_timeout
+    while loop.time() < end_time and len(payloads) < max_batch_size:
+        remaining_time = end_time - loop.time()
+        if remaining_time <= 0:
+            break
+        try:
+            response_queue_id, uid, _, x_enc = await loop.run_in_executor(
+                None, request_queue.get, True, min(remaining_time, 0.001)
+            )
+            payloads.append((response_queue_id, uid, x_enc))
+        except Empty:
+            continue
+    return payloads
+
+
+async def legacy_loop(api, request_queue, response_queues, max_batch_size, batch_timeout, executor_collate, stopped):
+    while not stopped.is_set():
+        if executor_collate:
+            batches = await _legacy_collate_executor(request_queue, max_batch_size, batch_timeout)
+        else:
+            batches = _legacy_collate_blocking(request_queue, max_batch_size, batch_timeout)
+        if not batches:
+            await asyncio.sleep(0.01)
+            continue
+        response_queue_ids, uids, inputs = zip(*batches)
+        x = api.batch([api.decode_request(input) for input in inputs])
+        y = await api.predict(x)
+        for response_queue_id, y, uid in zip(response_queue_ids, api.unbatch(y), uids):
+            response_queues[response_queue_id].put((uid, (api.encode_response(y), BubbleAPIStatus.OK)))
+
+
+def run(name: str, num_requests: int, max_batch_size: int, batch_timeout: float, codec_size: int, predict_time: float):
+    api = SimulatedAPI(codec_size, predict_time)
+    api.request_timeout = -1
+    api._sanitize(max_batch_size, spec=None)
+    request_queue, response_queue = Queue(), Queue()
+
+    stopped = threading.Event()
+    if name == "engine":
+        engine = InferenceEngine(
+            api, None, request_queue, [response_queue], max_batch_size, batch_timeout, False, stop_event=stopped
+        )
+        loop = engine.run()
+    else:
+        loop = legacy_loop(api, request_queue, [response_queue], max_batch_size, batch_timeout, name == "loops", stopped)
+    worker = threading.Thread(target=asyncio.run, args=(loop,), daemon=True)
+    worker.start()
+
+    start = time.perf_counter()
+    for uid in range(num_requests):
+        request_queue.put((0, uid, time.monotonic(), {"value": uid, "tokens": list(range(16))}))
+    for _ in range(num_requests):
+        response_queue.get()
+    elapsed = time.perf_counter() - start
+    stopped.set()
+    worker.join()
+    print(f"{name:>7}: {num_requests / elapsed:8.0f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--batch-timeout", type=float, default=0.002)
+    parser.add_argument("--codec-size", type=int, default=200, help="work done by decode/encode per item")
+    parser.add_argument("--predict-time", type=float, default=0.005, help="seconds per predict call")
+    args = parser.parse_args()
+    for name in ("server", "loops", "engine"):
+        run(name, args.requests, args.max_batch_size, args.batch_timeout, args.codec_size, args.predict_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Round-trip time of large NumPy payloads between the API process and an inference worker.
+
+`pickle` sends the array in-band through the queue, `zero-copy` sends a `SharedPayload` handle and
+the array travels through a shared-memory segment. The worker touches the array and sends it back.
+
+    python -m bubble-motor.benchmarks.payload_benchmark --sizes 1 10 100 --repeat 10
+"""
+
+import argparse
+import multiprocessing as mp
+import time
+
+import numpy as np
+
+from ..payloads import PayloadSegments, unpack_payload
+from ..transport import create_transport
+
+
+def worker(request_queue, response_queue, segments):
+    while True:
+        item = request_queue.get()
+        if item is None:
+            return
+        array = unpack_payload(item)
+        array[0] += 1
+        response_queue.put(segments.pack(array) if segments else array)
+
+
+def run(transport_name: str, zero_copy: bool, sizes_mb, repeat: int):
+    largest = max(sizes_mb) * 1024 * 1024
+    # in-band payloads must fit the ring, handles are a few hundred bytes
+    transport = create_transport(transport_name, capacity=largest + 1024 * 1024)
+    request_queue, response_queue = transport.queue(), transport.queue()
+    segments = PayloadSegments() if zero_copy else None
+    process = mp.get_context("spawn").Process(target=worker, args=(request_queue, response_queue, segments))
+    process.start()
+
+    label = f"{transport_name}+{'zero-copy' if zero_copy else 'pickle'}"
+    for size_mb in sizes_mb:
+        array = np.ones(size_mb * 1024 * 1024 // 8, dtype=np.float64)
+        timings = []
+        for _ in range(repeat + 1):
+            start = time.perf_counter()
+            request_queue.put(segments.pack(array) if segments else array)
+            result = unpack_payload(response_queue.get())
+            timings.append(time.perf_counter() - start)
+            del result
+        timings = sorted(timings[1:])
+        print(f"{label:>18} {size_mb:4d} MB: p50 {timings[len(timings) // 2] * 1000:8.2f} ms")
+
+    request_queue.put(None)
+    process.join()
+    transport.shutdown()
+    if segments:
+        segments.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100], help="array sizes in MB")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    run("manager", False, args.sizes, args.repeat)
+    run("shm", False, args.sizes, args.repeat)
+    run("shm", True, args.sizes, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Compare the Manager queue transport against the shared-memory ring transport.
+
+Runs echo workers in spawned processes and measures request throughput and round-trip latency
+between the "API" side (this process) and the workers.
+
+    python -m bubble-motor.benchmarks.transport_benchmark --requests 20000 --workers 2
+"""
+
+import argparse
+import multiprocessing as mp
+import threading
+import time
+from queue import Empty
+
+from ..transport import create_transport, get_many
+
+
+def echo_worker(request_queue, response_queue):
+    while True:
+        try:
+            item = request_queue.get(timeout=1.0)
+        except Empty:
+            continue
+        if item is None:
+            return
+        uid, sent_at, payload = item
+        response_queue.put((uid, sent_at, payload))
+
+
+def run(transport_name: str, num_requests: int, num_workers: int, concurrency: int, payload_size: int):
+    transport = create_transport(transport_name)
+    request_queue = transport.queue()
+    response_queue = transport.queue()
+    ctx = mp.get_context("spawn")
+    workers = [ctx.Process(target=echo_worker, args=(request_queue, response_queue)) for _ in range(num_workers)]
+    for w in workers:
+        w.start()
+
+    payload = b"x" * payload_size
+    in_flight = threading.Semaphore(concurrency)
+    latencies = []
+
+    def receive():
+        while len(latencies) < num_requests:
+            try:
+                items = get_many(response_queue, 256, timeout=1.0)
+            except Empty:
+                continue
+            now = time.perf_counter()
+            for _, sent_at, _ in items:
+                latencies.append(now - sent_at)
+                in_flight.release()
+
+    # warm up so process start-up is not measured
+    request_queue.put((-1, time.perf_counter(), payload))
+    response_queue.get()
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    start = time.perf_counter()
+    for uid in range(num_requests):
+        in_flight.acquire()
+        request_queue.put((uid, time.perf_counter(), payload))
+    receiver.join()
+    elapsed = time.perf_counter() - start
+
+    for _ in workers:
+        request_queue.put(None)
+    for w in workers:
+        w.join()
+    transport.shutdown()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"{transport_name:>8}: {num_requests / elapsed:10.0f} req/s  p50 {p50:7.3f} ms  p99 {p99:7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--payload-size", type=int, default=256)
+    args = parser.parse_args()
+    for name in ("manager", "shm"):
+        run(name, args.requests, args.workers, args.concurrency, args.payload_size)
+
+
+if __name__ == "__main__":
+    main()
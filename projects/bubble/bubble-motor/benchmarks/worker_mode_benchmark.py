@@ -0,0 +1,111 @@
+"""End-to-end throughput and latency of a small NumPy model served with process workers and with
+thread workers.
+
+Each mode starts a `BubbleServer` in a child process and sends `--requests` small JSON requests over
+HTTP from `--concurrency` concurrent clients. The model is one dense layer, whose NumPy matmul
+releases the GIL.
+
+    python -m bubble-motor.benchmarks.worker_mode_benchmark --requests 5000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import multiprocessing as mp
+import time
+
+import httpx
+import numpy as np
+
+from ..api import BubbleAPI
+from ..server import BubbleServer
+
+FEATURES = 64
+
+
+class DenseAPI(BubbleAPI):
+    async def setup(self, device):
+        self.weights = np.random.default_rng(0).standard_normal((FEATURES, FEATURES)).astype(np.float32)
+
+    def decode_request(self, request):
+        return np.asarray(request["x"], dtype=np.float32)
+
+    def predict(self, x):
+        return np.tanh(x @ self.weights)
+
+    def encode_response(self, output):
+        return {"y": float(output.sum())}
+
+
+def serve(worker_mode: str, port: int, workers: int, max_batch_size: int):
+    server = BubbleServer(
+        DenseAPI(),
+        accelerator="cpu",
+        workers_per_device=workers,
+        max_batch_size=max_batch_size,
+        batch_timeout=0.001,
+        worker_mode=worker_mode,
+    )
+    asyncio.run(server.run(port=port, num_api_servers=1, log_level="warning", generate_client_file=False))
+
+
+async def load(port: int, requests: int, concurrency: int):
+    url = f"http://127.0.0.1:{port}/predict"
+    payload = {"x": [0.5] * FEATURES}
+    latencies = []
+    uids = iter(range(requests))
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+
+        async def worker():
+            for _ in uids:
+                start = time.perf_counter()
+                response = await client.post(url, json=payload)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return requests / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def wait_ready(port: int, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError("server did not become ready")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    ctx = mp.get_context("spawn")
+    for worker_mode in ("process", "thread"):
+        server = ctx.Process(target=serve, args=(worker_mode, args.port, args.workers, args.max_batch_size))
+        server.start()
+        try:
+            wait_ready(args.port)
+            # warm up connections and the workers' first batches
+            asyncio.run(load(args.port, args.concurrency * 4, args.concurrency))
+            throughput, p50, p99 = asyncio.run(load(args.port, args.requests, args.concurrency))
+            print(
+                f"{worker_mode:>8}: {throughput:7.0f} req/s, p50 {p50 * 1000:6.1f} ms, p99 {p99 * 1000:6.1f} ms"
+            )
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
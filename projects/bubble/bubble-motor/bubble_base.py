@@ -16,6 +16,12 @@ class BubbleSpec:
     def setup(self, server: "BubbleServer"):
         self._server = server
 
+    def __getstate__(self):
+        # inference workers only decode requests and encode responses, the server stays in the API server
+        state = self.__dict__.copy()
+        state["_server"] = None
+        return state
+
     def add_endpoint(self, path: str, endpoint: Callable, methods: List[str]):
         """Register an endpoint in the spec."""
         self._endpoints.append((path, endpoint, methods))
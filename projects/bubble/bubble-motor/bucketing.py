@@ -0,0 +1,52 @@
+import itertools
+from bisect import bisect_left
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# upper bounds of the default buckets, sizes above the last one share a bucket
+DEFAULT_BUCKET_BOUNDARIES = tuple(2 ** i for i in range(3, 17))
+
+
+def padding_waste(sizes: Sequence[int]) -> float:
+    """Fraction of a batch padded to its longest item that is padding."""
+    padded = max(sizes) * len(sizes)
+    if not padded:
+        return 0.0
+    return 1 - sum(sizes) / padded
+
+
+class BucketBatcher:
+    """Groups collected requests by `size_key` into buckets and forms batches within one bucket.
+
+    A full bucket is served first, the one whose oldest request arrived first if several are full.
+    Otherwise the bucket holding the oldest request is served with what it has, so a rare size
+    doesn't wait for company longer than one collection round.
+    """
+
+    def __init__(self, size_key: Callable[[Any], int], boundaries: Optional[Sequence[int]] = None):
+        self.size_key = size_key
+        self.boundaries = tuple(sorted(boundaries or DEFAULT_BUCKET_BOUNDARIES))
+        # bucket -> (seq, size, payload)
+        self._buckets: Dict[int, deque] = {}
+        self._seq = itertools.count()
+        self.pending = 0
+
+    def add(self, payload: Tuple, input: Any):
+        """Queue a collected `(response_queue_id, uid, input)` payload."""
+        size = self.size_key(input)
+        bucket = bisect_left(self.boundaries, size)
+        self._buckets.setdefault(bucket, deque()).append((next(self._seq), size, payload))
+        self.pending += 1
+
+    def next_batch(self, batch_size: int) -> Tuple[List[Tuple], List[int]]:
+        """Up to `batch_size` payloads of one bucket and their sizes."""
+        if not self.pending:
+            return [], []
+        candidates = [b for b, q in self._buckets.items() if len(q) >= batch_size] or list(self._buckets)
+        bucket = min(candidates, key=lambda b: self._buckets[b][0][0])
+        queue = self._buckets[bucket]
+        taken = [queue.popleft() for _ in range(min(batch_size, len(queue)))]
+        if not queue:
+            del self._buckets[bucket]
+        self.pending -= len(taken)
+        return [payload for _, _, payload in taken], [size for _, size, _ in taken]
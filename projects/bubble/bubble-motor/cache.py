@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import logging
+import pickle
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, MutableMapping, Optional, Tuple
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_TTL = 300.0
+DEFAULT_CACHE_MAX_ENTRIES = 10_000
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+_MISSING = object()
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+class _Flight:
+    """A computation shared by the identical requests waiting for it."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+def _feed(h, obj: Any):
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        h.update(f"{type(obj).__name__}:{obj!r};".encode())
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        data = memoryview(obj).cast("B")
+        h.update(f"bytes:{data.nbytes};".encode())
+        h.update(data)
+    elif isinstance(obj, dict):
+        h.update(f"dict:{len(obj)};".encode())
+        for key, value in sorted(obj.items(), key=lambda item: repr(item[0])):
+            _feed(h, key)
+            _feed(h, value)
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"list:{len(obj)};".encode())
+        for value in obj:
+            _feed(h, value)
+    elif isinstance(obj, BaseModel):
+        _feed(h, obj.model_dump() if hasattr(obj, "model_dump") else obj.dict())
+    elif hasattr(obj, "__array__") and hasattr(obj, "dtype"):
+        import numpy as np
+
+        array = np.ascontiguousarray(obj)
+        h.update(f"array:{array.dtype.str}:{array.shape};".encode())
+        h.update(memoryview(array).cast("B"))
+    else:
+        raise _Uncacheable(type(obj).__name__)
+
+
+def request_key(payload: Any, model_version: Optional[str] = None) -> Optional[str]:
+    """Stable hash of a decoded request payload and the model version, or None if it can't be hashed."""
+    h = hashlib.blake2b(digest_size=16)
+    _feed(h, model_version)
+    try:
+        _feed(h, payload)
+    except _Uncacheable as e:
+        logger.debug(f"Request payload of type {e} is not cacheable")
+        return None
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Opt-in cache of `/predict` responses, keyed by `request_key`.
+
+    Entries are kept in LRU order and evicted when they are older than `ttl` seconds or when the
+    cache holds more than `max_entries` entries or `max_bytes` of pickled responses. Identical
+    requests that arrive while the first one is still being computed wait for its result instead of
+    reaching the workers (single-flight). A waiter that is cancelled stops waiting, the computation
+    itself is only cancelled when no request waits for it anymore. Errors are never cached.
+
+    With `shared=True` the server also stores responses in a dict of its transport, so API servers
+    in other processes can answer from it. Local misses are then looked up there before computing.
+    """
+
+    def __init__(
+        self,
+        ttl: Optional[float] = DEFAULT_CACHE_TTL,
+        max_entries: int = DEFAULT_CACHE_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+        shared: bool = False,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.backend: Optional[MutableMapping[str, Tuple[float, bytes]]] = None
+        self.nbytes = 0
+        self.counters = {
+            "result_cache_hits_total": 0,
+            "result_cache_misses_total": 0,
+            "result_cache_coalesced_total": 0,
+            "result_cache_evictions_total": 0,
+        }
+        # key -> (monotonic expiry, pickled size, response)
+        self._entries: "OrderedDict[str, Tuple[float, int, Any]]" = OrderedDict()
+        self._inflight: Dict[str, _Flight] = {}
+
+    def _expiry(self, now: float) -> float:
+        return now + self.ttl if self.ttl else float("inf")
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self.nbytes -= size
+
+    def _get_local(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        if entry[0] < time.monotonic():
+            self._remove(key)
+            return _MISSING
+        self._entries.move_to_end(key)
+        return entry[2]
+
+    def _set_local(self, key: str, value: Any, size: int, expires_at: float):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, size, value)
+        self.nbytes += size
+        while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.counters["result_cache_evictions_total"] += 1
+
+    async def get(self, key: str) -> Any:
+        value = self._get_local(key)
+        if value is not _MISSING or self.backend is None:
+            return value
+        loop = asyncio.get_running_loop()
+        stored = await loop.run_in_executor(None, self.backend.get, key)
+        if stored is None:
+            return _MISSING
+        expires_at, data = stored
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            return _MISSING
+        value = pickle.loads(data)
+        self._set_local(key, value, len(data), time.monotonic() + remaining)
+        return value
+
+    async def set(self, key: str, value: Any):
+        try:
+            data = pickle.dumps(value, protocol=5)
+        except Exception:
+            logger.debug(f"Response for cache key {key} can't be pickled, not caching it")
+            return
+        if len(data) > self.max_bytes:
+            return
+        self._set_local(key, value, len(data), self._expiry(time.monotonic()))
+        if self.backend is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.backend.__setitem__, key, (self._expiry(time.time()), data))
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        value = await self.get(key)
+        if value is not _MISSING:
+            self.counters["result_cache_hits_total"] += 1
+            return value
+
+        flight = self._inflight.get(key)
+        if flight is None:
+            self.counters["result_cache_misses_total"] += 1
+            flight = _Flight(asyncio.get_running_loop().create_task(self._compute(key, compute)))
+            self._inflight[key] = flight
+        else:
+            self.counters["result_cache_coalesced_total"] += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+                flight.task.cancel()
+            raise
+
+    async def _compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await compute()
+            await self.set(key, value)
+            return value
+        finally:
+            if self._inflight.get(key) is not None and self._inflight[key].task is asyncio.current_task():
+                del self._inflight[key]
+
+    def sweep(self):
+        """Drop expired local entries."""
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _, _) in self._entries.items() if expires_at < now]:
+            self._remove(key)
+
+    def trim_backend(self):
+        """Drop expired entries of the shared backend and trim it to the limits of the local cache.
+
+        Blocking, since every access to the backend is an IPC round-trip.
+        """
+        now = time.time()
+        entries = sorted(self.backend.items(), key=lambda item: item[1][0])
+        total = sum(len(data) for _, (_, data) in entries)
+        for i, (key, (expires_at, data)) in enumerate(entries):
+            if expires_at >= now and len(entries) - i <= self.max_entries and total <= self.max_bytes:
+                break
+            self.backend.pop(key, None)
+            total -= len(data)
+
+    def metrics(self) -> dict:
+        return {
+            "gauges": {"result_cache_entries": len(self._entries), "result_cache_bytes": self.nbytes},
+            "counters": dict(self.counters),
+        }
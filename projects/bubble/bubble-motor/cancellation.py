@@ -0,0 +1,73 @@
+import pickle
+import time
+from typing import Dict, List, Mapping
+
+from fastapi import HTTPException
+
+from .metrics import metric_key
+from .transport import SharedDictWriter
+from .utils import BubbleAPIStatus
+
+# how often workers read the requests cancelled by their API servers
+CANCEL_POLL_INTERVAL = 0.05
+# a cancelled request whose final response never arrives, e.g. because its worker crashed, is forgotten after this many seconds
+CANCELLATION_TTL = 300.0
+
+
+def cancelled_response() -> bytes:
+    """Pickled error sent in place of the response of a cancelled request."""
+    return pickle.dumps(HTTPException(499, "Client closed the request"))
+
+
+class Cancellations:
+    """API-side cancellation tokens of the requests whose client went away after they were dispatched.
+
+    A cancelled request is added to the shared dict its worker reads, and removed again once its
+    final response arrived.
+    """
+
+    def __init__(self, shared: Mapping, stream: bool, ttl: float = CANCELLATION_TTL):
+        self.shared = shared
+        self.stream = stream
+        self.ttl = ttl
+        self.pending: Dict[object, float] = {}
+        self.cancelled = {"queued": 0, "dispatched": 0}
+        self.writer = SharedDictWriter(shared, "bubble-cancellations")
+
+    def cancel(self, uid, dispatched: bool):
+        """Record a cancelled request, and tell its worker if it was dispatched. Runs on the event loop."""
+        if not dispatched:
+            self.cancelled["queued"] += 1
+            return
+        self.cancelled["dispatched"] += 1
+        self.pending[uid] = time.monotonic()
+        self.writer.add(uid)
+
+    def observe(self, responses: List[tuple]):
+        """Forget the cancelled requests whose final response arrived. Runs on the event loop."""
+        if not self.pending:
+            return
+        for uid, (_, status) in responses:
+            if uid not in self.pending:
+                continue
+            if self.stream and status in (BubbleAPIStatus.OK, BubbleAPIStatus.CHUNKS):
+                continue
+            self._forget(uid)
+
+    def sweep(self):
+        now = time.monotonic()
+        for uid in [uid for uid, cancelled_at in self.pending.items() if now - cancelled_at > self.ttl]:
+            self._forget(uid)
+
+    def _forget(self, uid):
+        del self.pending[uid]
+        self.writer.discard(uid)
+
+    def metrics(self) -> dict:
+        return {
+            "gauges": {"requests_cancelling": len(self.pending)},
+            "counters": {
+                metric_key("requests_cancelled_total", {"stage": stage}): count
+                for stage, count in self.cancelled.items()
+            },
+        }
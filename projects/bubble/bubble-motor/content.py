@@ -0,0 +1,185 @@
+import io
+import json
+from math import prod
+from typing import Any, Callable, Optional
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+NPY = "application/x-npy"
+OCTET_STREAM = "application/octet-stream"
+BINARY_MEDIA_TYPES = (MSGPACK, NPY, OCTET_STREAM)
+# unregistered names still sent by older msgpack clients
+_MEDIA_TYPE_ALIASES = {"application/x-msgpack": MSGPACK}
+# msgpack extension type of a NumPy array, the extension data is the array in .npy format
+NDARRAY_EXT_CODE = 1
+
+
+def media_type(content_type: Optional[str]) -> str:
+    """Media type of a Content-Type or Accept entry, without parameters."""
+    if not content_type:
+        return ""
+    name = content_type.split(";", 1)[0].strip().lower()
+    return _MEDIA_TYPE_ALIASES.get(name, name)
+
+
+def negotiate(accept: Optional[str]) -> Optional[str]:
+    """Binary media type preferred by an Accept header, or None when JSON should be returned."""
+    if not accept:
+        return None
+    best, best_q = None, 0.0
+    for entry in accept.split(","):
+        name, *params = entry.split(";")
+        name = media_type(name)
+        if name not in BINARY_MEDIA_TYPES and name != JSON:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = name, q
+    return best if best in BINARY_MEDIA_TYPES else None
+
+
+def _msgpack(status_code: int):
+    try:
+        import msgpack
+    except ImportError:
+        raise HTTPException(status_code, f"{MSGPACK} requires the msgpack package: pip install msgpack")
+    return msgpack
+
+
+def npy_loads(data: bytes):
+    """Read a .npy body as an array backed by `data` itself. The array is read-only."""
+    import numpy as np
+    from numpy.lib import format as npy_format
+
+    stream = io.BytesIO(data)
+    version = npy_format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_1_0(stream)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_2_0(stream)
+    else:
+        return np.load(io.BytesIO(data), allow_pickle=False)
+    if dtype.hasobject:
+        raise ValueError("object arrays are not supported")
+    array = np.frombuffer(data, dtype=dtype, count=prod(shape), offset=stream.tell())
+    return array.reshape(shape, order="F" if fortran_order else "C")
+
+
+def npy_dumps(obj: Any) -> bytes:
+    import numpy as np
+
+    stream = io.BytesIO()
+    np.save(stream, np.asarray(obj), allow_pickle=False)
+    return stream.getvalue()
+
+
+def _msgpack_default(obj: Any):
+    if isinstance(obj, BaseModel):
+        return obj.model_dump() if hasattr(obj, "model_dump") else obj.dict()
+    if getattr(obj, "ndim", None) == 0 and hasattr(obj, "item"):
+        return obj.item()
+    if hasattr(obj, "__array__"):
+        import msgpack
+
+        return msgpack.ExtType(NDARRAY_EXT_CODE, npy_dumps(obj))
+    raise TypeError(f"Object of type {type(obj).__name__} is not msgpack serializable")
+
+
+def _msgpack_ext_hook(code: int, data: bytes):
+    if code == NDARRAY_EXT_CODE:
+        return npy_loads(data)
+    import msgpack
+
+    return msgpack.ExtType(code, data)
+
+
+def decode_body(content_type: str, body: bytes) -> Any:
+    if content_type == MSGPACK:
+        return _msgpack(415).unpackb(body, raw=False, ext_hook=_msgpack_ext_hook)
+    if content_type == NPY:
+        return npy_loads(body)
+    if content_type == OCTET_STREAM:
+        return body
+    return json.loads(body)
+
+
+def encode_body(content_type: str, obj: Any) -> bytes:
+    try:
+        if content_type == MSGPACK:
+            return _msgpack(406).packb(obj, default=_msgpack_default)
+        if content_type == NPY:
+            return npy_dumps(obj)
+        if content_type == OCTET_STREAM:
+            if isinstance(obj, str):
+                return obj.encode()
+            if hasattr(obj, "__array__"):
+                import numpy as np
+
+                obj = np.ascontiguousarray(obj)
+            return bytes(memoryview(obj))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(406, f"Response cannot be encoded as {content_type}: {e}")
+    raise HTTPException(406, f"Unsupported media type {content_type}")
+
+
+async def _as_decoded_request(request: Request, content_type: str) -> Request:
+    body = await request.body()
+    try:
+        decoded = decode_body(content_type, body)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(400, f"Invalid {content_type} body: {e}")
+    # hand the decoded object to FastAPI and to endpoints as the request's JSON, so pydantic request
+    # models and `await request.json()` work unchanged
+    scope = dict(request.scope)
+    scope["headers"] = [(k, v) for k, v in request.scope["headers"] if k != b"content-type"]
+    scope["headers"].append((b"content-type", JSON.encode()))
+    decoded_request = Request(scope, request.receive)
+    decoded_request._body = body
+    decoded_request._json = decoded
+    return decoded_request
+
+
+class NegotiatedRoute(APIRoute):
+    """APIRoute that accepts msgpack, npy and raw bytes bodies besides JSON.
+
+    Binary bodies are decoded once, without going through JSON, and reach the endpoint as the
+    request's JSON. JSON responses are re-encoded as msgpack when the client prefers it. Endpoints
+    that want to answer with npy or raw bytes encode the response themselves with `encode_body`.
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def negotiated_handler(request: Request) -> Response:
+            content_type = media_type(request.headers.get("content-type"))
+            if content_type in BINARY_MEDIA_TYPES:
+                request = await _as_decoded_request(request, content_type)
+            response = await handler(request)
+
+            if isinstance(response, JSONResponse) and negotiate(request.headers.get("accept")) == MSGPACK:
+                content = encode_body(MSGPACK, json.loads(response.body))
+                headers = {k: v for k, v in response.headers.items() if k not in ("content-length", "content-type")}
+                return Response(
+                    content,
+                    status_code=response.status_code,
+                    headers=headers,
+                    media_type=MSGPACK,
+                    background=response.background,
+                )
+            return response
+
+        return negotiated_handler
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from queue import Empty
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from .payloads import unpack_payload
+from .transport import get_many
+from .utils import BubbleAPIStatus
+
+logger = logging.getLogger(__name__)
+
+# upper bound of responses handed to the event loop per wakeup
+MAX_RESPONSES_PER_DISPATCH = 256
+
+
+def deliver(response_buffer: Dict, responses: List[tuple]):
+    """Hand `(uid, (data, status))` responses to their waiters in `response_buffer`. Runs on the event loop."""
+    for uid, response in responses:
+        entry = response_buffer.get(uid)
+        if entry is None:
+            logger.debug(f"Dropping response for unknown request uid={uid}")
+            continue
+        if isinstance(entry, asyncio.Event):
+            response_buffer[uid] = response
+            entry.set()
+        elif isinstance(entry, tuple) and isinstance(entry[1], asyncio.Event):
+            stream_response_buffer, event = entry
+            data, status = response
+            if status == BubbleAPIStatus.CHUNKS:
+                stream_response_buffer.extend((chunk, BubbleAPIStatus.OK) for chunk in data)
+            else:
+                stream_response_buffer.append(response)
+            event.set()
+        else:
+            logger.debug(f"Dropping duplicate response for request uid={uid}")
+
+
+def awaiting_response(entry) -> bool:
+    """Whether a `response_buffer` entry still waits for the final response of its request."""
+    if isinstance(entry, asyncio.Event):
+        return True
+    if isinstance(entry, tuple) and isinstance(entry[1], asyncio.Event):
+        stream_response_buffer = entry[0]
+        return not stream_response_buffer or stream_response_buffer[-1][1] not in (
+            BubbleAPIStatus.FINISH_STREAMING,
+            BubbleAPIStatus.ERROR,
+        )
+    return False
+
+
+class ResponseDemultiplexer:
+    """Routes the responses of one API server's response queue to its `response_buffer` waiters.
+
+    A reader thread takes every response that is already queued in one bulk read and hands the whole
+    batch to the event loop with a single `call_soon_threadsafe`, so streaming many tokens does not
+    cost one executor round-trip per token.
+
+    A response queue that can `bind` to the event loop, such as the `LoopQueue` of thread workers,
+    calls `dispatch` itself and needs no reader thread.
+
+    Notices of requests stolen by a peer worker are not delivered, their `(uid, worker_id)` pairs are
+    passed to `on_stolen`.
+    """
+
+    def __init__(
+        self,
+        response_queue,
+        response_buffer: Dict[str, Union[Tuple[deque, asyncio.Event], asyncio.Event]],
+        max_batch: int = MAX_RESPONSES_PER_DISPATCH,
+        poll_timeout: float = 1.0,
+        on_responses: Optional[Callable[[List[tuple]], None]] = None,
+        on_stolen: Optional[Callable[[List[tuple]], None]] = None,
+    ):
+        self.response_queue = response_queue
+        self.response_buffer = response_buffer
+        self.max_batch = max_batch
+        self.poll_timeout = poll_timeout
+        self.on_responses = on_responses
+        self.on_stolen = on_stolen
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        if hasattr(self.response_queue, "bind"):
+            self.response_queue.bind(loop, self.dispatch)
+            return
+        self._thread = threading.Thread(target=self._read, name="bubble-response-demux", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(self.poll_timeout * 2)
+
+    def _read(self):
+        while not self._stopped.is_set():
+            try:
+                responses = get_many(self.response_queue, self.max_batch, timeout=self.poll_timeout)
+            except Empty:
+                continue
+            except (EOFError, OSError):
+                logger.debug("Response queue closed, stopping the response demultiplexer")
+                return
+            # map zero-copy payloads here so the event loop only does the routing
+            responses = [(uid, (unpack_payload(data), status)) for uid, (data, status) in responses]
+            try:
+                self._loop.call_soon_threadsafe(self.dispatch, responses)
+            except RuntimeError:
+                # event loop already closed
+                return
+
+    def dispatch(self, responses: List[tuple]):
+        """Deliver responses to their waiters. Runs on the event loop."""
+        stolen = [(uid, data) for uid, (data, status) in responses if status == BubbleAPIStatus.STOLEN]
+        if stolen:
+            responses = [response for response in responses if response[1][1] != BubbleAPIStatus.STOLEN]
+            if self.on_stolen is not None:
+                self.on_stolen(stolen)
+        deliver(self.response_buffer, responses)
+        if self.on_responses is not None:
+            self.on_responses(responses)
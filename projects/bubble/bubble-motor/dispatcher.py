@@ -0,0 +1,166 @@
+import logging
+from queue import Empty
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from .metrics import RATE_WINDOW, RateMeter, metric_key
+from .transport import get_many
+
+logger = logging.getLogger(__name__)
+
+# how long an idle worker waits on its own queue before it looks for work to steal again
+STEAL_INTERVAL = 0.05
+
+
+class Dispatcher:
+    """Queue-like front of the per-worker request queues of the inference workers.
+
+    Each request goes to the worker with the earliest expected finish time: its outstanding
+    requests divided by its measured throughput. Until every worker has a measurement, requests are
+    spread by outstanding count. Throughput is counted over `window` seconds in which the worker was
+    busy, so it reflects the device speed and the input sizes the worker was given.
+
+    A request stolen by a peer is `reassign`ed to the peer, so its completion counts towards the
+    throughput of the worker that served it and it isn't run again when its first worker exits.
+
+    A worker that exited is `evict`ed: it gets no new requests until it is `restore`d, unless no
+    worker is available.
+    """
+
+    def __init__(self, queues: Sequence, smoothing: float = 0.2, window: float = RATE_WINDOW):
+        self.queues = list(queues)
+        self.outstanding = [0] * len(self.queues)
+        self.completions = [RateMeter(window, smoothing) for _ in self.queues]
+        self.available = [True] * len(self.queues)
+        # uid -> (worker_id, item)
+        self._assigned: Dict[Any, Tuple[int, tuple]] = {}
+        self._retries: Dict[Any, int] = {}
+
+    def _pick(self) -> int:
+        workers = [w for w in range(len(self.queues)) if self.available[w]] or range(len(self.queues))
+        throughput = [meter.rate for meter in self.completions]
+        if not all(throughput[w] for w in workers):
+            return min(workers, key=lambda w: self.outstanding[w])
+        return min(workers, key=lambda w: (self.outstanding[w] + 1) / throughput[w])
+
+    def put_nowait(self, item: tuple):
+        self.put_many((item,))
+
+    put = put_nowait
+
+    def put_many(self, items: Sequence[tuple]):
+        """Dispatch `items` to a single worker, one after another, so they can share its next batch."""
+        worker_id = self._pick()
+        if self.outstanding[worker_id] == 0:
+            # the worker was idle, start measuring from now
+            self.completions[worker_id].restart()
+        self.outstanding[worker_id] += len(items)
+        queue = self.queues[worker_id]
+        for item in items:
+            self._assigned[item[1]] = worker_id, item
+            queue.put_nowait(item)
+
+    def reassign(self, stolen: Sequence[Tuple[Any, int]]):
+        """Account the `(uid, worker_id)` requests to the peer that took them. Runs on the event loop."""
+        for uid, worker_id in stolen:
+            assigned = self._assigned.get(uid)
+            if assigned is None or assigned[0] == worker_id:
+                continue
+            owner, item = assigned
+            self.outstanding[owner] -= 1
+            if self.outstanding[worker_id] == 0:
+                self.completions[worker_id].restart()
+            self.outstanding[worker_id] += 1
+            self._assigned[uid] = worker_id, item
+
+    def complete(self, uid):
+        """Account for the final response of `uid`. Runs on the event loop."""
+        assigned = self._assigned.pop(uid, None)
+        if assigned is None:
+            return
+        worker_id = assigned[0]
+        if self._retries:
+            self._retries.pop(uid, None)
+        self.outstanding[worker_id] -= 1
+        self.completions[worker_id].add()
+
+    def evict(self, worker_id: int, requeued: Set = frozenset()) -> List[tuple]:
+        """Take back the requests assigned to `worker_id`, whose worker exited. Runs on the event loop.
+
+        Returns the ones it had taken, except for the `requeued` uids that `requeue` found still in
+        its queue. They were lost with the worker.
+        """
+        self.available[worker_id] = False
+        held = [item for uid, (w, item) in self._assigned.items() if w == worker_id and uid not in requeued]
+        for uid in [uid for uid, (w, _) in self._assigned.items() if w == worker_id]:
+            del self._assigned[uid]
+        self.outstanding[worker_id] = 0
+        self.completions[worker_id].reset()
+        return held
+
+    def retry(self, item: tuple, max_retries: int) -> bool:
+        """Dispatch `item` again unless it was already retried `max_retries` times."""
+        uid = item[1]
+        retries = self._retries.get(uid, 0)
+        if retries >= max_retries:
+            self._retries.pop(uid, None)
+            return False
+        self._retries[uid] = retries + 1
+        self.put_nowait(item)
+        return True
+
+    def restore(self, worker_id: int):
+        """Dispatch to `worker_id` again, after its worker was restarted."""
+        self.available[worker_id] = True
+
+    def qsize(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def metrics(self) -> dict:
+        gauges = {}
+        for worker_id in range(len(self.queues)):
+            labels = {"worker_id": str(worker_id)}
+            gauges[metric_key("dispatcher_outstanding", labels)] = self.outstanding[worker_id]
+            gauges[metric_key("dispatcher_throughput", labels)] = self.completions[worker_id].rate
+        return {"gauges": gauges, "counters": {}}
+
+
+def requeue(queues: Sequence, worker_id: int) -> List:
+    """Move the requests left in the queue of `worker_id`, whose worker exited, to the queues of its
+    peers, or back into its own queue if it has none. Returns their uids."""
+    queued = []
+    while True:
+        try:
+            queued += get_many(queues[worker_id], 256, block=False)
+        except (Empty, EOFError, OSError):
+            break
+    targets = [queue for i, queue in enumerate(queues) if i != worker_id] or [queues[worker_id]]
+    for i, item in enumerate(queued):
+        targets[i % len(targets)].put(item)
+    return [item[1] for item in queued]
+
+
+def steal(queues: Sequence, max_items: int) -> List[tuple]:
+    """Take the requests of the longest of `queues` that won't fit in its owner's next batch, without blocking."""
+    depths = []
+    for queue in queues:
+        try:
+            depths.append((queue.qsize(), queue))
+        except NotImplementedError:
+            continue
+    if not depths:
+        return []
+    depth, victim = max(depths, key=lambda d: d[0])
+    # the owner takes the first `max_items` itself when it is done with its current batch
+    surplus = depth - max_items
+    if surplus <= 0:
+        return []
+    try:
+        return get_many(victim, min(max_items, surplus), block=False)
+    except Empty:
+        return []
+
+
+def steal_from(request_queues: Sequence, worker_id: int) -> Optional[List]:
+    """Queues worker `worker_id` may steal from, None if it has no peers."""
+    others = [queue for i, queue in enumerate(request_queues) if i != worker_id]
+    return others or None
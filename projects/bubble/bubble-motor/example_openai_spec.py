@@ -289,41 +289,46 @@ class OpenAISpec(BubbleSpec):
 
     async def get_from_queues(self, uids) -> List[AsyncGenerator]:
         choice_pipes = []
-        for uid, q, event in zip(uids, self.queues, self.events):
-            data = self._server.data_streamer(q, event, send_status=True)
+        for uid in uids:
+            q, event = self._server.response_buffer[uid]
+            data = self._server.data_streamer(q, event, send_status=True, uid=uid)
             choice_pipes.append(data)
         return choice_pipes
 
     async def options_chat_completions(self, request: Request):
         return Response(status_code=200)
 
-    async def chat_completion(self, request: ChatCompletionRequest, background_tasks: BackgroundTasks):
+    async def chat_completion(
+        self, request: ChatCompletionRequest, http_request: Request, background_tasks: BackgroundTasks
+    ):
         response_queue_id = self.response_queue_id
         logger.debug("Received chat completion request %s", request)
+        self._server.scheduler.admit()
         uids = [uuid.uuid4() for _ in range(request.n)]
-        self.queues = []
-        self.events = []
         for uid in uids:
             request_el = request.model_copy()
             request_el.n = 1
             q = deque()
             event = asyncio.Event()
             self._server.response_buffer[uid] = (q, event)
-            self._server.request_queue.put((response_queue_id, uid, time.monotonic(), request_el))
-            self.queues.append(q)
-            self.events.append(event)
+            self._server.scheduler.submit((response_queue_id, uid, time.monotonic(), request_el))
 
         responses = await self.get_from_queues(uids)
 
         if request.stream:
+            # the streams are cancelled when the client leaves and their generators are closed
             return StreamingResponse(
                 self.streaming_completion(request, responses),
                 media_type="application/x-ndjson",
                 background=background_tasks,
             )
 
-        response_task = asyncio.create_task(self.non_streaming_completion(request, responses))
-        return await response_task
+        watcher = self._server.cancel_on_disconnect(http_request, uids)
+        try:
+            response_task = asyncio.create_task(self.non_streaming_completion(request, responses))
+            return await response_task
+        finally:
+            watcher.cancel()
 
     async def streaming_completion(self, request: ChatCompletionRequest, pipe_responses: List):
         model = request.model
@@ -347,45 +352,45 @@ class OpenAISpec(BubbleSpec):
             chunk = ChatCompletionChunk(model=model, choices=choices, usage=None).json()
             logger.debug(chunk)
             yield f"data: {chunk}\n\n"
-            choices = [
-                ChatCompletionStreamingChoice(
-                    index=i,
-                    delta=ChoiceDelta(),
-                    finish_reason="stop",
-                )
-                for i in range(request.n)
-            ]
-            last_chunk = ChatCompletionChunk(
-                model=model,
-                choices=choices,
-                usage=usage_info,
-            ).json()
-            yield f"data: {last_chunk}\n\n"
-            yield "data: [DONE]\n\n"
-
-        async def non_streaming_completion(self, request: ChatCompletionRequest, generator_list: List[AsyncGenerator]):
-            model = request.model
-            usage_infos = []
-            choices = []
-            for i, streaming_response in enumerate(generator_list):
-                msgs = []
-                tool_calls = None
-                usage = None
-                async for response, status in streaming_response:
-                    if status == BubbleAPIStatus.ERROR:
-                        load_and_raise(response)
-                    encoded_response = json.loads(response)
-                    logger.debug(encoded_response)
-                    chat_msg = ChatMessage(**encoded_response)
-                    usage = UsageInfo(**encoded_response)
-                    msgs.append(chat_msg.content)
-                    if chat_msg.tool_calls:
-                        tool_calls = chat_msg.tool_calls
-
-                content = "".join(msgs)
-                msg = {"role": "assistant", "content": content, "tool_calls": tool_calls}
-                choice = ChatCompletionResponseChoice(index=i, message=msg, finish_reason="stop")
-                choices.append(choice)
-                usage_infos.append(usage)  # Only use the last item from encode_response
-
-            return ChatCompletionResponse(model=model, choices=choices, usage=sum(usage_infos))
+        choices = [
+            ChatCompletionStreamingChoice(
+                index=i,
+                delta=ChoiceDelta(),
+                finish_reason="stop",
+            )
+            for i in range(request.n)
+        ]
+        last_chunk = ChatCompletionChunk(
+            model=model,
+            choices=choices,
+            usage=usage_info,
+        ).json()
+        yield f"data: {last_chunk}\n\n"
+        yield "data: [DONE]\n\n"
+
+    async def non_streaming_completion(self, request: ChatCompletionRequest, generator_list: List[AsyncGenerator]):
+        model = request.model
+        usage_infos = []
+        choices = []
+        for i, streaming_response in enumerate(generator_list):
+            msgs = []
+            tool_calls = None
+            usage = None
+            async for response, status in streaming_response:
+                if status == BubbleAPIStatus.ERROR:
+                    load_and_raise(response)
+                encoded_response = json.loads(response)
+                logger.debug(encoded_response)
+                chat_msg = ChatMessage(**encoded_response)
+                usage = UsageInfo(**encoded_response)
+                msgs.append(chat_msg.content)
+                if chat_msg.tool_calls:
+                    tool_calls = chat_msg.tool_calls
+
+            content = "".join(msgs)
+            msg = {"role": "assistant", "content": content, "tool_calls": tool_calls}
+            choice = ChatCompletionResponseChoice(index=i, message=msg, finish_reason="stop")
+            choices.append(choice)
+            usage_infos.append(usage)  # Only use the last item from encode_response
+
+        return ChatCompletionResponse(model=model, choices=choices, usage=sum(usage_infos))
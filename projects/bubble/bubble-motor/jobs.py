@@ -0,0 +1,259 @@
+import asyncio
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from .utils import BubbleAPIStatus
+
+logger = logging.getLogger(__name__)
+
+JOBS_PREFIX = "bubble-jobs"
+# finished jobs are kept this many seconds after their last update
+DEFAULT_JOB_TTL = 24 * 3600.0
+# how often a waiter polls the store for a job run by another API server
+JOB_POLL_INTERVAL = 0.25
+# longest long-poll a client can ask for, in seconds
+MAX_JOB_WAIT = 60.0
+# idle server-sent event streams send a comment this often, so proxies keep them open
+JOB_EVENTS_KEEPALIVE = 15.0
+# seconds a writer waits for another process holding the database lock
+_BUSY_TIMEOUT = 30.0
+
+QUEUED = "queued"
+COMPLETED = "completed"
+ERROR = "error"
+CANCELLED = "cancelled"
+FINISHED = (COMPLETED, ERROR, CANCELLED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    result BLOB,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_expires_at ON jobs (expires_at);
+"""
+
+
+class JobId(str):
+    """Uid of a request submitted as a job, whose worker writes the result to the `JobStore`."""
+
+    __slots__ = ()
+
+
+class JobStore:
+    """Jobs and their results in a SQLite database on local disk, with a TTL.
+
+    Inference workers write the result of a job straight to the database, so it outlives the
+    connection of the client and a restart of the server. All methods block. Each process and
+    thread opens its own connection, and the database is in WAL mode so readers don't wait for the
+    writers. Only the path and the TTL are pickled to the workers.
+
+    `temporary_store` creates a database in the temp directory, which `cleanup` deletes when its
+    server stops, for tests that don't need the results to persist.
+    """
+
+    def __init__(self, path: str, ttl: float = DEFAULT_JOB_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.temporary = False
+        self._local = threading.local()
+
+    @classmethod
+    def temporary_store(cls, ttl: float = DEFAULT_JOB_TTL) -> "JobStore":
+        # the database is only created by the first connection, when the server starts
+        path = os.path.join(tempfile.gettempdir(), f"{JOBS_PREFIX}-{uuid.uuid4().hex}.sqlite3")
+        store = cls(path, ttl)
+        store.temporary = True
+        return store
+
+    def __getstate__(self) -> dict:
+        return {"path": self.path, "ttl": self.ttl}
+
+    def __setstate__(self, state: dict):
+        self.__init__(**state)
+
+    def _connection(self) -> sqlite3.Connection:
+        # a connection inherited through fork is unusable, open a new one in the child
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            connection = sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(_SCHEMA)
+            self._local.connection, self._local.pid = connection, pid
+        return self._local.connection
+
+    def _row(self, row: Optional[tuple]) -> Optional[Dict[str, Any]]:
+        if row is None or row[4] < time.time():
+            return None
+        job_id, status, created_at, updated_at, expires_at = row
+        return {
+            "job_id": job_id,
+            "status": status,
+            "created_at": created_at,
+            "updated_at": updated_at,
+            "expires_at": expires_at,
+        }
+
+    def create(self, job_id: str):
+        now = time.time()
+        self._connection().execute(
+            "INSERT INTO jobs VALUES (?, ?, NULL, ?, ?, ?)", (job_id, QUEUED, now, now, now + self.ttl)
+        )
+
+    def finish(self, job_id: str, status: str, response: Any):
+        """Store the response of a job, unless it was cancelled. An error response is already pickled."""
+        if status == BubbleAPIStatus.ERROR:
+            status, result = ERROR, response
+        else:
+            status, result = COMPLETED, pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        self._connection().execute(
+            "UPDATE jobs SET status = ?, result = ?, updated_at = ?, expires_at = ? WHERE job_id = ? AND status = ?",
+            (status, result, now, now + self.ttl, job_id, QUEUED),
+        )
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Cancel a queued job. Returns the job, or None if it is unknown."""
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "UPDATE jobs SET status = ?, updated_at = ?, expires_at = ? WHERE job_id = ? AND status = ?",
+            (CANCELLED, now, now + self.ttl, job_id, QUEUED),
+        )
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            "SELECT job_id, status, created_at, updated_at, expires_at FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return self._row(row)
+
+    def result(self, job_id: str) -> Optional[bytes]:
+        row = self._connection().execute("SELECT result FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def fail_unfinished(self) -> int:
+        """Fail the jobs left queued by a previous run of the server, whose requests are gone."""
+        now = time.time()
+        error = pickle.dumps(RuntimeError("The server restarted before the job finished"))
+        cursor = self._connection().execute(
+            "UPDATE jobs SET status = ?, result = ?, updated_at = ?, expires_at = ? WHERE status = ?",
+            (ERROR, error, now, now + self.ttl, QUEUED),
+        )
+        return cursor.rowcount
+
+    def sweep(self) -> int:
+        cursor = self._connection().execute("DELETE FROM jobs WHERE expires_at < ?", (time.time(),))
+        return cursor.rowcount
+
+    def cleanup(self):
+        """Delete the database of a temporary store."""
+        if not self.temporary:
+            return
+        if getattr(self._local, "pid", None) == os.getpid():
+            self._local.connection.close()
+            del self._local.connection, self._local.pid
+        for path in (self.path, f"{self.path}-wal", f"{self.path}-shm"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class Jobs:
+    """The `JobStore` as seen from the event loop of one API server.
+
+    Every store access runs in the default executor. Waiters of a job this API server submitted are
+    woken as soon as its worker reports that it finished, waiters of other jobs poll the store.
+    """
+
+    def __init__(self, store: JobStore, poll_interval: float = JOB_POLL_INTERVAL):
+        self.store = store
+        self.poll_interval = poll_interval
+        self.counters = {"jobs_submitted_total": 0, "jobs_cancelled_total": 0, "jobs_expired_total": 0}
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+
+    async def _call(self, method, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+
+    async def submit(self, job_id: str):
+        await self._call(self.store.create, job_id)
+        self.counters["jobs_submitted_total"] += 1
+
+    async def finish(self, job_id: str, status: str, response: Any):
+        await self._call(self.store.finish, job_id, status, response)
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self._call(self.store.get, job_id)
+
+    async def result(self, job_id: str) -> Optional[bytes]:
+        return await self._call(self.store.result, job_id)
+
+    async def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = await self._call(self.store.cancel, job_id)
+        if job is not None and job["status"] == CANCELLED:
+            self.counters["jobs_cancelled_total"] += 1
+            self.notify(job_id)
+        return job
+
+    async def sweep(self):
+        self.counters["jobs_expired_total"] += await self._call(self.store.sweep)
+
+    def notify(self, job_id: str):
+        """Wake the waiters of a job that finished. Runs on the event loop."""
+        for waiter in self._waiters.pop(job_id, []):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """The job once it finished, or as it is after `timeout` seconds. None if it is unknown."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            waiter = loop.create_future()
+            self._waiters.setdefault(job_id, []).append(waiter)
+            try:
+                job = await self.get(job_id)
+                remaining = deadline - loop.time()
+                if job is None or job["status"] in FINISHED or remaining <= 0:
+                    return job
+                try:
+                    await asyncio.wait_for(waiter, min(self.poll_interval, remaining))
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                waiters = self._waiters.get(job_id)
+                if waiters is not None and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters[job_id]
+
+    async def events(self, job_id: str, keepalive: float = JOB_EVENTS_KEEPALIVE) -> AsyncIterator[str]:
+        """Server-sent events with the state of a job when it is read and once it finished."""
+        job = await self.get(job_id)
+        while True:
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'job_id': job_id, 'status': 'not_found'})}\n\n"
+                return
+            yield f"event: status\ndata: {json.dumps(job)}\n\n"
+            if job["status"] in FINISHED:
+                return
+            job = await self.wait(job_id, keepalive)
+            while job is not None and job["status"] == QUEUED:
+                yield ": keep-alive\n\n"
+                job = await self.wait(job_id, keepalive)
+
+    def metrics(self) -> dict:
+        return {"gauges": {"jobs_waiting": len(self._waiters)}, "counters": dict(self.counters)}
@@ -3,246 +3,823 @@ import inspect
 import logging
 import multiprocessing as mp
 import pickle
-import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from queue import Empty, Queue
-from typing import Dict, List, Optional, Tuple, Union
-
-from fastapi import HTTPException
-
-from .server import BubbleAPI
+from typing import Any, AsyncIterator, Callable, Dict, List, Mapping, Optional, Sequence, Set, Tuple, Union
+
+from .api import BubbleAPI
+from .batching import BatchPolicy, FixedBatchPolicy
+from .bucketing import BucketBatcher, padding_waste
+from .cache import request_key
+from .cancellation import CANCEL_POLL_INTERVAL, cancelled_response
+from .dispatcher import STEAL_INTERVAL, steal, steal_from
 from .bubble_base import BubbleSpec
+from .jobs import JobId, JobStore
+from .metrics import RATIO_BUCKETS, WorkerMetrics, size_buckets
+from .payloads import PayloadSegments, discard_payload, unpack_payload
+from .streaming import ChunkCoalescer, PausedStreams
+from .transport import SharedUids, SharedUidsReader, get_many
 from .utils import BubbleAPIStatus
+from .weights import SharedWeights
 
 mp.allow_connection_pickling()
 
 logger = logging.getLogger(__name__)
 
+# how long an idle worker blocks waiting for the first request before looping again
+IDLE_WAIT_TIMEOUT = 1.0
+
+@lru_cache(maxsize=None)
+def _accepts_context(func) -> bool:
+    return "context" in inspect.signature(func).parameters
+
 def _inject_context(context: Union[List[dict], dict], func, *args, **kwargs):
-    sig = inspect.signature(func)
-    if "context" in sig.parameters:
+    if _accepts_context(func):
         return func(*args, **kwargs, context=context)
     return func(*args, **kwargs)
 
-async def collate_requests(
-    bubble_api: BubbleAPI, request_queue: Queue, max_batch_size: int, batch_timeout: float
-) -> Tuple[List, List]:
-    payloads = []
-    timed_out_uids = []
-    entered_at = asyncio.get_event_loop().time()
-    end_time = entered_at + batch_timeout
-    apply_timeout = bubble_api.request_timeout not in (-1, False)
-
-    while asyncio.get_event_loop().time() < end_time and len(payloads) < max_batch_size:
-        remaining_time = end_time - asyncio.get_event_loop().time()
-        if remaining_time <= 0:
-            break
+async def _resolve(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
 
+async def _aiter(iterable) -> AsyncIterator:
+    if hasattr(iterable, "__aiter__"):
         try:
-            response_queue_id, uid, timestamp, x_enc = await asyncio.get_event_loop().run_in_executor(
-                None, request_queue.get, True, min(remaining_time, 0.001)
-            )
-            if apply_timeout and asyncio.get_event_loop().time() - timestamp > bubble_api.request_timeout:
-                timed_out_uids.append((response_queue_id, uid))
-            else:
-                payloads.append((response_queue_id, uid, x_enc))
-        except Empty:
-            continue
-
-    return payloads, timed_out_uids
+            async for item in iterable:
+                yield item
+        finally:
+            # stop the generator now when the stream is abandoned, not when it is collected
+            if hasattr(iterable, "aclose"):
+                await iterable.aclose()
+    else:
+        for item in iterable:
+            yield item
 
-async def run_single_loop(bubble_api: BubbleAPI, bubble_spec: BubbleSpec, request_queue: Queue, response_queues: List[Queue]):
-    while True:
+def _first_items(
+    request_queue: Queue,
+    max_batch_size: int,
+    idle_timeout: Optional[float],
+    steal_queues: Optional[Sequence],
+    on_steal: Optional[Callable[[List[tuple]], None]],
+) -> List[tuple]:
+    if steal_queues:
+        # an idle worker takes work queued for its peers before it goes to sleep on its own queue
         try:
-            response_queue_id, uid, timestamp, x_enc = await asyncio.get_event_loop().run_in_executor(
-                None, request_queue.get, True, 1.0
-            )
+            return get_many(request_queue, max_batch_size, block=False)
         except Empty:
-            await asyncio.sleep(0.01)
-            continue
-
-        if (bubble_api.request_timeout and bubble_api.request_timeout != -1) and (
-            asyncio.get_event_loop().time() - timestamp > bubble_api.request_timeout
-        ):
-            logger.error(f"Request {uid} timed out.")
-            response_queues[response_queue_id].put((uid, (HTTPException(504, "Request timed out"), BubbleAPIStatus.ERROR)))
-            continue
-
-        try:
-            context = {}
-            if hasattr(bubble_spec, "populate_context"):
-                bubble_spec.populate_context(context, x_enc)
-            x = _inject_context(context, bubble_api.decode_request, x_enc)
-            y = await _inject_context(context, bubble_api.predict, x)
-            y_enc = _inject_context(context, bubble_api.encode_response, y)
-            response_queues[response_queue_id].put((uid, (y_enc, BubbleAPIStatus.OK)))
-        except Exception as e:
-            logger.exception(f"Error processing request uid={uid}")
-            err_pkl = pickle.dumps(e)
-            response_queues[response_queue_id].put((uid, (err_pkl, BubbleAPIStatus.ERROR)))
-
-async def run_batched_loop(
-    bubble_api: BubbleAPI,
-    bubble_spec: BubbleSpec,
+            pass
+        items = steal(steal_queues, max_batch_size)
+        if items:
+            if on_steal is not None:
+                on_steal(items)
+            return items
+        idle_timeout = STEAL_INTERVAL
+    return get_many(request_queue, max_batch_size, timeout=idle_timeout)
+
+def collate_requests(
     request_queue: Queue,
-    response_queues: List[Queue],
     max_batch_size: int,
     batch_timeout: float,
-):
-    while True:
-        batches, timed_out_uids = await collate_requests(
-            bubble_api,
-            request_queue,
-            max_batch_size,
-            batch_timeout,
-        )
-
-        for response_queue_id, uid in timed_out_uids:
-            logger.error(f"Request {uid} timed out.")
-            response_queues[response_queue_id].put((uid, (HTTPException(504, "Request timed out"), BubbleAPIStatus.ERROR)))
-
-        if not batches:
-            await asyncio.sleep(0.01)
-            continue
-
-        response_queue_ids, uids, inputs = zip(*batches)
-        try:
-            contexts = [{}] * len(inputs)
-            if hasattr(bubble_spec, "populate_context"):
-                for input, context in zip(inputs, contexts):
-                    bubble_spec.populate_context(context, input)
-
-            x = [
-                _inject_context(context, bubble_api.decode_request, input)
-                for input, context in zip(inputs, contexts)
-            ]
-            x = bubble_api.batch(x)
-            y = await _inject_context(contexts, bubble_api.predict, x)
-            outputs = bubble_api.unbatch(y)
-            for response_queue_id, y, uid, context in zip(response_queue_ids, outputs, uids, contexts):
-                y_enc = _inject_context(context, bubble_api.encode_response, y)
-                response_queues[response_queue_id].put((uid, (y_enc, BubbleAPIStatus.OK)))
-
-        except Exception as e:
-            logger.exception("Error processing batched request.")
-            err_pkl = pickle.dumps(e)
-            for response_queue_id, uid in zip(response_queue_ids, uids):
-                response_queues[response_queue_id].put((uid, (err_pkl, BubbleAPIStatus.ERROR)))
+    idle_timeout: Optional[float] = IDLE_WAIT_TIMEOUT,
+    metrics: Optional[WorkerMetrics] = None,
+    steal_queues: Optional[Sequence[Queue]] = None,
+    on_steal: Optional[Callable[[List[tuple]], None]] = None,
+    arrival_rate: Optional[float] = None,
+) -> List[tuple]:
+    """Block until the first request arrives, drain what is already queued, then wait out `batch_timeout`.
+
+    Requests that can't meet their deadline are dropped by the `RequestScheduler` before they are
+    queued, so everything collected here is served. With `steal_queues`, a worker whose own queue is
+    empty takes the requests of the longest of them that won't fit in its owner's next batch, up to
+    `max_batch_size`, and passes them to `on_steal`.
+
+    Given a measured `arrival_rate` of requests per second, it stops waiting as soon as less than one
+    more request is expected before the timeout, so a lone request is not held for the whole timeout.
+    Without one, or while it is still 0, it waits out `batch_timeout`.
+    """
+    payloads = []
+    try:
+        items = _first_items(request_queue, max_batch_size, idle_timeout, steal_queues, on_steal)
+    except Empty:
+        return payloads
 
-async def run_streaming_loop(bubble_api: BubbleAPI, bubble_spec: BubbleSpec, request_queue: Queue, response_queues: List[Queue]):
+    end_time = time.monotonic() + batch_timeout
     while True:
+        now = time.monotonic()
+        for response_queue_id, uid, timestamp, x_enc in items:
+            if metrics:
+                metrics.observe("queue_wait_seconds", now - timestamp)
+            payloads.append((response_queue_id, uid, x_enc))
+
+        remaining_time = end_time - time.monotonic()
+        if arrival_rate:
+            # no need to wait for the last stretch of the timeout that is shorter than one arrival interval
+            remaining_time -= 1 / arrival_rate
+        if len(payloads) >= max_batch_size or remaining_time <= 0:
+            break
         try:
-            response_queue_id, uid, timestamp, x_enc = await asyncio.get_event_loop().run_in_executor(
-                None, request_queue.get, True, 1.0
-            )
-            logger.debug("uid=%s", uid)
+            items = get_many(request_queue, max_batch_size - len(payloads), timeout=remaining_time)
         except Empty:
-            await asyncio.sleep(0.01)
-            continue
-
-        if (bubble_api.request_timeout and bubble_api.request_timeout != -1) and (
-            asyncio.get_event_loop().time() - timestamp > bubble_api.request_timeout
-        ):
-            logger.error(f"Request {uid} timed out.")
-            response_queues[response_queue_id].put((uid, (HTTPException(504, "Request timed out"), BubbleAPIStatus.ERROR)))
-            continue
+            break
 
-        try:
-            context = {}
-            if hasattr(bubble_spec, "populate_context"):
-                bubble_spec.populate_context(context, x_enc)
-            x = _inject_context(context, bubble_api.decode_request, x_enc)
-            y_gen = await _inject_context(context, bubble_api.predict, x)
-            y_enc_gen = _inject_context(context, bubble_api.encode_response, y_gen)
-            async for y_enc in y_enc_gen:
-                y_enc = bubble_api.format_encoded_response(y_enc)
-                response_queues[response_queue_id].put((uid, (y_enc, BubbleAPIStatus.OK)))
-            response_queues[response_queue_id].put((uid, ("", BubbleAPIStatus.FINISH_STREAMING)))
-        except Exception as e:
-            logger.exception(f"Error processing streaming request uid={uid}")
-            response_queues[response_queue_id].put((uid, (pickle.dumps(e), BubbleAPIStatus.ERROR)))
+    return payloads
+
+def _group_identical(inputs: List[Any]) -> List[List[int]]:
+    """Indices of `inputs` grouped by identical payloads, in order of first appearance."""
+    groups: Dict[str, List[int]] = {}
+    unique = []
+    for i, input in enumerate(inputs):
+        key = request_key(input)
+        if key is None:
+            unique.append([i])
+        elif key in groups:
+            groups[key].append(i)
+        else:
+            groups[key] = [i]
+            unique.append(groups[key])
+    return unique
+
+class _Batch:
+    """Requests of one batch. `x` holds one input per group of identical requests in `groups`.
+
+    `capacity` is the batch size that was asked for, `sizes` the size keys of the requests when the
+    engine buckets by size.
+    """
+
+    __slots__ = ("response_queue_ids", "uids", "contexts", "x", "groups", "size", "capacity", "sizes")
+
+    def __init__(self, response_queue_ids, uids, contexts, x, groups, capacity=None, sizes=None):
+        self.response_queue_ids = response_queue_ids
+        self.uids = uids
+        self.contexts = contexts
+        self.x = x
+        self.groups = groups
+        self.size = len(groups)
+        self.capacity = capacity
+        self.sizes = sizes
+
+    @property
+    def saved(self) -> int:
+        return len(self.uids) - self.size
+
+    def primary_contexts(self) -> List[dict]:
+        return [self.contexts[group[0]] for group in self.groups]
+
+class _Sequence:
+    """A request in a continuous batch. `state` is its decoded request, advanced by `step`."""
+
+    __slots__ = ("response_queue_id", "uid", "context", "state")
+
+    def __init__(self, response_queue_id, uid, context, state):
+        self.response_queue_id = response_queue_id
+        self.uid = uid
+        self.context = context
+        self.state = state
+
+class InferenceEngine:
+    """Runs the request loop of one inference worker as a pipeline of decode, predict and encode.
+
+    Collating and decoding batch N+1 and encoding batch N-1 happen on a small thread pool while
+    batch N is in `predict`, so the model does not wait for Python-side (de)serialization. With
+    `max_batch_size == 1` requests are passed to `predict` one by one, without `batch`/`unbatch`.
+
+    With `coalesce=True` identical payloads collected in the same batch are decoded and predicted
+    once, and the output is encoded and sent to every request that asked for it.
+
+    When the API defines `size_key`, collected requests are held in a `BucketBatcher` and each batch
+    is formed from requests of one size bucket, so short inputs are not padded to the longest one.
+
+    With `continuous=True` the engine calls `step` on the active sequences instead of `predict` on
+    whole batches. Finished sequences leave and queued requests join between two steps, so a new
+    request doesn't wait for the longest generation in the batch.
+
+    Stream chunks are coalesced per request by `stream_flush_bytes`/`stream_flush_interval` when
+    either is set. Streams listed in `paused_streams` by their API server are held: a paused
+    sequence skips continuous batching steps, and a batch generator waits while any of its
+    streams is paused.
+
+    With `concurrent_batches > 1` up to that many batches are in `predict` at once, for an async
+    `predict` that waits on I/O such as a remote model. Batches finish in any order and each response
+    goes back to its own uid.
+
+    The results of jobs are written straight to `job_store`, and their API server only receives
+    their status.
+
+    A worker with a `worker_id` tells the API server of each request it steals from a peer's queue,
+    so the request is accounted to the worker that serves it.
+
+    Requests listed in `cancelled_requests` by their API server, because their client went away, are
+    skipped when they are collected, continuous batching drops their sequences and a generator stops
+    once all of its streams are cancelled. Each of them gets a 499 error as its final response.
+
+    `stop` makes `run` stop taking requests. It returns once the batches and sequences already taken
+    are done, and shuts down the thread pool, the reader of the paused and cancelled uids and the
+    flush thread of the chunk coalescer.
+    """
+
+    def __init__(
+        self,
+        bubble_api: BubbleAPI,
+        bubble_spec: Optional[BubbleSpec],
+        request_queue: Queue,
+        response_queues: List[Queue],
+        max_batch_size: int,
+        batch_timeout: float,
+        stream: bool,
+        batch_policy: Optional[BatchPolicy] = None,
+        metrics: Optional[WorkerMetrics] = None,
+        payload_segments: Optional[PayloadSegments] = None,
+        coalesce: bool = False,
+        steal_queues: Optional[List[Queue]] = None,
+        bucket_boundaries: Optional[Sequence[int]] = None,
+        continuous: bool = False,
+        stream_flush_bytes: Optional[int] = None,
+        stream_flush_interval: Optional[float] = None,
+        paused_streams: Optional[Mapping] = None,
+        concurrent_batches: int = 1,
+        job_store: Optional[JobStore] = None,
+        cancelled_requests: Optional[Mapping] = None,
+        worker_id: Optional[int] = None,
+        stop_event: Optional[threading.Event] = None,
+    ):
+        self.bubble_api = bubble_api
+        self.bubble_spec = bubble_spec
+        self.request_queue = request_queue
+        self.steal_queues = steal_queues
+        self.worker_id = worker_id
+        self._on_steal = self._announce_stolen if worker_id is not None else None
+        self.response_queues = response_queues
+        self.max_batch_size = max_batch_size
+        self._batch_size_buckets = size_buckets(max_batch_size)
+        self.batched = max_batch_size > 1
+        self.stream = stream
+        self.batch_policy = batch_policy or FixedBatchPolicy(max_batch_size, batch_timeout)
+        self.metrics = metrics
+        self.payload_segments = payload_segments
+        self.coalesce = coalesce and self.batched
+        self.continuous = continuous
+        self.concurrent_batches = concurrent_batches
+        self.job_store = job_store
+        self.coalescer = None
+        if stream and (stream_flush_bytes is not None or stream_flush_interval is not None):
+            self.coalescer = ChunkCoalescer(self._send_chunks, stream_flush_bytes, stream_flush_interval)
+        # one thread reads the paused streams and the cancelled requests of the API servers
+        self._shared_uids = SharedUidsReader()
+        self.paused = None
+        if stream and paused_streams is not None:
+            self.paused = self._shared_uids.watch(PausedStreams(paused_streams))
+        self.cancelled = None
+        if cancelled_requests is not None:
+            self.cancelled = self._shared_uids.watch(SharedUids(cancelled_requests, CANCEL_POLL_INTERVAL))
+        self._cancelled_response = cancelled_response()
+        self.bucketer = None
+        if self.batched and bubble_api.size_key is not None:
+            self.bucketer = BucketBatcher(bubble_api.size_key, bucket_boundaries)
+        # one thread collates and decodes the next batch, the other encodes the previous one
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="bubble-engine")
+        self._stopped = stop_event or threading.Event()
+
+    def stop(self):
+        """Stop taking requests, from any thread."""
+        self._stopped.set()
+
+    def _send(self, response_queue_id: int, uid, response: Any, status: str):
+        if self.job_store is not None and isinstance(uid, JobId):
+            try:
+                self.job_store.finish(uid, status, response)
+                # the API server only needs to know that the job finished
+                response = None
+            except Exception:
+                logger.exception(f"Failed to store the result of job {uid}, sending it to the API server")
+        elif self.payload_segments and status == BubbleAPIStatus.OK:
+            response = self.payload_segments.pack(response)
+        self.response_queues[response_queue_id].put((uid, (response, status)))
+
+    def _send_chunks(self, response_queue_id: int, uid, chunks: List[Any]):
+        if len(chunks) == 1:
+            self._send(response_queue_id, uid, chunks[0], BubbleAPIStatus.OK)
+        else:
+            self.response_queues[response_queue_id].put((uid, (chunks, BubbleAPIStatus.CHUNKS)))
+
+    def _put(self, response_queue_id: int, uid, response: Any, status: str):
+        if self.coalescer is not None:
+            if status == BubbleAPIStatus.OK:
+                self.coalescer.add(response_queue_id, uid, response)
+                return
+            # buffered chunks go out before the end of the stream
+            self.coalescer.flush(uid)
+        self._send(response_queue_id, uid, response, status)
+
+    def _announce_stolen(self, items: List[tuple]):
+        for response_queue_id, uid, _, _ in items:
+            self.response_queues[response_queue_id].put((uid, (self.worker_id, BubbleAPIStatus.STOLEN)))
+
+    def _observe_stage(self, stage: str, seconds: float):
+        if self.metrics:
+            self.metrics.observe("stage_latency_seconds", seconds, {"stage": stage})
+
+    def _send_error(self, response_queue_ids, uids, error: Exception):
+        if self.metrics:
+            self.metrics.inc("request_errors_total", len(uids))
+        err_pkl = pickle.dumps(error)
+        for response_queue_id, uid in zip(response_queue_ids, uids):
+            self._put(response_queue_id, uid, err_pkl, BubbleAPIStatus.ERROR)
+
+    def _cancel(self, response_queue_id: int, uid):
+        if self.metrics:
+            self.metrics.inc("requests_cancelled_total")
+        self._put(response_queue_id, uid, self._cancelled_response, BubbleAPIStatus.ERROR)
+
+    def _skip_cancelled(self, payloads: List[tuple]) -> List[tuple]:
+        """Drop the collected requests whose client went away, before they are decoded."""
+        if self.cancelled is None or not self.cancelled.uids:
+            return payloads
+        cancelled = self.cancelled.uids
+        kept = []
+        for response_queue_id, uid, input in payloads:
+            if uid in cancelled:
+                discard_payload(input)
+                self._cancel(response_queue_id, uid)
+            else:
+                kept.append((response_queue_id, uid, input))
+        return kept
+
+    def _skip_cancelled_batch(self, batch: _Batch) -> bool:
+        """Whether all requests of a decoded batch were cancelled while it waited for `predict`."""
+        if self.cancelled is None or not self.cancelled.uids:
+            return False
+        cancelled = self.cancelled.uids
+        if not all(uid in cancelled for uid in batch.uids):
+            return False
+        for response_queue_id, uid in zip(batch.response_queue_ids, batch.uids):
+            self._cancel(response_queue_id, uid)
+        return True
+
+    def _stop_cancelled(self, batch: _Batch, stopped: Set) -> bool:
+        """End the streams of `batch` cancelled since the last chunk, and return whether all of them are."""
+        cancelled = self.cancelled.uids if self.cancelled is not None else ()
+        if cancelled:
+            for response_queue_id, uid in zip(batch.response_queue_ids, batch.uids):
+                if uid in cancelled and uid not in stopped:
+                    stopped.add(uid)
+                    self._cancel(response_queue_id, uid)
+        return len(stopped) == len(batch.uids)
+
+    def _collect_bucketed(self, batch_size: int, timeout: float) -> Tuple[List[tuple], int, List[int]]:
+        """Add newly collated requests to their size buckets and take the next batch of one bucket."""
+        if self.bucketer.pending:
+            # requests are already waiting for a batch, only take what else has arrived
+            payloads = collate_requests(self.request_queue, batch_size, 0, idle_timeout=0, metrics=self.metrics)
+        else:
+            payloads = collate_requests(
+                self.request_queue,
+                batch_size,
+                timeout,
+                metrics=self.metrics,
+                steal_queues=self.steal_queues,
+                on_steal=self._on_steal,
+                arrival_rate=self.batch_policy.collation_arrival_rate(),
+            )
+        num_collected = len(payloads)
+        for response_queue_id, uid, input in self._skip_cancelled(payloads):
+            input = unpack_payload(input)
+            try:
+                self.bucketer.add((response_queue_id, uid, input), input)
+            except Exception as e:
+                logger.exception("Error computing the size key of a request.")
+                self._send_error([response_queue_id], [uid], e)
+        batch, sizes = self.bucketer.next_batch(batch_size)
+        return batch, num_collected, sizes
+
+    def _collect(self) -> Tuple[Optional[_Batch], int]:
+        """Collate and decode the next batch. Runs on the thread pool."""
+        if self._stopped.is_set():
+            return None, 0
+        batch_size, timeout = self.batch_policy.next_batch()
+        sizes = None
+        if self.bucketer is not None:
+            payloads, num_collected, sizes = self._collect_bucketed(batch_size, timeout)
+        else:
+            payloads = collate_requests(
+                self.request_queue,
+                batch_size,
+                timeout,
+                metrics=self.metrics,
+                steal_queues=self.steal_queues,
+                on_steal=self._on_steal,
+                arrival_rate=self.batch_policy.collation_arrival_rate(),
+            )
+            num_collected = len(payloads)
+            payloads = self._skip_cancelled(payloads)
+        if not payloads:
+            return None, num_collected
 
-async def run_batched_streaming_loop(
-    bubble_api: BubbleAPI,
-    bubble_spec: BubbleSpec,
-    request_queue: Queue,
-    response_queues: List[Queue],
-    max_batch_size: int,
-    batch_timeout: float,
-):
-    while True:
-        batches, timed_out_uids = await collate_requests(
-            bubble_api,
-            request_queue,
-            max_batch_size,
-            batch_timeout,
-        )
-        for response_queue_id, uid in timed_out_uids:
-            logger.error(f"Request {uid} timed out.")
-            response_queues[response_queue_id].put((uid, (HTTPException(504, "Request timed out"), BubbleAPIStatus.ERROR)))
-
-        if not batches:
-            await asyncio.sleep(0.01)
-            continue
-
-        response_queue_ids, uids, inputs = zip(*batches)
+        response_queue_ids, uids, inputs = zip(*payloads)
         try:
-            contexts = [{}] * len(inputs)
-            if hasattr(bubble_spec, "populate_context"):
+            inputs = [unpack_payload(input) for input in inputs]
+            contexts = [{} for _ in inputs]
+            if hasattr(self.bubble_spec, "populate_context"):
                 for input, context in zip(inputs, contexts):
-                    bubble_spec.populate_context(context, input)
-
+                    self.bubble_spec.populate_context(context, input)
+            groups = _group_identical(inputs) if self.coalesce else [[i] for i in range(len(inputs))]
+            start = time.perf_counter()
             x = [
-                _inject_context(context, bubble_api.decode_request, input)
-                for input, context in zip(inputs, contexts)
+                _inject_context(contexts[group[0]], self.bubble_api.decode_request, inputs[group[0]])
+                for group in groups
             ]
-            x = bubble_api.batch(x)
-            y_iter = await _inject_context(contexts, bubble_api.predict, x)
-            unbatched_iter = bubble_api.unbatch(y_iter)
-            y_enc_iter = _inject_context(contexts, bubble_api.encode_response, unbatched_iter)
-
-            async for y_batch in y_enc_iter:
-                for response_queue_id, y_enc, uid in zip(response_queue_ids, y_batch, uids):
-                    y_enc = bubble_api.format_encoded_response(y_enc)
-                    response_queues[response_queue_id].put((uid, (y_enc, BubbleAPIStatus.OK)))
+            self._observe_stage("decode_request", time.perf_counter() - start)
+            if self.batched:
+                start = time.perf_counter()
+                x = self.bubble_api.batch(x)
+                self._observe_stage("batch", time.perf_counter() - start)
+            else:
+                x = x[0]
+        except Exception as e:
+            logger.exception("Error decoding requests.")
+            self._send_error(response_queue_ids, uids, e)
+            return None, num_collected
+        return _Batch(response_queue_ids, uids, contexts, x, groups, batch_size, sizes), num_collected
+
+    async def _predict(self, batch: _Batch):
+        contexts = batch.primary_contexts() if self.batched else batch.contexts[0]
+        start = time.monotonic()
+        y = await _resolve(_inject_context(contexts, self.bubble_api.predict, batch.x))
+        latency = time.monotonic() - start
+        self.batch_policy.observe_predict(batch.size, latency)
+        self._observe_stage("predict", latency)
+        return y
+
+    def _encode(self, batch: _Batch, y):
+        """Encode the outputs of a finished batch and send them back. Runs on the thread pool."""
+        try:
+            if self.batched:
+                start = time.perf_counter()
+                outputs = self.bubble_api.unbatch(y)
+                self._observe_stage("unbatch", time.perf_counter() - start)
+            else:
+                outputs = [y]
+            encode_time = 0.0
+            for output, group in zip(outputs, batch.groups):
+                for i in group:
+                    start = time.perf_counter()
+                    y_enc = _inject_context(batch.contexts[i], self.bubble_api.encode_response, output)
+                    encode_time += time.perf_counter() - start
+                    self._put(batch.response_queue_ids[i], batch.uids[i], y_enc, BubbleAPIStatus.OK)
+            self._observe_stage("encode_response", encode_time)
+        except Exception as e:
+            logger.exception("Error encoding responses.")
+            self._send_error(batch.response_queue_ids, batch.uids, e)
+
+    async def _stream(self, batch: _Batch):
+        api = self.bubble_api
+        start = time.monotonic()
+        stopped = set()
+        if self.batched:
+            contexts = batch.primary_contexts()
+            y_iter = await _resolve(_inject_context(contexts, api.predict, batch.x))
+            y_enc_iter = _inject_context(contexts, api.encode_response, api.unbatch(y_iter))
+            chunks = _aiter(y_enc_iter)
+            async for y_batch in chunks:
+                if self.paused is not None:
+                    await self.paused.wait(batch.uids)
+                if self._stop_cancelled(batch, stopped):
+                    await chunks.aclose()
+                    return
+                for y_enc, group in zip(y_batch, batch.groups):
+                    y_enc = api.format_encoded_response(y_enc)
+                    for i in group:
+                        if batch.uids[i] not in stopped:
+                            self._put(batch.response_queue_ids[i], batch.uids[i], y_enc, BubbleAPIStatus.OK)
+        else:
+            context = batch.contexts[0]
+            y_gen = await _resolve(_inject_context(context, api.predict, batch.x))
+            y_enc_gen = _inject_context(context, api.encode_response, y_gen)
+            chunks = _aiter(y_enc_gen)
+            async for y_enc in chunks:
+                if self.paused is not None:
+                    await self.paused.wait(batch.uids)
+                if self._stop_cancelled(batch, stopped):
+                    await chunks.aclose()
+                    return
+                self._put(batch.response_queue_ids[0], batch.uids[0], api.format_encoded_response(y_enc), BubbleAPIStatus.OK)
+        # for streams the latency of a batch is the time to exhaust the generator
+        latency = time.monotonic() - start
+        self.batch_policy.observe_predict(batch.size, latency)
+        self._observe_stage("predict", latency)
+        for response_queue_id, uid in zip(batch.response_queue_ids, batch.uids):
+            if uid not in stopped:
+                self._put(response_queue_id, uid, "", BubbleAPIStatus.FINISH_STREAMING)
+
+    def _observe_collection(self, num_collected: int, batch: Optional[_Batch]):
+        self.batch_policy.observe_arrivals(num_collected)
+        if self.metrics:
+            if batch is not None:
+                self.metrics.observe("batch_size", len(batch.uids), buckets=self._batch_size_buckets)
+                if batch.saved:
+                    self.metrics.inc("inferences_saved_total", batch.saved)
+                if self.batched:
+                    self.metrics.observe("batch_fill_ratio", batch.size / batch.capacity, buckets=RATIO_BUCKETS)
+                if batch.sizes:
+                    # identical requests are predicted once, only their first copy is padded
+                    sizes = [batch.sizes[group[0]] for group in batch.groups]
+                    self.metrics.observe("batch_padding_waste", padding_waste(sizes), buckets=RATIO_BUCKETS)
+            if self.bucketer is not None:
+                self.metrics.set_gauge("bucket_pending", self.bucketer.pending)
+            for name, value in self.batch_policy.metrics().items():
+                self.metrics.set_gauge(name, value)
+            self.metrics.maybe_publish()
+
+    def _join(self, payloads: List[tuple], active: List[_Sequence]):
+        """Decode newly collected requests into sequences of the running batch."""
+        start = time.perf_counter()
+        for response_queue_id, uid, input in payloads:
+            context = {}
+            try:
+                state = _inject_context(context, self.bubble_api.decode_request, unpack_payload(input))
+            except Exception as e:
+                logger.exception("Error decoding request.")
+                self._send_error([response_queue_id], [uid], e)
+                continue
+            active.append(_Sequence(response_queue_id, uid, context, state))
+        self._observe_stage("decode_request", time.perf_counter() - start)
+
+    def _drop_cancelled(self, active: List[_Sequence]) -> List[_Sequence]:
+        cancelled = self.cancelled.uids
+        running = []
+        for sequence in active:
+            if sequence.uid in cancelled:
+                self._cancel(sequence.response_queue_id, sequence.uid)
+                self._release(sequence)
+            else:
+                running.append(sequence)
+        return running
 
-            for response_queue_id, uid in zip(response_queue_ids, uids):
-                response_queues[response_queue_id].put((uid, ("", BubbleAPIStatus.FINISH_STREAMING)))
+    def _release(self, sequence: _Sequence):
+        try:
+            self.bubble_api.release(sequence.state)
+        except Exception:
+            logger.exception(f"Error releasing the sequence of request {sequence.uid}.")
+
+    def _step_outputs(self, active: List[_Sequence], outputs: List[Any]) -> List[_Sequence]:
+        """Send the outputs of one step, and return the sequences that are not finished."""
+        api = self.bubble_api
+        running = []
+        for sequence, output in zip(active, outputs):
+            try:
+                # a sequence may have nothing to send after a step, e.g. while its prompt is processed
+                if output is not None:
+                    y_enc = api.format_encoded_response(_inject_context(sequence.context, api.encode_response, output))
+                    self._put(sequence.response_queue_id, sequence.uid, y_enc, BubbleAPIStatus.OK)
+                finished = api.is_finished(sequence.state)
+            except Exception as e:
+                logger.exception(f"Error encoding the output of request {sequence.uid}.")
+                self._send_error([sequence.response_queue_id], [sequence.uid], e)
+                finished = None
+            if finished is False:
+                running.append(sequence)
+                continue
+            if finished:
+                self._put(sequence.response_queue_id, sequence.uid, "", BubbleAPIStatus.FINISH_STREAMING)
+            self._release(sequence)
+        return running
+
+    async def _run_continuous(self):
+        loop = asyncio.get_running_loop()
+        active: List[_Sequence] = []
+        # sequences that already joined run to completion after `stop`
+        while active or not self._stopped.is_set():
+            if self._stopped.is_set():
+                payloads = []
+            elif not active:
+                _, timeout = self.batch_policy.next_batch()
+                payloads = await loop.run_in_executor(
+                    self._executor,
+                    collate_requests,
+                    self.request_queue,
+                    self.max_batch_size,
+                    timeout,
+                    IDLE_WAIT_TIMEOUT,
+                    self.metrics,
+                    self.steal_queues,
+                    self._on_steal,
+                )
+            elif len(active) < self.max_batch_size:
+                # take what has arrived since the last step without delaying the next one
+                payloads = collate_requests(
+                    self.request_queue, self.max_batch_size - len(active), 0, idle_timeout=0, metrics=self.metrics
+                )
+            else:
+                payloads = []
+            payloads = self._skip_cancelled(payloads)
+            if payloads:
+                self._join(payloads, active)
+            if self.cancelled is not None and self.cancelled.any_of(sequence.uid for sequence in active):
+                active = self._drop_cancelled(active)
+            if self.metrics:
+                self.metrics.set_gauge("active_sequences", len(active))
+                if active:
+                    self.metrics.observe("batch_size", len(active), buckets=self._batch_size_buckets)
+                self.metrics.maybe_publish()
+            if not active:
+                continue
+
+            stepping = active
+            if self.paused is not None and self.paused.any_of(sequence.uid for sequence in active):
+                # paused sequences keep their place in the batch but don't advance
+                paused = self.paused.uids
+                stepping = [sequence for sequence in active if sequence.uid not in paused]
+                if not stepping:
+                    await asyncio.sleep(self.paused.poll_interval)
+                    continue
+            try:
+                start = time.monotonic()
+                states = [sequence.state for sequence in stepping]
+                contexts = [sequence.context for sequence in stepping]
+                outputs = await _resolve(_inject_context(contexts, self.bubble_api.step, states))
+                self._observe_stage("step", time.monotonic() - start)
+            except Exception as e:
+                logger.exception("Error processing continuous batch step.")
+                self._send_error([s.response_queue_id for s in stepping], [s.uid for s in stepping], e)
+                for sequence in stepping:
+                    self._release(sequence)
+                running = []
+            else:
+                running = self._step_outputs(stepping, outputs)
+            if stepping is active:
+                active = running
+            else:
+                left = {id(sequence) for sequence in stepping} - {id(sequence) for sequence in running}
+                active = [sequence for sequence in active if id(sequence) not in left]
 
+    async def _process(self, batch: _Batch):
+        if self._skip_cancelled_batch(batch):
+            return
+        try:
+            if self.stream:
+                await self._stream(batch)
+                return
+            y = await self._predict(batch)
         except Exception as e:
-            logger.exception("Error processing streaming batched request.")
-            err_pkl = pickle.dumps(e)
-            for response_queue_id, uid in zip(response_queue_ids, uids):
-                response_queues[response_queue_id].put((uid, (err_pkl, BubbleAPIStatus.ERROR)))
+            logger.exception("Error processing batched request." if self.batched else "Error processing request.")
+            self._send_error(batch.response_queue_ids, batch.uids, e)
+            return
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._encode, batch, y)
+
+    async def _run_concurrent(self):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrent_batches)
+        in_flight = set()
+
+        def finished(task: asyncio.Task):
+            in_flight.discard(task)
+            slots.release()
+
+        while not self._stopped.is_set():
+            # only take requests off the queue when a batch slot is free, peers may steal them meanwhile
+            await slots.acquire()
+            batch, num_collected = await loop.run_in_executor(self._executor, self._collect)
+            if batch is None:
+                slots.release()
+            else:
+                task = loop.create_task(self._process(batch))
+                in_flight.add(task)
+                task.add_done_callback(finished)
+            if self.metrics:
+                self.metrics.set_gauge("batches_in_flight", len(in_flight))
+            self._observe_collection(num_collected, batch)
+        if in_flight:
+            await asyncio.wait(in_flight)
+
+    async def run(self):
+        self._shared_uids.start()
+        try:
+            if self.continuous:
+                await self._run_continuous()
+            elif self.concurrent_batches > 1:
+                await self._run_concurrent()
+            else:
+                await self._run_pipelined()
+        finally:
+            self._executor.shutdown()
+            self._shared_uids.stop()
+            if self.coalescer is not None:
+                self.coalescer.close()
+
+    async def _run_pipelined(self):
+        loop = asyncio.get_running_loop()
+        next_batch = loop.run_in_executor(self._executor, self._collect)
+        encoding = None
+        while next_batch is not None:
+            batch, num_collected = await next_batch
+            # decode batch N+1 while batch N is in predict, a batch collected before `stop` is still served
+            next_batch = None if self._stopped.is_set() else loop.run_in_executor(self._executor, self._collect)
+            self._observe_collection(num_collected, batch)
+            if batch is None or self._skip_cancelled_batch(batch):
+                continue
+
+            try:
+                if self.stream:
+                    await self._stream(batch)
+                    continue
+                y = await self._predict(batch)
+            except Exception as e:
+                logger.exception("Error processing batched request." if self.batched else "Error processing request.")
+                self._send_error(batch.response_queue_ids, batch.uids, e)
+                continue
+
+            # encode batch N while batch N+1 is in predict, keeping at most one batch in the encoder
+            if encoding is not None:
+                await encoding
+            encoding = loop.run_in_executor(self._executor, self._encode, batch, y)
+        if encoding is not None:
+            await encoding
+
 
 async def inference_worker(
     bubble_api: BubbleAPI,
     bubble_spec: Optional[BubbleSpec],
     device: str,
     worker_id: int,
-    request_queue: Queue,
+    request_queues: List[Queue],
     response_queues: List[Queue],
     max_batch_size: int,
     batch_timeout: float,
     stream: bool,
     workers_setup_status: Dict[str, bool] = None,
+    batch_policy: Optional[BatchPolicy] = None,
+    workers_metrics: Optional[Dict[int, dict]] = None,
+    payload_segments: Optional[PayloadSegments] = None,
+    coalesce: bool = False,
+    bucket_boundaries: Optional[Sequence[int]] = None,
+    continuous: bool = False,
+    stream_flush_bytes: Optional[int] = None,
+    stream_flush_interval: Optional[float] = None,
+    paused_streams: Optional[Mapping] = None,
+    concurrent_batches: int = 1,
+    shared_weights: Optional[SharedWeights] = None,
+    job_store: Optional[JobStore] = None,
+    cancelled_requests: Optional[Mapping] = None,
+    stop_event: Optional[threading.Event] = None,
 ):
+    start = time.monotonic()
+    if shared_weights is not None:
+        bubble_api.weights = shared_weights.attach()
     await bubble_api.setup(device)
     bubble_api.device = device
 
     print(f"Setup complete for worker {worker_id}.")
 
+    metrics = WorkerMetrics(worker_id, workers_metrics)
+    metrics.set_gauge("worker_setup_seconds", time.monotonic() - start)
+    metrics.set_gauge("worker_ready_timestamp_seconds", time.time())
+    metrics.maybe_publish(force=True)
     if workers_setup_status:
         workers_setup_status[worker_id] = True
 
     if bubble_spec:
         logging.info(f"bubble_motor will use {bubble_spec.__class__.__name__} spec")
 
-    if stream:
-        if max_batch_size > 1:
-            await run_batched_streaming_loop(bubble_api, bubble_spec, request_queue, response_queues, max_batch_size, batch_timeout)
-        else:
-            await run_streaming_loop(bubble_api, bubble_spec, request_queue, response_queues)
-    elif max_batch_size > 1:
-        await run_batched_loop(bubble_api, bubble_spec, request_queue, response_queues, max_batch_size, batch_timeout)
-    else:
-        await run_single_loop(bubble_api, bubble_spec, request_queue, response_queues)
+    engine = InferenceEngine(
+        bubble_api,
+        bubble_spec,
+        request_queues[worker_id],
+        response_queues,
+        max_batch_size,
+        batch_timeout,
+        stream,
+        batch_policy=batch_policy,
+        metrics=metrics,
+        payload_segments=payload_segments,
+        coalesce=coalesce,
+        steal_queues=steal_from(request_queues, worker_id),
+        bucket_boundaries=bucket_boundaries,
+        continuous=continuous,
+        stream_flush_bytes=stream_flush_bytes,
+        stream_flush_interval=stream_flush_interval,
+        paused_streams=paused_streams,
+        concurrent_batches=concurrent_batches,
+        job_store=job_store,
+        cancelled_requests=cancelled_requests,
+        worker_id=worker_id,
+        stop_event=stop_event,
+    )
+    await engine.run()
+
+class InferenceThread(threading.Thread):
+    """Runs `inference_worker(*args)` on its own event loop in a thread of the API server process."""
+
+    def __init__(self, *args):
+        super().__init__(name=f"bubble-worker-{args[3]}", daemon=True)
+        self._args = args
+        self._stopped = threading.Event()
+
+    def run(self):
+        asyncio.run(inference_worker(*self._args, stop_event=self._stopped))
+
+    def terminate(self):
+        """Stop the engine of the worker, the thread ends once its current batches are done."""
+        self._stopped.set()
@@ -0,0 +1,222 @@
+import sys
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, Hashable, Mapping, Optional, Sequence, Tuple
+
+METRIC_PREFIX = "bubble_"
+PUBLISH_INTERVAL = 1.0
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+# seconds over which a `RateMeter` counts events before it updates its rate
+RATE_WINDOW = 0.5
+
+
+def metric_key(name: str, labels: Optional[Mapping[str, str]] = None) -> Hashable:
+    """Key of one series in a snapshot: the bare name, or the name and its sorted labels."""
+    if not labels:
+        return name
+    return name, tuple(sorted(labels.items()))
+
+
+def _split_key(key: Hashable) -> Tuple[str, Tuple]:
+    if isinstance(key, tuple):
+        return key
+    return key, ()
+
+
+def size_buckets(max_size: int) -> Tuple[int, ...]:
+    """Powers of two up to and including `max_size`, for batch size histograms."""
+    buckets, size = [], 1
+    while size < max_size:
+        buckets.append(size)
+        size *= 2
+    buckets.append(max_size)
+    return tuple(buckets)
+
+
+def process_memory() -> Dict[str, float]:
+    """Resident and, on Linux, proportional set size of this process in bytes.
+
+    PSS divides shared pages between the processes mapping them, so unlike RSS it shows what
+    shared model weights save.
+    """
+    try:
+        memory = {}
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                if name in ("Rss", "Pss"):
+                    memory[f"process_{name.lower()}_bytes"] = int(value.split()[0]) * 1024
+        return memory
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return {}
+    # peak resident size, in bytes on macOS and KiB elsewhere
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"process_rss_bytes": rss if sys.platform == "darwin" else rss * 1024}
+
+
+class RateMeter:
+    """Events per second, counted over windows of at least `window` seconds and smoothed across them.
+
+    `restart` drops the current window, e.g. while the measured worker is idle, so that only busy
+    time is measured. `reset` also forgets the rate.
+    """
+
+    def __init__(self, window: float = RATE_WINDOW, smoothing: float = 0.1):
+        self.window = window
+        self.smoothing = smoothing
+        self.rate = 0.0
+        self._start = time.monotonic()
+        self._count = 0
+
+    def add(self, count: int = 1) -> bool:
+        """Count `count` events, returns whether the rate was updated."""
+        self._count += count
+        now = time.monotonic()
+        elapsed = now - self._start
+        if elapsed < self.window:
+            return False
+        rate = self._count / elapsed
+        self.rate = rate if not self.rate else self.rate + self.smoothing * (rate - self.rate)
+        self._start, self._count = now, 0
+        return True
+
+    def restart(self):
+        self._start, self._count = time.monotonic(), 0
+
+    def reset(self):
+        self.rate = 0.0
+        self.restart()
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # the last slot counts observations above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        return {"buckets": self.buckets, "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+
+class WorkerMetrics:
+    """Process-local metrics of one inference worker.
+
+    Values are only kept in the worker and copied into the shared `snapshots` dict at most every
+    `interval` seconds, so recording a metric never costs an IPC round-trip. Metrics may be recorded
+    from the engine's threads.
+    """
+
+    def __init__(self, worker_id: int, snapshots: Mapping = None, interval: float = PUBLISH_INTERVAL):
+        self.worker_id = worker_id
+        self.snapshots = snapshots
+        self.interval = interval
+        self.gauges: Dict[Hashable, float] = {}
+        self.counters: Dict[Hashable, float] = {}
+        self.histograms: Dict[Hashable, _Histogram] = {}
+        self._lock = threading.Lock()
+        self._published_at = 0.0
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Mapping[str, str]] = None):
+        self.gauges[metric_key(name, labels)] = value
+
+    def inc(self, name: str, value: float = 1, labels: Optional[Mapping[str, str]] = None):
+        key = metric_key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        labels: Optional[Mapping[str, str]] = None,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        key = metric_key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "gauges": dict(self.gauges),
+                "counters": dict(self.counters),
+                "histograms": {key: histogram.snapshot() for key, histogram in self.histograms.items()},
+            }
+
+    def maybe_publish(self, force: bool = False):
+        if self.snapshots is None:
+            return
+        now = time.monotonic()
+        if force or now - self._published_at >= self.interval:
+            self.gauges.update(process_memory())
+            self.snapshots[self.worker_id] = self.snapshot()
+            self._published_at = now
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(*labels: str) -> str:
+    labels = [label for label in labels if label]
+    return f"{{{','.join(labels)}}}" if labels else ""
+
+
+def render_prometheus(
+    worker_snapshots: Mapping,
+    server_snapshot: Optional[dict] = None,
+    api_server_snapshots: Optional[Mapping] = None,
+) -> str:
+    """Render the published worker snapshots, and the metrics of this API server or the published
+    ones of every API server process, in the Prometheus text exposition format."""
+    labeled = [(f'worker_id="{worker_id}"', snapshot) for worker_id, snapshot in sorted(dict(worker_snapshots).items())]
+    if server_snapshot:
+        labeled.append(("", server_snapshot))
+    if api_server_snapshots:
+        labeled += [(f'api_server="{i}"', snapshot) for i, snapshot in sorted(dict(api_server_snapshots).items())]
+
+    series: Dict[str, Dict[str, list]] = {}
+    for base_labels, snapshot in labeled:
+        for kind, type_name in (("gauges", "gauge"), ("counters", "counter"), ("histograms", "histogram")):
+            for key, value in snapshot.get(kind, {}).items():
+                name, labels = _split_key(key)
+                labels = ",".join(f'{k}="{v}"' for k, v in labels)
+                family = series.setdefault(METRIC_PREFIX + name, {"type": type_name, "samples": []})
+                samples = family["samples"]
+                if kind != "histograms":
+                    samples.append(("", _format_labels(base_labels, labels), value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(value["buckets"]) + ["+Inf"], value["counts"]):
+                    cumulative += count
+                    le = f'le="{bound if bound == "+Inf" else _format_value(bound)}"'
+                    samples.append(("_bucket", _format_labels(base_labels, labels, le), cumulative))
+                samples.append(("_sum", _format_labels(base_labels, labels), value["sum"]))
+                samples.append(("_count", _format_labels(base_labels, labels), value["count"]))
+
+    lines = []
+    for name, family in sorted(series.items()):
+        lines.append(f"# TYPE {name} {family['type']}")
+        for suffix, labels, value in family["samples"]:
+            lines.append(f"{name}{suffix}{labels} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
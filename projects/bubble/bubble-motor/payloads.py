@@ -0,0 +1,133 @@
+import glob
+import io
+import logging
+import mmap
+import os
+import pickle
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# payloads whose out-of-band buffers add up to less than this are sent through the queue as usual
+ZERO_COPY_THRESHOLD = 64 * 1024
+SEGMENT_PREFIX = "bubble-payload"
+
+
+def _shared_memory_dir() -> str:
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _tensor_from_numpy(array):
+    import torch
+
+    return torch.from_numpy(array)
+
+
+class _BufferPickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # torch tensors don't expose protocol 5 buffers, route CPU tensors through their numpy view
+        if type(obj).__module__.startswith("torch") and hasattr(obj, "__torch_function__"):
+            if obj.device.type == "cpu" and not obj.requires_grad:
+                return _tensor_from_numpy, (obj.numpy(),)
+        return NotImplemented
+
+
+class SharedPayload:
+    """Small handle that crosses the queue instead of an object with large buffers."""
+
+    __slots__ = ("path", "meta", "sizes")
+
+    def __init__(self, path: str, meta: bytes, sizes: List[int]):
+        self.path = path
+        self.meta = meta
+        self.sizes = sizes
+
+    def __getstate__(self):
+        return self.path, self.meta, self.sizes
+
+    def __setstate__(self, state):
+        self.path, self.meta, self.sizes = state
+
+
+class PayloadSegments:
+    """Moves large pickle protocol 5 buffers of one server's payloads into shared-memory segments.
+
+    `pack` writes the buffers of NumPy arrays (and CPU torch tensors) into a file on a tmpfs mount
+    and returns a `SharedPayload` handle. `unpack_payload` on the receiving side maps that file,
+    rebuilds the object on top of the mapping without copying and unlinks the file right away, so
+    the memory is released once the last array referencing it is gone. Segments of this server that
+    are never received (crashed worker, dropped request) are removed by `sweep` and `cleanup`.
+    """
+
+    def __init__(self, threshold: int = ZERO_COPY_THRESHOLD, directory: Optional[str] = None):
+        self.threshold = threshold
+        self.directory = directory or _shared_memory_dir()
+        self.token = uuid.uuid4().hex[:12]
+
+    def pack(self, obj: Any) -> Any:
+        buffers = []
+        meta = io.BytesIO()
+        _BufferPickler(meta, protocol=5, buffer_callback=buffers.append).dump(obj)
+        if not buffers:
+            return obj
+        raws = [buffer.raw() for buffer in buffers]
+        if sum(raw.nbytes for raw in raws) < self.threshold:
+            return obj
+
+        path = os.path.join(self.directory, f"{SEGMENT_PREFIX}-{self.token}-{uuid.uuid4().hex}")
+        with open(path, "wb") as f:
+            for raw in raws:
+                f.write(raw)
+        return SharedPayload(path, meta.getvalue(), [raw.nbytes for raw in raws])
+
+    def sweep(self, max_age: float) -> int:
+        """Remove segments of this server older than `max_age` seconds that nobody received."""
+        removed = 0
+        now = time.time()
+        for path in glob.glob(os.path.join(self.directory, f"{SEGMENT_PREFIX}-{self.token}-*")):
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.unlink(path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        if removed:
+            logger.warning(f"Removed {removed} unclaimed shared payload segments")
+        return removed
+
+    def cleanup(self):
+        self.sweep(max_age=-1)
+
+
+def unpack_payload(obj: Any) -> Any:
+    if not isinstance(obj, SharedPayload):
+        return obj
+    size = sum(obj.sizes)
+    fd = os.open(obj.path, os.O_RDWR)
+    try:
+        mapping = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+    if sys.platform != "win32":
+        os.unlink(obj.path)
+    view = memoryview(mapping)
+    buffers, offset = [], 0
+    for n in obj.sizes:
+        buffers.append(view[offset:offset + n])
+        offset += n
+    return pickle.loads(obj.meta, buffers=buffers)
+
+
+def discard_payload(obj: Any):
+    """Release the segment of a payload that will never be unpacked."""
+    if isinstance(obj, SharedPayload):
+        try:
+            os.unlink(obj.path)
+        except FileNotFoundError:
+            pass
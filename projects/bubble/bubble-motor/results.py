@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Any, Callable, Dict, List, MutableMapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESULT_TTL = 300.0
+DEFAULT_RESULT_MAX_ENTRIES = 10_000
+DEFAULT_RESULT_MAX_BYTES = 256 * 1024 * 1024
+# how often a subscriber polls the shared store for a result computed by another API server
+RESULT_POLL_INTERVAL = 0.05
+# a request submitted by another API server may reach the shared store this much later than its id
+SUBMIT_GRACE = 1.0
+
+PROCESSING = "processing"
+COMPLETED = "completed"
+ERROR = "error"
+NOT_FOUND = "not_found"
+
+
+def _nbytes(result: Optional[str]) -> int:
+    return len(result.encode()) if result is not None else 0
+
+
+class ResultStore:
+    """Results of the GraphQL `predict` mutation, readable from every API server.
+
+    A request is stored as `processing` when it is submitted and replaced by its result when it
+    completes. Entries are kept for `ttl` seconds after their last update, and the oldest are
+    dropped when the store holds more than `max_entries` entries or `max_bytes` of results. A result
+    larger than `max_bytes` is stored as an error.
+
+    `backend` is a plain dict for a single API server, and a dict of the transport when several API
+    server processes share it. Waiters of a request completed by this API server are woken at once,
+    the others poll the backend.
+    """
+
+    def __init__(
+        self,
+        ttl: Optional[float] = DEFAULT_RESULT_TTL,
+        max_entries: int = DEFAULT_RESULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_RESULT_MAX_BYTES,
+        poll_interval: float = RESULT_POLL_INTERVAL,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        # request_id -> (wall clock expiry, status, result)
+        self.backend: MutableMapping[str, Tuple[float, str, Optional[str]]] = {}
+        self.counters = {"graphql_results_stored_total": 0, "graphql_results_evicted_total": 0}
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+
+    async def _call(self, method: Callable, *args) -> Any:
+        if isinstance(self.backend, dict):
+            return method(*args)
+        # every access to a shared backend is an IPC round-trip
+        return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+
+    def _expiry(self) -> float:
+        return time.time() + self.ttl if self.ttl else float("inf")
+
+    async def submit_many(self, request_ids: List[str]):
+        entry = (self._expiry(), PROCESSING, None)
+        await self._call(self.backend.update, {request_id: entry for request_id in request_ids})
+
+    async def put(self, request_id: str, status: str, result: Optional[str]):
+        nbytes = _nbytes(result)
+        if nbytes > self.max_bytes:
+            status, result = ERROR, f"Result of {nbytes} bytes exceeds the {self.max_bytes} bytes of the store"
+        await self._call(self.backend.__setitem__, request_id, (self._expiry(), status, result))
+        self.counters["graphql_results_stored_total"] += 1
+        for waiter in self._waiters.pop(request_id, []):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def get(self, request_id: str) -> dict:
+        stored = await self._call(self.backend.get, request_id)
+        if stored is None or stored[0] < time.time():
+            return {"request_id": request_id, "status": NOT_FOUND, "result": None}
+        _, status, result = stored
+        return {"request_id": request_id, "status": status, "result": result}
+
+    async def wait(self, request_id: str) -> dict:
+        """The final result of `request_id`, or `not_found` if it is unknown or expired."""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.setdefault(request_id, []).append(waiter)
+        grace_until = loop.time() + SUBMIT_GRACE
+        try:
+            while True:
+                found = await self.get(request_id)
+                if found["status"] == NOT_FOUND and loop.time() < grace_until:
+                    found["status"] = PROCESSING
+                if found["status"] != PROCESSING:
+                    return found
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), self.poll_interval)
+                except asyncio.TimeoutError:
+                    continue
+        finally:
+            waiters = self._waiters.get(request_id)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[request_id]
+
+    def trim_backend(self):
+        """Drop expired entries and trim the store to its limits.
+
+        Blocking for a shared backend, since every access to it is an IPC round-trip.
+        """
+        now = time.time()
+        entries = sorted(self.backend.items(), key=lambda item: item[1][0])
+        sizes = [_nbytes(result) for _, (_, _, result) in entries]
+        total = sum(sizes)
+        for i, (request_id, (expires_at, _, _)) in enumerate(entries):
+            if expires_at >= now and len(entries) - i <= self.max_entries and total <= self.max_bytes:
+                break
+            self.backend.pop(request_id, None)
+            total -= sizes[i]
+            if expires_at >= now:
+                self.counters["graphql_results_evicted_total"] += 1
+
+    def metrics(self) -> dict:
+        return {"gauges": {"graphql_results_waiting": len(self._waiters)}, "counters": dict(self.counters)}
+
+
+class PredictionLoader:
+    """Coalesces the predictions requested by one GraphQL operation into a single enqueue.
+
+    `load` returns the request id of an input at once and keeps the input until the next turn of
+    the event loop, so the `predict` fields of a mutation, which GraphQL resolves one after
+    another, are handed to `enqueue` together with the inputs of `predictBatch` as one list of
+    `(request_id, input)` pairs.
+    """
+
+    def __init__(self, enqueue: Callable[[List[Tuple[str, Any]]], None]):
+        self.enqueue = enqueue
+        self._pending: List[Tuple[str, Any]] = []
+
+    def load(self, input_data: Any) -> str:
+        if not self._pending:
+            asyncio.get_running_loop().call_soon(self._flush)
+        request_id = str(uuid.uuid4())
+        self._pending.append((request_id, input_data))
+        return request_id
+
+    def load_many(self, inputs: List[Any]) -> List[str]:
+        return [self.load(input_data) for input_data in inputs]
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        self.enqueue(pending)
@@ -0,0 +1,269 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Mapping, Optional, Sequence
+
+from fastapi import HTTPException, Request
+
+from .metrics import RateMeter, metric_key
+from .payloads import discard_payload
+from .utils import BubbleAPIStatus
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HEADER = "X-Bubble-Priority"
+# lower values are served first, clients can only lower the priority of their own requests
+DEFAULT_PRIORITY = 0
+# batches a worker holds at once: one being collected, one in predict and one being encoded
+IN_FLIGHT_BATCHES_PER_WORKER = 3
+# batches per worker that may wait in the API servers before new requests are rejected with a 503
+PENDING_BATCHES_PER_WORKER = 16
+# in-flight requests without a final response after this many seconds are forgotten
+STALE_IN_FLIGHT_AFTER = 300.0
+
+
+def request_priority(request: Request, api_key_priorities: Optional[Mapping[str, int]] = None) -> int:
+    """Priority of a request from its API key and the optional `X-Bubble-Priority` header."""
+    priority = DEFAULT_PRIORITY
+    if api_key_priorities:
+        priority = api_key_priorities.get(request.headers.get("X-API-Key"), DEFAULT_PRIORITY)
+    header = request.headers.get(PRIORITY_HEADER)
+    if header is not None:
+        try:
+            priority = max(priority, int(header))
+        except ValueError:
+            raise HTTPException(400, f"{PRIORITY_HEADER} must be an integer")
+    return priority
+
+
+class RequestScheduler:
+    """Orders the requests of one API server process by priority, then earliest deadline first.
+
+    Only `max_in_flight` requests are handed to the request queue at a time, the others wait here so
+    that a later, more urgent request can still overtake them. The deadline of a request, its
+    enqueue timestamp plus `request_timeout`, bounds its wait until a worker takes it, not its
+    inference. A request is dropped with a 504 before it reaches a worker when its deadline has
+    passed, or when the requests already queued for the workers would, at the measured throughput,
+    keep it waiting past its deadline.
+
+    `admit` sheds new requests with a 503 when `max_pending` requests are already waiting, and with a
+    429 when the requests waiting ahead of them at the measured throughput would keep them waiting
+    for more than `slo` seconds. It defaults to `request_timeout`, the longest a request may wait
+    anyway.
+    """
+
+    def __init__(
+        self,
+        request_queue,
+        request_timeout: Optional[float],
+        max_in_flight: int,
+        stream: bool,
+        on_drop: Callable[[object, Exception], None],
+        on_complete: Optional[Callable[[object], None]] = None,
+        smoothing: float = 0.1,
+        stale_after: float = STALE_IN_FLIGHT_AFTER,
+        slo: Optional[float] = None,
+        max_pending: Optional[int] = None,
+    ):
+        self.request_queue = request_queue
+        self.request_timeout = None if request_timeout in (-1, False, None) else request_timeout
+        self.max_in_flight = max_in_flight
+        self.stream = stream
+        self.on_drop = on_drop
+        self.on_complete = on_complete
+        self.smoothing = smoothing
+        self.stale_after = stale_after
+        self.slo = slo if slo is not None else self.request_timeout
+        self.max_pending = max_pending
+        self.completions = RateMeter(smoothing=smoothing)
+        self.dropped = {"deadline": 0, "doomed": 0}
+        self.shed = {"slo": 0, "queue_full": 0}
+        self._pending_by_priority: Counter = Counter()
+        # [priority, deadline, seq, item, timer], item is None once the entry left the heap early
+        self._heap: List[list] = []
+        self._entries: Dict[object, list] = {}
+        self._in_flight: Dict[object, float] = {}
+        self._seq = itertools.count()
+
+    @property
+    def throughput(self) -> float:
+        return self.completions.rate
+
+    def estimated_wait(self, priority: int = DEFAULT_PRIORITY, count: int = 1) -> float:
+        """Seconds the last of `count` new requests of `priority` would wait before it is dispatched.
+
+        With nothing in flight the next request goes straight to a worker, whatever the last
+        measured throughput was.
+        """
+        if not self.throughput or not self._in_flight:
+            return 0.0
+        ahead = sum(pending for p, pending in self._pending_by_priority.items() if p <= priority)
+        return (ahead + count - 1) / self.throughput
+
+    def admit(self, priority: int = DEFAULT_PRIORITY, count: int = 1):
+        """Raise a 503 or 429 with Retry-After if `count` new requests of `priority` should be shed, all
+        of them or none."""
+        if self.max_pending is not None and len(self._entries) + count > self.max_pending:
+            self.shed["queue_full"] += 1
+            raise HTTPException(503, "Too many pending requests", headers={"Retry-After": "1"})
+        if self.slo is None:
+            return
+        wait = self.estimated_wait(priority, count)
+        if wait > self.slo:
+            self.shed["slo"] += 1
+            retry_after = max(1, math.ceil(wait - self.slo))
+            raise HTTPException(429, "Server overloaded", headers={"Retry-After": str(retry_after)})
+
+    def submit(self, item: tuple, priority: int = DEFAULT_PRIORITY):
+        """Queue `(response_queue_id, uid, timestamp, payload)`. Runs on the event loop."""
+        _, uid, timestamp, _ = item
+        deadline = timestamp + self.request_timeout if self.request_timeout else float("inf")
+        entry = [priority, deadline, next(self._seq), item, None]
+        if self.request_timeout:
+            loop = asyncio.get_running_loop()
+            entry[4] = loop.call_later(max(deadline - time.monotonic(), 0), self._expire, uid)
+        self._entries[uid] = entry
+        self._pending_by_priority[priority] += 1
+        heapq.heappush(self._heap, entry)
+        self._dispatch()
+
+    def submit_many(self, items: Sequence[tuple], priority: int = DEFAULT_PRIORITY):
+        """Queue requests that should share an inference batch. Runs on the event loop.
+
+        They are dispatched to one worker at once when they fit in the in-flight limit and no request
+        of the same or a higher priority is waiting, and queued one by one otherwise.
+        """
+        if len(self._in_flight) + len(items) > self.max_in_flight:
+            self._forget_stale()
+        waiting = any(count for p, count in self._pending_by_priority.items() if p <= priority)
+        if waiting or len(self._in_flight) + len(items) > self.max_in_flight:
+            for item in items:
+                self.submit(item, priority)
+            return
+        now = time.monotonic()
+        for item in items:
+            self._in_flight[item[1]] = now
+        self.request_queue.put_many(items)
+
+    def cancel(self, uid) -> bool:
+        """Remove a request that was not dispatched yet. Runs on the event loop."""
+        entry = self._entries.get(uid)
+        if entry is None:
+            return False
+        self._remove(entry)
+        return True
+
+    def _remove(self, entry: list):
+        _, uid, _, payload = entry[3]
+        entry[3] = None
+        if entry[4] is not None:
+            entry[4].cancel()
+        del self._entries[uid]
+        self._pending_by_priority[entry[0]] -= 1
+        discard_payload(payload)
+
+    def _drop(self, entry: list, reason: str):
+        uid = entry[3][1]
+        self._remove(entry)
+        self.dropped[reason] += 1
+        logger.error(f"Request {uid} timed out.")
+        self.on_drop(uid, HTTPException(504, "Request timed out"))
+
+    def _expire(self, uid):
+        entry = self._entries.get(uid)
+        if entry is not None:
+            self._drop(entry, "deadline")
+
+    def _forget_stale(self):
+        now = time.monotonic()
+        for uid in [uid for uid, started in self._in_flight.items() if now - started > self.stale_after]:
+            logger.warning(f"No response for request {uid} after {self.stale_after}s, releasing its slot")
+            del self._in_flight[uid]
+            if self.on_complete is not None:
+                self.on_complete(uid)
+
+    def _queued(self) -> int:
+        """Dispatched requests that no worker has taken yet."""
+        try:
+            return self.request_queue.qsize()
+        except NotImplementedError:
+            return 0
+
+    def _dispatch(self):
+        if len(self._in_flight) >= self.max_in_flight:
+            self._forget_stale()
+        queued = None
+        while self._heap and len(self._in_flight) < self.max_in_flight:
+            entry = heapq.heappop(self._heap)
+            if entry[3] is None:
+                continue
+            now = time.monotonic()
+            throughput = self.throughput
+            # at most every in-flight request is still queued, only count them when that could be too many
+            if throughput and now + len(self._in_flight) / throughput > entry[1]:
+                if queued is None:
+                    queued = self._queued()
+                if now + queued / throughput > entry[1]:
+                    self._drop(entry, "doomed")
+                    continue
+            item = entry[3]
+            if entry[4] is not None:
+                entry[4].cancel()
+            del self._entries[item[1]]
+            self._pending_by_priority[entry[0]] -= 1
+            self._in_flight[item[1]] = now
+            self.request_queue.put_nowait(item)
+            if queued is not None:
+                queued += 1
+
+    def _observe_throughput(self, completed: int):
+        if not self._entries:
+            # nobody is waiting, completions follow the arrival rate and not the capacity
+            self.completions.restart()
+            return
+        self.completions.add(completed)
+
+    def observe_responses(self, responses: List[tuple]):
+        """Release the slots of requests whose final response arrived. Runs on the event loop."""
+        released = 0
+        for uid, (_, status) in responses:
+            if self.stream and status in (BubbleAPIStatus.OK, BubbleAPIStatus.CHUNKS):
+                continue
+            if self._in_flight.pop(uid, None) is None:
+                continue
+            if self.on_complete is not None:
+                self.on_complete(uid)
+            released += 1
+        if released:
+            self._observe_throughput(released)
+            self._dispatch()
+
+    def release(self, uids):
+        """Free the slots of in-flight requests that ended without a final response. Runs on the event loop."""
+        released = False
+        for uid in uids:
+            if self._in_flight.pop(uid, None) is not None:
+                released = True
+        if released:
+            self._dispatch()
+
+    def metrics(self) -> dict:
+        return {
+            "gauges": {
+                "scheduler_pending": len(self._entries),
+                "scheduler_in_flight": len(self._in_flight),
+                "scheduler_throughput": self.throughput,
+                "scheduler_estimated_wait_seconds": self.estimated_wait(),
+            },
+            "counters": {
+                **{
+                    metric_key("requests_dropped_total", {"reason": reason}): count
+                    for reason, count in self.dropped.items()
+                },
+                **{metric_key("requests_shed_total", {"reason": reason}): count for reason, count in self.shed.items()},
+            },
+        }
@@ -1,34 +1,60 @@
 import asyncio
 import copy
 import inspect
+import math
 import logging
 import multiprocessing as mp
 import os
 import pickle
 import shutil
+import signal
+import socket
 import threading
 import time
 import uuid
 from collections import deque
-from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from queue import Empty, Queue
-from typing import Dict, List, Optional, Sequence, Tuple, Union
+from typing import Awaitable, Dict, List, Optional, Sequence, Union
 from pydantic import BaseModel
 import uvicorn
 from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Request, Response
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import APIKeyHeader
 from starlette.middleware.gzip import GZipMiddleware
-from ariadne import QueryType, MutationType, make_executable_schema
+from ariadne import QueryType, MutationType, SubscriptionType, make_executable_schema
 from ariadne.asgi import GraphQL
+from ariadne.asgi.handlers import GraphQLTransportWSHandler
+from graphql import GraphQLError
 import sys
 from .api import BubbleAPI
 from .auth import api_key_auth, no_auth
+from .batching import BatchPolicy, create_batch_policy
+from .cache import ResultCache, request_key
+from .cancellation import Cancellations
 from .connector import _Connector
+from .content import NegotiatedRoute, encode_body, negotiate
 from .example_openai_spec import OpenAISpec
+from .jobs import CANCELLED as JOB_CANCELLED, ERROR as JOB_ERROR, MAX_JOB_WAIT, QUEUED as JOB_QUEUED
+from .jobs import JobId, Jobs, JobStore
 from .bubble_base import BubbleSpec
+from .demux import ResponseDemultiplexer, awaiting_response, deliver
+from .dispatcher import Dispatcher, requeue
+from .loops import InferenceThread, inference_worker
+from .metrics import PUBLISH_INTERVAL, metric_key, render_prometheus
+from .payloads import PayloadSegments, SharedPayload, discard_payload
+from .results import COMPLETED, ERROR, PROCESSING, PredictionLoader, ResultStore
+from .scheduler import (
+    DEFAULT_PRIORITY,
+    IN_FLIGHT_BATCHES_PER_WORKER,
+    PENDING_BATCHES_PER_WORKER,
+    RequestScheduler,
+    request_priority,
+)
+from .streaming import DEFAULT_STREAM_BUFFER_SIZE, StreamBackpressure
+from .supervisor import RESTART_BACKOFF, WorkerExits, WorkerSupervisor
+from .transport import DEFAULT_RING_CAPACITY, ThreadTransport, Transport, create_transport
 from .utils import BubbleAPIStatus, MaxSizeMiddleware, load_and_raise
+from .weights import SharedWeights
 
 mp.allow_connection_pickling()
 
@@ -36,6 +62,28 @@ logger = logging.getLogger(__name__)
 
 BUBBLE_SERVER_API_KEY = os.environ.get("BUBBLE_SERVER_API_KEY")
 LONG_TIMEOUT = 100
+# unclaimed shared payload segments older than this are removed
+PAYLOAD_SEGMENT_TTL = 300
+# seconds between two sweeps of expired result cache entries
+RESULT_CACHE_SWEEP_INTERVAL = 30
+# seconds between two trims of the GraphQL result store
+GRAPHQL_RESULTS_SWEEP_INTERVAL = 5
+# seconds between two removals of expired jobs
+JOBS_SWEEP_INTERVAL = 60
+# final responses nobody picked up for this many seconds are removed from the response buffer
+RESPONSE_BUFFER_SWEEP_INTERVAL = 60
+
+
+def connection(request: Request) -> Request:
+    """The raw request, for endpoints whose `request` parameter is the decoded body."""
+    return request
+
+
+async def _disconnected(request: Request):
+    """Return when the client of `request` went away."""
+    # the body was read already, the next message tells that the client went away
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
 
 
 class PredictionRequest(BaseModel):
@@ -50,6 +98,11 @@ type_defs = """
 
     type Mutation {
         predict(input_data: String!): PredictionResult
+        predictBatch(inputs: [String!]!, wait: Boolean = false): [PredictionResult!]!
+    }
+
+    type Subscription {
+        result(request_id: String!): PredictionResult
     }
 
     type PredictionResult {
@@ -61,143 +114,62 @@ type_defs = """
 
 query = QueryType()
 mutation = MutationType()
+subscription = SubscriptionType()
 
 
 @query.field("get_result")
 async def resolve_get_result(_, info, request_id):
     server = info.context["request"].app.state.bubble_server
-    if request_id not in server.response_buffer:
+    result = await server.graphql_results.get(request_id)
+    if result["status"] == "not_found":
         logger.warning(f"GraphQL: Result request for unknown request ID: {request_id}")
-        return {"request_id": request_id, "status": "not_found", "result": None}
-    event = server.response_buffer[request_id]
+    return result
+
+
+def admit_predictions(info, count: int = 1):
+    """Admit the predictions of a GraphQL field, or fail it with the status and `retry_after` seconds
+    of the 503 or 429 in the error extensions."""
+    server = info.context["request"].app.state.bubble_server
     try:
-        await asyncio.wait_for(event.wait(), timeout=1.0)
-        result, status = server.response_buffer.pop(request_id)
-        if status == BubbleAPIStatus.ERROR:
-            return {"request_id": request_id, "status": "error", "result": str(result)}
-        logger.info(f"GraphQL: Result retrieved for request ID: {request_id}")
-        return {"request_id": request_id, "status": "completed", "result": str(result)}
-    except asyncio.TimeoutError:
-        logger.info(f"GraphQL: Result not ready for request ID: {request_id}")
-        return {"request_id": request_id, "status": "processing", "result": None}
+        server.scheduler.admit(info.context["priority"], count)
+    except HTTPException as e:
+        raise GraphQLError(
+            e.detail, extensions={"status": e.status_code, "retry_after": int(e.headers["Retry-After"])}
+        ) from e
 
 
 @mutation.field("predict")
 async def resolve_predict(_, info, input_data):
-    server = info.context["request"].app.state.bubble_server
-    request_id = str(uuid.uuid4())
-    event = asyncio.Event()
-    server.response_buffer[request_id] = event
-    server.request_queue.put((server.response_queue_id, request_id, asyncio.get_event_loop().time(), input_data))
+    admit_predictions(info)
+    request_id = info.context["predictions"].load(input_data)
     logger.info(f"GraphQL: Prediction request received. Request ID: {request_id}")
-    return {"request_id": request_id, "status": "processing", "result": None}
-
-
-# Create the executable schema
-schema = make_executable_schema(type_defs, query, mutation)
-
-
-def _inject_context(context: Union[List[dict], dict], func, *args, **kwargs):
-    sig = inspect.signature(func)
-    if "context" in sig.parameters:
-        return func(*args, **kwargs, context=context)
-    return func(*args, **kwargs)
+    return {"request_id": request_id, "status": PROCESSING, "result": None}
 
 
-def collate_requests(
-        bubble_api: BubbleAPI, request_queue: Queue, max_batch_size: int, batch_timeout: float
-) -> Tuple[List, List]:
-    payloads = []
-    timed_out_uids = []
-    entered_at = time.monotonic()
-    end_time = entered_at + batch_timeout
-    apply_timeout = bubble_api.request_timeout not in (-1, False)
-
-    while time.monotonic() < end_time and len(payloads) < max_batch_size:
-        remaining_time = end_time - time.monotonic()
-        if remaining_time <= 0:
-            break
-
-        try:
-            response_queue_id, uid, timestamp, x_enc = request_queue.get(timeout=min(remaining_time, 0.001))
-            if apply_timeout and time.monotonic() - timestamp > bubble_api.request_timeout:
-                timed_out_uids.append((response_queue_id, uid))
-            else:
-                payloads.append((response_queue_id, uid, x_enc))
-
-        except Empty:
-            continue
-
-    return payloads, timed_out_uids
-
-
-async def inference_worker(
-        bubble_api: BubbleAPI,
-        bubble_spec: Optional[BubbleSpec],
-        device: str,
-        worker_id: int,
-        request_queue: Queue,
-        response_queues: List[Queue],
-        max_batch_size: int,
-        batch_timeout: float,
-        stream: bool,
-        workers_setup_status: Dict[str, bool] = None,
-):
-    await bubble_api.setup(device)
-    bubble_api.device = device
-
-    print(f"Setup complete for worker {worker_id}.")
-
-    if workers_setup_status:
-        workers_setup_status[worker_id] = True
+@mutation.field("predictBatch")
+async def resolve_predict_batch(_, info, inputs, wait=False):
+    server = info.context["request"].app.state.bubble_server
+    admit_predictions(info, len(inputs))
+    request_ids = info.context["predictions"].load_many(inputs)
+    logger.info(f"GraphQL: Batch of {len(inputs)} prediction requests received")
+    if wait:
+        return await asyncio.gather(*[server.graphql_results.wait(request_id) for request_id in request_ids])
+    return [{"request_id": request_id, "status": PROCESSING, "result": None} for request_id in request_ids]
 
-    if bubble_spec:
-        logging.info(f"bubble_server will use {bubble_spec.__class__.__name__} spec")
 
-    while True:
-        batches, timed_out_uids = collate_requests(
-            bubble_api,
-            request_queue,
-            max_batch_size,
-            batch_timeout,
-        )
+@subscription.source("result")
+async def generate_result(_, info, request_id):
+    server = info.context["request"].app.state.bubble_server
+    yield await server.graphql_results.wait(request_id)
 
-        for response_queue_id, uid in timed_out_uids:
-            logger.error(f"Request {uid} timed out.")
-            response_queues[response_queue_id].put(
-                (uid, (HTTPException(504, "Request timed out"), BubbleAPIStatus.ERROR)))
 
-        if not batches:
-            await asyncio.sleep(0.01)
-            continue
+@subscription.field("result")
+def resolve_result(result, info, request_id):
+    return result
 
-        response_queue_ids, uids, inputs = zip(*batches)
-        try:
-            contexts = [{}] * len(inputs)
-            if hasattr(bubble_spec, "populate_context"):
-                for input, context in zip(inputs, contexts):
-                    bubble_spec.populate_context(context, input)
-
-            x = [
-                _inject_context(
-                    context,
-                    bubble_api.decode_request,
-                    input,
-                )
-                for input, context in zip(inputs, contexts)
-            ]
-            x = bubble_api.batch(x)
-            y = await _inject_context(contexts, bubble_api.predict, x)
-            outputs = bubble_api.unbatch(y)
-            for response_queue_id, y, uid, context in zip(response_queue_ids, outputs, uids, contexts):
-                y_enc = _inject_context(context, bubble_api.encode_response, y)
-                response_queues[response_queue_id].put((uid, (y_enc, BubbleAPIStatus.OK)))
 
-        except Exception as e:
-            logger.exception("Error processing batched request.")
-            err_pkl = pickle.dumps(e)
-            for response_queue_id, uid in zip(response_queue_ids, uids):
-                response_queues[response_queue_id].put((uid, (err_pkl, BubbleAPIStatus.ERROR)))
+# Create the executable schema
+schema = make_executable_schema(type_defs, query, mutation, subscription)
 
 
 class BubbleServer:
@@ -214,6 +186,28 @@ class BubbleServer:
             stream: bool = False,
             spec: Optional[BubbleSpec] = None,
             max_payload_size=None,
+            transport: Union[str, Transport] = "shm",
+            transport_capacity: int = DEFAULT_RING_CAPACITY,
+            batching: Union[str, BatchPolicy] = "fixed",
+            latency_slo: Optional[float] = None,
+            zero_copy: bool = False,
+            cache: Union[bool, ResultCache] = False,
+            graphql_results: Optional[ResultStore] = None,
+            jobs: Union[bool, str, JobStore] = False,
+            coalesce: bool = False,
+            bucket_boundaries: Optional[Sequence[int]] = None,
+            continuous_batching: bool = False,
+            stream_flush_bytes: Optional[int] = None,
+            stream_flush_interval: Optional[float] = None,
+            stream_buffer_size: Optional[int] = DEFAULT_STREAM_BUFFER_SIZE,
+            concurrent_batches: int = 1,
+            worker_mode: str = "process",
+            worker_start_method: str = "spawn",
+            max_request_retries: int = 1,
+            worker_restart_backoff: float = RESTART_BACKOFF,
+            api_key_priorities: Optional[Dict[str, int]] = None,
+            max_in_flight: Optional[int] = None,
+            max_pending: Optional[int] = None,
     ):
         if batch_timeout > timeout and timeout not in (False, -1):
             raise ValueError("batch_timeout must be less than timeout")
@@ -221,6 +215,25 @@ class BubbleServer:
             raise ValueError("max_batch_size must be greater than 0")
         if isinstance(spec, OpenAISpec):
             stream = True
+        if continuous_batching:
+            if spec is not None:
+                raise ValueError("continuous_batching can't be combined with a spec")
+            stream = True
+        if worker_mode not in ("process", "thread"):
+            raise ValueError("worker_mode must be one of 'process' or 'thread'")
+        if worker_start_method not in ("spawn", "forkserver"):
+            raise ValueError("worker_start_method must be one of 'spawn' or 'forkserver'")
+        if concurrent_batches < 1:
+            raise ValueError("concurrent_batches must be greater than 0")
+        if jobs and (stream or spec is not None):
+            raise ValueError("jobs can't be combined with streaming or a spec")
+        if jobs is True:
+            raise ValueError("jobs needs the path of its database, e.g. jobs='/var/lib/bubble/jobs.sqlite3', or a JobStore")
+        if concurrent_batches > 1:
+            if continuous_batching:
+                raise ValueError("concurrent_batches can't be combined with continuous_batching")
+            if not (inspect.iscoroutinefunction(bubble_api.predict) or inspect.isasyncgenfunction(bubble_api.predict)):
+                raise ValueError("concurrent_batches > 1 requires an `async def predict`, a blocking one would run batches one by one")
 
         if not api_path.startswith("/"):
             raise ValueError("api_path must start with '/'.")
@@ -228,8 +241,9 @@ class BubbleServer:
         self.api_path = api_path
         bubble_api.stream = stream
         bubble_api.request_timeout = timeout
-        bubble_api._sanitize(max_batch_size, spec=spec)
+        bubble_api._sanitize(max_batch_size, spec=spec, continuous=continuous_batching)
         self.app = FastAPI(lifespan=self.lifespan)
+        self.app.router.route_class = NegotiatedRoute
         self.app.state.bubble_server = self
         self.response_queue_id = None
         self.response_buffer = {}
@@ -242,7 +256,45 @@ class BubbleServer:
         self.workers_per_device = workers_per_device
         self.max_batch_size = max_batch_size
         self.batch_timeout = batch_timeout
+        self.batch_policy = create_batch_policy(batching, max_batch_size, batch_timeout, latency_slo)
         self.stream = stream
+        self.worker_mode = worker_mode
+        self.worker_start_method = worker_start_method
+        self.shared_weights = None
+        self.max_request_retries = max_request_retries
+        self.worker_restart_backoff = worker_restart_backoff
+        self.supervisor = None
+        self.worker_exits = None
+        self.recovered = {"retried": 0, "failed": 0}
+        self.num_api_servers = 1
+        self._workers_launched_at = {}
+        if worker_mode == "thread":
+            # workers share this process, requests and responses are passed by reference
+            self._transport = ThreadTransport()
+            self.payload_segments = None
+        else:
+            self._transport = create_transport(transport, transport_capacity)
+            self.payload_segments = PayloadSegments() if zero_copy else None
+        self.result_cache = ResultCache() if cache is True else cache or None
+        self.graphql_results = graphql_results or ResultStore()
+        self._graphql_tasks = set()
+        self.job_store = JobStore(jobs) if isinstance(jobs, str) else jobs or None
+        self.jobs = Jobs(self.job_store) if self.job_store else None
+        self._job_tasks = set()
+        self.coalesce = coalesce
+        self.bucket_boundaries = bucket_boundaries
+        self.continuous_batching = continuous_batching
+        self.stream_flush_bytes = stream_flush_bytes
+        self.stream_flush_interval = stream_flush_interval
+        self.stream_buffer_size = stream_buffer_size
+        self.stream_backpressure = None
+        self.cancellations = None
+        self.response_buffer_swept = 0
+        self.concurrent_batches = concurrent_batches
+        self.api_key_priorities = api_key_priorities
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.latency_slo = latency_slo
         self._connector = _Connector(accelerator=accelerator, devices=devices)
 
         specs = spec if spec is not None else []
@@ -283,38 +335,339 @@ class BubbleServer:
             raise RuntimeError("Response queues have not been initialized.")
 
         response_queue = self.response_queues[app.state.bubble_server.response_queue_id]
-        response_executor = ThreadPoolExecutor(max_workers=len(self.devices) * self.workers_per_device)
-        future = self.response_queue_to_buffer(response_queue, self.response_buffer, self.stream, response_executor)
-        task = loop.create_task(future)
+        demux = ResponseDemultiplexer(
+            response_queue,
+            self.response_buffer,
+            on_responses=self._observe_responses,
+            on_stolen=self.request_queue.reassign,
+        )
+        demux.start(loop)
+        sweeper = loop.create_task(self._sweep_payload_segments()) if self.payload_segments else None
+        cache_sweeper = loop.create_task(self._sweep_result_cache()) if self.result_cache else None
+        exits_watcher = loop.create_task(
+            self.worker_exits.watch(
+                self._recover_requests,
+                ready=lambda worker_id: self.workers_setup_status.get(worker_id, False),
+                on_ready=self.request_queue.restore,
+            )
+        )
+        metrics_publisher = loop.create_task(self._publish_server_metrics()) if self.num_api_servers > 1 else None
+        # a shared store is trimmed by the first API server only
+        results_sweeper = loop.create_task(self._sweep_graphql_results()) if self.response_queue_id == 0 else None
+        jobs_sweeper = loop.create_task(self._sweep_jobs()) if self.jobs and self.response_queue_id == 0 else None
+        buffer_sweeper = loop.create_task(self._sweep_response_buffer())
 
         yield
 
-        task.cancel()
-        logger.debug("Shutting down response queue to buffer task")
+        logger.debug("Shutting down response demultiplexer")
+        demux.stop()
+        exits_watcher.cancel()
+        buffer_sweeper.cancel()
+        if metrics_publisher:
+            metrics_publisher.cancel()
+        if sweeper:
+            sweeper.cancel()
+        if cache_sweeper:
+            cache_sweeper.cancel()
+        if results_sweeper:
+            results_sweeper.cancel()
+        if jobs_sweeper:
+            jobs_sweeper.cancel()
+
+    async def _publish_server_metrics(self):
+        while True:
+            await asyncio.sleep(PUBLISH_INTERVAL)
+            self.api_server_metrics[self.response_queue_id] = self._server_metrics()
+
+    async def _sweep_payload_segments(self):
+        while True:
+            await asyncio.sleep(PAYLOAD_SEGMENT_TTL / 5)
+            self.payload_segments.sweep(PAYLOAD_SEGMENT_TTL)
+
+    async def _sweep_result_cache(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(RESULT_CACHE_SWEEP_INTERVAL)
+            self.result_cache.sweep()
+            if self.result_cache.backend is not None:
+                await loop.run_in_executor(None, self.result_cache.trim_backend)
+
+    async def _sweep_graphql_results(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(GRAPHQL_RESULTS_SWEEP_INTERVAL)
+            if isinstance(self.graphql_results.backend, dict):
+                self.graphql_results.trim_backend()
+            else:
+                await loop.run_in_executor(None, self.graphql_results.trim_backend)
+
+    async def _sweep_response_buffer(self):
+        """Remove the final responses nobody picked up within a sweep interval, e.g. because their
+        handler was cancelled, and forget cancellations whose response never arrived."""
+        unclaimed = set()
+        while True:
+            await asyncio.sleep(RESPONSE_BUFFER_SWEEP_INTERVAL)
+            finished = {uid for uid, entry in self.response_buffer.items() if not awaiting_response(entry)}
+            for uid in finished & unclaimed:
+                logger.warning(f"Removing the unclaimed response of request {uid}")
+                self.response_buffer.pop(uid, None)
+                self.response_buffer_swept += 1
+            unclaimed = finished - unclaimed
+            self.cancellations.sweep()
+
+    async def _sweep_jobs(self):
+        while True:
+            await asyncio.sleep(JOBS_SWEEP_INTERVAL)
+            await self.jobs.sweep()
+
+    def _graphql_context(self, request, data) -> dict:
+        priority = request_priority(request, self.api_key_priorities)
+        return {
+            "request": request,
+            "priority": priority,
+            "predictions": PredictionLoader(lambda pending: self._enqueue_graphql_predictions(pending, priority)),
+        }
+
+    def _enqueue_graphql_predictions(self, pending: List[tuple], priority: int = DEFAULT_PRIORITY):
+        """Submit the predictions of a GraphQL operation, in chunks of `max_batch_size` that each go
+        to one worker so they share a batch. Runs on the event loop."""
+        submitted = asyncio.get_running_loop().create_task(
+            self.graphql_results.submit_many([request_id for request_id, _ in pending])
+        )
+        now = time.monotonic()
+        items = []
+        for request_id, input_data in pending:
+            event = asyncio.Event()
+            self.response_buffer[request_id] = event
+            self._store_graphql_result(request_id, event, submitted)
+            items.append((self.response_queue_id, request_id, now, input_data))
+        for i in range(0, len(items), self.max_batch_size):
+            self.scheduler.submit_many(items[i:i + self.max_batch_size], priority)
+
+    def _store_graphql_result(self, request_id: str, event: asyncio.Event, submitted: asyncio.Task):
+        """Store the result of a GraphQL prediction once it arrives, after its submission. Runs on
+        the event loop."""
+
+        async def store():
+            await submitted
+            await event.wait()
+            result, status = self.response_buffer.pop(request_id)
+            status = ERROR if status == BubbleAPIStatus.ERROR else COMPLETED
+            await self.graphql_results.put(request_id, status, str(result))
+
+        task = asyncio.get_running_loop().create_task(store())
+        self._graphql_tasks.add(task)
+        task.add_done_callback(self._graphql_tasks.discard)
+
+    def _observe_responses(self, responses: List[tuple]):
+        self.scheduler.observe_responses(responses)
+        self.cancellations.observe(responses)
+        if self.stream_backpressure is not None:
+            self.stream_backpressure.observe(self.response_buffer, responses)
+
+    def _server_metrics(self) -> dict:
+        server_metrics = self.scheduler.metrics()
+        components = [self.request_queue, self.graphql_results, self.cancellations] + [
+            component for component in (self.result_cache, self.jobs) if component
+        ]
+        if self.worker_exits is not None:
+            components.append(self.worker_exits)
+        if self.stream_backpressure is not None:
+            components.append(self.stream_backpressure)
+        for component in components:
+            component_metrics = component.metrics()
+            server_metrics["gauges"].update(component_metrics["gauges"])
+            server_metrics["counters"].update(component_metrics["counters"])
+        queues = [({"queue": "request", "worker_id": str(i)}, queue) for i, queue in enumerate(self.request_queues)]
+        queues += [
+            ({"queue": "response", "response_queue_id": str(i)}, queue) for i, queue in enumerate(self.response_queues)
+        ]
+        server_metrics["gauges"]["response_buffer_entries"] = len(self.response_buffer)
+        server_metrics["counters"]["response_buffer_swept_total"] = self.response_buffer_swept
+        for outcome, count in self.recovered.items():
+            server_metrics["counters"][metric_key("requests_recovered_total", {"outcome": outcome})] = count
+        for labels, queue in queues:
+            try:
+                server_metrics["gauges"][metric_key("queue_depth", labels)] = queue.qsize()
+            except NotImplementedError:
+                # multiprocessing queues don't implement qsize on macOS
+                continue
+        return server_metrics
+
+    def _workers_health(self) -> dict:
+        snapshots = dict(self.workers_metrics)
+        workers = {}
+        for worker_id, ready in sorted(dict(self.workers_setup_status).items()):
+            gauges = snapshots.get(worker_id, {}).get("gauges", {})
+            ready_at = gauges.get("worker_ready_timestamp_seconds")
+            launched_at = self._workers_launched_at.get(worker_id)
+            workers[str(worker_id)] = {
+                "ready": bool(ready),
+                "startup_seconds": ready_at - launched_at if ready_at and launched_at else None,
+                "setup_seconds": gauges.get("worker_setup_seconds"),
+                "rss_bytes": gauges.get("process_rss_bytes"),
+                "pss_bytes": gauges.get("process_pss_bytes"),
+            }
+        return workers
+
+    def _reject(self, uid, error: Exception):
+        deliver(self.response_buffer, [(uid, (pickle.dumps(error), BubbleAPIStatus.ERROR))])
+
+    def _cancel(self, uid):
+        """Cancel a request whose client went away. Runs on the event loop.
+
+        A request that was not dispatched yet is removed from the scheduler, otherwise its worker is
+        told to skip or stop it. Its handler is woken with a 499 error.
+        """
+        if not awaiting_response(self.response_buffer.get(uid)):
+            return
+        dispatched = not self.scheduler.cancel(uid)
+        self.cancellations.cancel(uid, dispatched)
+        logger.info(f"Cancelled request uid={uid}")
+        self._reject(uid, HTTPException(499, "Client closed the request"))
+
+    def _cancel_job(self, job_id: str):
+        """Stop a cancelled job, whichever API server submitted it. Runs on the event loop."""
+        if awaiting_response(self.response_buffer.get(job_id)):
+            self._cancel(job_id)
+        else:
+            # submitted through another API server, whose worker reads the shared cancellations
+            self.cancellations.cancel(job_id, dispatched=True)
+
+    def cancel_on_disconnect(self, request: Request, uids: List) -> asyncio.Task:
+        """Cancel `uids` when the client of `request` disconnects, until the returned task is cancelled.
+
+        Specs that submit requests to the scheduler themselves use it to release their workers when
+        the client goes away, like `/predict` does.
+        """
+
+        async def watch():
+            await _disconnected(request)
+            for uid in uids:
+                self._cancel(uid)
+
+        return asyncio.get_running_loop().create_task(watch())
+
+    async def _unless_disconnected(self, request: Request, awaitable: Awaitable):
+        """Await `awaitable`, or cancel it and fail with a 499 error if the client of `request` disconnects first."""
+        task = asyncio.ensure_future(awaitable)
+        watcher = asyncio.get_running_loop().create_task(_disconnected(request))
+        try:
+            done, _ = await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+            if not task.done():
+                task.cancel()
+        if task not in done:
+            raise HTTPException(499, "Client closed the request")
+        return task.result()
+
+    async def _infer(self, payload, priority: int, request: Optional[Request] = None):
+        self.scheduler.admit(priority)
+        response_queue_id = self.app.state.bubble_server.response_queue_id
+        uid = uuid.uuid4()
+        event = asyncio.Event()
+        self.response_buffer[uid] = event
+        logger.info(f"Received request uid={uid}")
+
+        if self.payload_segments:
+            payload = self.payload_segments.pack(payload)
+        self.scheduler.submit((response_queue_id, uid, time.monotonic(), payload), priority)
+
+        watcher = self.cancel_on_disconnect(request, [uid]) if request is not None else None
+        try:
+            await event.wait()
+        except asyncio.CancelledError:
+            self._cancel(uid)
+            self.response_buffer.pop(uid, None)
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+        response, status = self.response_buffer.pop(uid)
+
+        if status == BubbleAPIStatus.ERROR:
+            load_and_raise(response)
+        return response
+
+    async def _submit_job(self, payload, priority: int) -> str:
+        """Queue a request as a job and return its id, the result goes to the job store."""
+        self.scheduler.admit(priority)
+        uid = JobId(uuid.uuid4())
+        await self.jobs.submit(uid)
+        event = asyncio.Event()
+        self.response_buffer[uid] = event
+        logger.info(f"Received job {uid}")
+
+        if self.payload_segments:
+            payload = self.payload_segments.pack(payload)
+        self.scheduler.submit((self.response_queue_id, uid, time.monotonic(), payload), priority)
+        task = asyncio.get_running_loop().create_task(self._finish_job(uid, event))
+        self._job_tasks.add(task)
+        task.add_done_callback(self._job_tasks.discard)
+        return uid
+
+    async def _finish_job(self, uid: str, event: asyncio.Event):
+        await event.wait()
+        response, status = self.response_buffer.pop(uid)
+        if response is not None:
+            # rejected by this API server, or the worker could not write the job store
+            await self.jobs.finish(uid, status, response)
+        self.jobs.notify(uid)
 
     def device_identifiers(self, accelerator, device):
         if isinstance(device, Sequence):
             return [f"{accelerator}:{el}" for el in device]
         return [f"{accelerator}:{device}"]
 
-    async def data_streamer(self, q: deque, data_available: asyncio.Event, send_status: bool = False):
-        while True:
-            await data_available.wait()
-            while len(q) > 0:
-                data, status = q.popleft()
-                if status == BubbleAPIStatus.FINISH_STREAMING:
-                    return
+    async def data_streamer(self, q: deque, data_available: asyncio.Event, send_status: bool = False, uid=None):
+        """Yield the chunks of a stream as they arrive. Everything already buffered is taken at once and,
+        unless `send_status` is set, text or bytes chunks are joined into a single write.
 
-                if status == BubbleAPIStatus.ERROR:
-                    logger.error("Error occurred while streaming outputs from the inference worker.")
-                    if send_status:
-                        yield data, status
-                    return
-                if send_status:
-                    yield data, status
+        With `uid`, the stream is resumed on its worker whenever the client caught up, and its
+        buffer is removed from `response_buffer` when the stream ends. A stream closed before its
+        end, because its client went away, is cancelled.
+        """
+        finished = False
+        try:
+            while True:
+                await data_available.wait()
+                chunks, finished = [], False
+                while len(q) > 0:
+                    data, status = q.popleft()
+                    if status == BubbleAPIStatus.FINISH_STREAMING:
+                        finished = True
+                        break
+                    if status == BubbleAPIStatus.ERROR:
+                        logger.error("Error occurred while streaming outputs from the inference worker.")
+                        if send_status:
+                            chunks.append((data, status))
+                        finished = True
+                        break
+                    chunks.append((data, status) if send_status else data)
+                data_available.clear()
+                if uid is not None and self.stream_backpressure is not None:
+                    self.stream_backpressure.drained(uid)
+
+                if send_status or len(chunks) == 1:
+                    for chunk in chunks:
+                        yield chunk
+                elif all(isinstance(chunk, str) for chunk in chunks):
+                    yield "".join(chunks)
+                elif all(isinstance(chunk, bytes) for chunk in chunks):
+                    yield b"".join(chunks)
                 else:
-                    yield data
-            data_available.clear()
+                    for chunk in chunks:
+                        yield chunk
+                if finished:
+                    return
+        finally:
+            if uid is not None:
+                if not finished:
+                    self._cancel(uid)
+                self.response_buffer.pop(uid, None)
+                if self.stream_backpressure is not None:
+                    self.stream_backpressure.drained(uid)
 
     def setup_server(self):
         workers_ready = False
@@ -334,34 +687,56 @@ class BubbleServer:
 
             return Response(content="not ready", status_code=503)
 
-        # Use request_type and response_type directly to avoid the attribute error
-        async def predict(request: self.request_type,
-                          background_tasks: BackgroundTasks) -> self.response_type:
-            response_queue_id = self.app.state.bubble_server.response_queue_id
-            uid = uuid.uuid4()
-            event = asyncio.Event()
-            self.response_buffer[uid] = event
-            logger.info(f"Received request uid={uid}")
+        @self.app.get("/health/workers", dependencies=[Depends(self.setup_auth())])
+        async def health_workers(request: Request) -> Response:
+            workers = self._workers_health()
+            status_code = 200 if all(worker["ready"] for worker in workers.values()) else 503
+            return JSONResponse(content={"workers": workers}, status_code=status_code)
 
-            payload = request
-            if self.request_type == Request:
-                if request.headers["Content-Type"] == "application/x-www-form-urlencoded" or request.headers[
-                    "Content-Type"].startswith("multipart/form-data"):
-                    payload = await request.form()
-                else:
-                    payload = await request.json()
+        @self.app.get("/metrics", dependencies=[Depends(self.setup_auth())])
+        async def metrics(request: Request) -> Response:
+            if self.num_api_servers > 1:
+                content = render_prometheus(self.workers_metrics, api_server_snapshots=self.api_server_metrics)
+            else:
+                content = render_prometheus(self.workers_metrics, self._server_metrics())
+            return Response(content=content, media_type="text/plain; version=0.0.4")
 
-            self.request_queue.put_nowait((response_queue_id, uid, time.monotonic(), payload))
+        async def resolve_priority(request: Request) -> int:
+            return request_priority(request, self.api_key_priorities)
 
-            await event.wait()
-            response, status = self.response_buffer.pop(uid)
+        async def read_payload(request):
+            if self.request_type != Request:
+                return request
+            if request.headers["Content-Type"] == "application/x-www-form-urlencoded" or request.headers[
+                "Content-Type"].startswith("multipart/form-data"):
+                return await request.form()
+            # msgpack, npy and raw bytes bodies are already decoded by NegotiatedRoute
+            return await request.json()
 
-            if status == BubbleAPIStatus.ERROR:
-                load_and_raise(response)
+        # Use request_type and response_type directly to avoid the attribute error
+        async def predict(request: self.request_type,
+                          background_tasks: BackgroundTasks,
+                          priority: int = Depends(resolve_priority),
+                          http_request: Request = Depends(connection)) -> self.response_type:
+            accept = negotiate(request.headers.get("Accept")) if self.request_type == Request else None
+            payload = await read_payload(request)
+
+            cache_key = request_key(payload, self.bubble_api.model_version) if self.result_cache else None
+            if cache_key:
+                # the shared request is only cancelled once every client waiting for it went away
+                response = await self._unless_disconnected(
+                    http_request, self.result_cache.get_or_compute(cache_key, lambda: self._infer(payload, priority))
+                )
+            else:
+                response = await self._infer(payload, priority, http_request)
+            if accept:
+                return Response(content=encode_body(accept, response), media_type=accept)
             return response
 
         async def stream_predict(request: self.request_type,
-                                 background_tasks: BackgroundTasks) -> self.response_type:
+                                 background_tasks: BackgroundTasks,
+                                 priority: int = Depends(resolve_priority)) -> self.response_type:
+            self.scheduler.admit(priority)
             response_queue_id = self.app.state.bubble_server.response_queue_id
             uid = uuid.uuid4()
             event = asyncio.Event()
@@ -372,9 +747,11 @@ class BubbleServer:
             payload = request
             if self.request_type == Request:
                 payload = await request.json()
-            self.request_queue.put((response_queue_id, uid, time.monotonic(), payload))
+            if self.payload_segments:
+                payload = self.payload_segments.pack(payload)
+            self.scheduler.submit((response_queue_id, uid, time.monotonic(), payload), priority)
 
-            return StreamingResponse(self.data_streamer(q, data_available=event))
+            return StreamingResponse(self.data_streamer(q, data_available=event, uid=uid))
 
         if not self._specs:
             stream = self.bubble_api.stream
@@ -387,6 +764,9 @@ class BubbleServer:
                 dependencies=[Depends(self.setup_auth())]
             )
 
+        if self.jobs:
+            self.setup_jobs(read_payload, resolve_priority)
+
         for spec in self._specs:
             spec: BubbleSpec
             for path, endpoint, methods in spec.endpoints:
@@ -395,52 +775,195 @@ class BubbleServer:
                 )
 
         # Setup GraphQL using Ariadne
-        self.app.add_route("/graphql", GraphQL(schema=schema), methods=["GET", "POST"])
+        graphql = GraphQL(
+            schema=schema, context_value=self._graphql_context, websocket_handler=GraphQLTransportWSHandler()
+        )
+        self.app.add_route("/graphql", graphql, methods=["GET", "POST"])
+        self.app.router.add_websocket_route("/graphql", graphql)
+
+    def setup_jobs(self, read_payload, resolve_priority):
+        """Endpoints to submit a prediction as a job and to follow, fetch or cancel it."""
+        auth = [Depends(self.setup_auth())]
+
+        async def find_job(job_id: str, wait: float) -> dict:
+            if wait > 0:
+                job = await self.jobs.wait(job_id, min(wait, MAX_JOB_WAIT))
+            else:
+                job = await self.jobs.get(job_id)
+            if job is None:
+                raise HTTPException(404, f"Job {job_id} not found")
+            return job
+
+        async def submit_job(request: self.request_type, priority: int = Depends(resolve_priority)) -> JSONResponse:
+            job_id = await self._submit_job(await read_payload(request), priority)
+            return JSONResponse(
+                content={"job_id": job_id, "status": JOB_QUEUED}, status_code=202, headers={"Location": f"/jobs/{job_id}"}
+            )
+
+        self.app.add_api_route("/jobs", submit_job, methods=["POST"], dependencies=auth)
+
+        @self.app.get("/jobs/{job_id}", dependencies=auth)
+        async def job_status(job_id: str, wait: float = 0) -> dict:
+            return await find_job(job_id, wait)
+
+        @self.app.get("/jobs/{job_id}/result", dependencies=auth)
+        async def job_result(job_id: str, request: Request, wait: float = 0):
+            job = await find_job(job_id, wait)
+            if job["status"] == JOB_QUEUED:
+                return JSONResponse(content=job, status_code=202, headers={"Retry-After": "1"})
+            if job["status"] == JOB_CANCELLED:
+                raise HTTPException(410, f"Job {job_id} was cancelled")
+            result = await self.jobs.result(job_id)
+            if job["status"] == JOB_ERROR:
+                try:
+                    load_and_raise(result)
+                except HTTPException:
+                    raise
+                except Exception as e:
+                    raise HTTPException(500, f"Job {job_id} failed") from e
+            response = pickle.loads(result)
+            accept = negotiate(request.headers.get("Accept"))
+            if accept:
+                return Response(content=encode_body(accept, response), media_type=accept)
+            return response
+
+        @self.app.get("/jobs/{job_id}/events", dependencies=auth)
+        async def job_events(job_id: str) -> StreamingResponse:
+            return StreamingResponse(
+                self.jobs.events(job_id), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+            )
+
+        @self.app.delete("/jobs/{job_id}", dependencies=auth)
+        async def cancel_job(job_id: str) -> dict:
+            job = await self.jobs.cancel(job_id)
+            if job is None:
+                raise HTTPException(404, f"Job {job_id} not found")
+            if job["status"] == JOB_CANCELLED:
+                self._cancel_job(job_id)
+            return job
 
     async def launch_inference_worker(self, num_uvicorn_servers: int):
-        manager = mp.Manager()
-        self.workers_setup_status = manager.dict()
-        self.request_queue = manager.Queue()
+        transport = self._transport
+        self.workers_setup_status = transport.dict()
+        self.workers_metrics = transport.dict()
+        self.api_server_metrics = transport.dict()
+        self.worker_exits = WorkerExits(transport.dict())
+        self._workers_launched_at = transport.dict()
+        self.request_queues = [transport.queue() for _ in self.workers]
+        self.request_queue = Dispatcher(self.request_queues)
+        self.scheduler = RequestScheduler(
+            self.request_queue,
+            self.bubble_api.request_timeout,
+            self.max_in_flight
+            or len(self.workers) * self.max_batch_size * (IN_FLIGHT_BATCHES_PER_WORKER + self.concurrent_batches - 1),
+            self.stream,
+            on_drop=self._reject,
+            on_complete=self.request_queue.complete,
+            slo=self.latency_slo,
+            max_pending=self.max_pending or len(self.workers) * self.max_batch_size * PENDING_BATCHES_PER_WORKER,
+        )
+        if self.result_cache and self.result_cache.shared:
+            self.result_cache.backend = transport.dict()
+        if num_uvicorn_servers > 1:
+            self.graphql_results.backend = transport.dict()
+        if self.stream and self.stream_buffer_size:
+            self.stream_backpressure = StreamBackpressure(transport.dict(), self.stream_buffer_size)
+        self.cancellations = Cancellations(transport.dict(), self.stream)
 
         self.response_queues = []
         for _ in range(num_uvicorn_servers):
-            response_queue = manager.Queue()
+            response_queue = transport.response_queue()
             self.response_queues.append(response_queue)
 
         for spec in self._specs:
             server_copy = copy.copy(self)
             del server_copy.app
+            del server_copy._transport
             try:
-                await spec.setup(server_copy)
+                setup = spec.setup(server_copy)
+                if inspect.isawaitable(setup):
+                    await setup
             except Exception as e:
                 raise e
 
-        process_list = []
-        for worker_id, device in enumerate(self.devices * self.workers_per_device):
-            if len(device) == 1:
-                device = device[0]
-
-            self.workers_setup_status[worker_id] = False
-
-            ctx = mp.get_context("spawn")
-            process = ctx.Process(
-                target=self.inference_worker_process,
-                args=(
-                    self.bubble_api,
-                    self.bubble_spec,
-                    device,
-                    worker_id,
-                    self.request_queue,
-                    self.response_queues,
-                    self.max_batch_size,
-                    self.batch_timeout,
-                    self.stream,
-                    self.workers_setup_status,
-                ),
-            )
-            process.start()
-            process_list.append(process)
-        return manager, process_list
+        if type(self.bubble_api).load_weights is not BubbleAPI.load_weights:
+            weights = self.bubble_api.load_weights()
+            if weights is not None:
+                self.shared_weights = SharedWeights.create(weights)
+
+        ctx = mp.get_context(self.worker_start_method)
+        if self.worker_start_method == "forkserver":
+            # import the API's module, and the heavy libraries it imports, once in the fork server
+            # instead of in every worker
+            module = type(self.bubble_api).__module__
+            ctx.set_forkserver_preload([__name__] + ([module] if module != "__main__" else []))
+
+        self._worker_context = ctx
+        self._worker_devices = [
+            device[0] if len(device) == 1 else device for device in self.devices * self.workers_per_device
+        ]
+        process_list = [self._spawn_worker(worker_id) for worker_id in range(len(self._worker_devices))]
+        return transport, process_list
+
+    def _spawn_worker(self, worker_id: int):
+        self.workers_setup_status[worker_id] = False
+        bubble_api, bubble_spec, batch_policy = self.bubble_api, self.bubble_spec, self.batch_policy
+        if self.worker_mode == "thread":
+            # like a spawned process, every thread worker gets its own API, spec and batch policy
+            bubble_api, bubble_spec, batch_policy = copy.deepcopy((bubble_api, bubble_spec, batch_policy))
+        args = (
+            bubble_api,
+            bubble_spec,
+            self._worker_devices[worker_id],
+            worker_id,
+            self.request_queues,
+            self.response_queues,
+            self.max_batch_size,
+            self.batch_timeout,
+            self.stream,
+            self.workers_setup_status,
+            batch_policy,
+            self.workers_metrics,
+            self.payload_segments,
+            self.coalesce,
+            self.bucket_boundaries,
+            self.continuous_batching,
+            self.stream_flush_bytes,
+            self.stream_flush_interval,
+            self.stream_backpressure.shared if self.stream_backpressure else None,
+            self.concurrent_batches,
+            self.shared_weights,
+            self.job_store,
+            self.cancellations.shared,
+        )
+        if self.worker_mode == "thread":
+            process = InferenceThread(*args)
+        else:
+            process = self._worker_context.Process(target=self.inference_worker_process, args=args)
+        self._workers_launched_at[worker_id] = time.time()
+        process.start()
+        return process
+
+    def _worker_exited(self, worker_id: int):
+        """Move the requests queued for a worker that exited to its peers, and tell every API server."""
+        self.workers_setup_status[worker_id] = False
+        self.worker_exits.publish(worker_id, requeue(self.request_queues, worker_id))
+
+    def _recover_requests(self, worker_id: int, requeued: set):
+        """Retry or fail the requests this API server had sent to a worker that exited. Runs on the event loop."""
+        failed = []
+        for item in self.request_queue.evict(worker_id, requeued):
+            _, uid, _, payload = item
+            # a stream may have sent part of its output, and a zero-copy payload was consumed by the worker
+            retryable = uid in self.response_buffer and not self.stream and not isinstance(payload, SharedPayload)
+            if retryable and self.request_queue.retry(item, self.max_request_retries):
+                self.recovered["retried"] += 1
+                continue
+            discard_payload(payload)
+            self._reject(uid, HTTPException(503, "Inference worker exited, please retry"))
+            failed.append(uid)
+            self.recovered["failed"] += 1
+        self.scheduler.release(failed)
 
     @staticmethod
     def inference_worker_process(*args, **kwargs):
@@ -483,35 +1006,117 @@ class BubbleServer:
         if num_api_servers is None:
             num_api_servers = len(self.workers)
 
-        manager, bubble_server_workers = await self.launch_inference_worker(num_api_servers)
-
-        if sys.platform == "win32":
+        if sys.platform == "win32" or self.worker_mode == "thread":
             api_server_worker_type = "thread"
         elif api_server_worker_type is None:
             api_server_worker_type = "process"
-
+        if api_server_worker_type == "process" and not hasattr(socket, "SO_REUSEPORT"):
+            logger.warning("SO_REUSEPORT is not supported on this platform, running the API server in this process")
+            api_server_worker_type = "thread"
+        if api_server_worker_type == "thread" and num_api_servers > 1:
+            logger.warning(f"Running 1 API server in this process instead of {num_api_servers}")
+            num_api_servers = 1
+        self.num_api_servers = num_api_servers
+        host = kwargs.pop("host", "0.0.0.0")
+
+        if self.job_store is not None:
+            failed = self.job_store.fail_unfinished()
+            if failed:
+                logger.warning(f"Failed {failed} jobs left unfinished by a previous run of the server")
+        transport, bubble_server_workers = await self.launch_inference_worker(num_api_servers)
+        self.supervisor = WorkerSupervisor(
+            bubble_server_workers,
+            self._spawn_worker,
+            self._worker_exited,
+            ready=lambda worker_id: self.workers_setup_status.get(worker_id, False),
+            backoff=self.worker_restart_backoff,
+        )
+        self.supervisor.start()
+        api_servers, api_supervisor = [], None
+        previous_sigterm = None
         try:
-            servers = await self._start_server(port, num_api_servers, log_level, api_server_worker_type, **kwargs)
-            await asyncio.gather(*[s.serve() for s in servers])
+            if num_api_servers == 1:
+                self.response_queue_id = 0
+                if self.bubble_spec:
+                    self.bubble_spec.response_queue_id = 0
+                config = uvicorn.Config(app=self.app, host=host, port=port, log_level=log_level, **kwargs)
+                server = uvicorn.Server(config=config)
+                in_main_thread = threading.current_thread() is threading.main_thread()
+                if in_main_thread and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+                    # uvicorn raises the signal again after its graceful shutdown, which would exit before
+                    # the workers below are stopped, shut down instead and return normally
+                    def stop_serving(signum, frame):
+                        server.should_exit = True
+
+                    previous_sigterm = signal.signal(signal.SIGTERM, stop_serving)
+                await server.serve()
+            else:
+                def fork_api_server(response_queue_id: int):
+                    return self._fork_api_server(response_queue_id, host, port, log_level, kwargs)
+
+                api_servers = [fork_api_server(i) for i in range(num_api_servers)]
+                api_supervisor = WorkerSupervisor(
+                    api_servers, fork_api_server, name="API server", backoff=self.worker_restart_backoff
+                )
+                api_supervisor.start()
+                stopped = asyncio.Event()
+                loop = asyncio.get_running_loop()
+                for signum in (signal.SIGINT, signal.SIGTERM):
+                    loop.add_signal_handler(signum, stopped.set)
+                await stopped.wait()
         finally:
             print("Shutting down bubble_server")
+            self.supervisor.stop()
+            if api_supervisor is not None:
+                api_supervisor.stop()
+            for api_server in api_servers:
+                api_server.terminate()
+            for api_server in api_servers:
+                api_server.join()
             for w in bubble_server_workers:
                 w.terminate()
                 w.join()
-            manager.shutdown()
-
-    async def _start_server(self, port, num_uvicorn_servers, log_level, uvicorn_worker_type, **kwargs):
-        servers = []
-        for response_queue_id in range(num_uvicorn_servers):
-            self.app.state.bubble_server.response_queue_id = response_queue_id
-            if self.bubble_spec:
-                self.bubble_spec.response_queue_id = response_queue_id
-            app = copy.copy(self.app)
-
-            config = uvicorn.Config(app=app, host="0.0.0.0", port=port, log_level=log_level, **kwargs)
-            server = uvicorn.Server(config=config)
-            servers.append(server)
-        return servers
+            transport.shutdown()
+            if self.payload_segments:
+                self.payload_segments.cleanup()
+            if self.shared_weights is not None:
+                self.shared_weights.close()
+            if self.job_store is not None:
+                self.job_store.cleanup()
+            if previous_sigterm is not None:
+                signal.signal(signal.SIGTERM, previous_sigterm)
+
+    def _fork_api_server(self, response_queue_id: int, host: str, port: int, log_level: str, kwargs: dict):
+        process = mp.get_context("fork").Process(
+            target=self._serve_api_server,
+            args=(response_queue_id, host, port, log_level, kwargs),
+            name=f"bubble-api-server-{response_queue_id}",
+        )
+        process.start()
+        return process
+
+    def _serve_api_server(self, response_queue_id: int, host: str, port: int, log_level: str, kwargs: dict):
+        """Run one API server in a process forked from `run`, with its own response queue, request
+        scheduler and dispatcher. The kernel spreads the connections over the processes that bind
+        `port` with SO_REUSEPORT."""
+        # the forked event loop of `run` still owns the signal wakeup fd
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.response_queue_id = response_queue_id
+        if self.bubble_spec:
+            self.bubble_spec.response_queue_id = response_queue_id
+        self.supervisor = None
+        # the in-flight and pending limits are shared by all API servers
+        self.scheduler.max_in_flight = max(1, math.ceil(self.scheduler.max_in_flight / self.num_api_servers))
+        self.scheduler.max_pending = max(1, math.ceil(self.scheduler.max_pending / self.num_api_servers))
+
+        sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        config = uvicorn.Config(app=self.app, log_level=log_level, **kwargs)
+        asyncio.run(uvicorn.Server(config=config).serve(sockets=[sock]))
 
     def setup_auth(self):
         if hasattr(self.bubble_api, "authorize") and callable(self.bubble_api.authorize):
@@ -520,31 +1125,6 @@ class BubbleServer:
             return api_key_auth
         return no_auth
 
-    async def response_queue_to_buffer(
-            self,
-            response_queue: mp.Queue,
-            response_buffer: Dict[str, Union[Tuple[deque, asyncio.Event], asyncio.Event]],
-            stream: bool,
-            threadpool: ThreadPoolExecutor,
-    ):
-        loop = asyncio.get_running_loop()
-        if stream:
-            while True:
-                try:
-                    uid, response = await loop.run_in_executor(threadpool, response_queue.get)
-                except Empty:
-                    await asyncio.sleep(0.0001)
-                    continue
-                stream_response_buffer, event = response_buffer[uid]
-                stream_response_buffer.append(response)
-                event.set()
-        else:
-            while True:
-                uid, response = await loop.run_in_executor(threadpool, response_queue.get)
-                event = response_buffer.pop(uid)
-                response_buffer[uid] = response
-                event.set()
-
 
 if __name__ == "__main__":
     class MyBubbleAPI(BubbleAPI):
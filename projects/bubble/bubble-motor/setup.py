@@ -13,6 +13,9 @@ setup(
         "requests>=2.26.0",
         "typing-extensions>=4.0.0",
     ],
+    extras_require={
+        "msgpack": ["msgpack>=1.0.0"],
+    },
     author="Your Name",
     author_email="your.email@example.com",
     description="A scalable API serving framework",
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Set
+
+from .transport import SharedDictWriter, SharedUids
+
+logger = logging.getLogger(__name__)
+
+# longest a chunk waits in the worker for more chunks of the same stream when only a byte limit is set
+STREAM_FLUSH_INTERVAL = 0.005
+# chunks buffered in the API server for one stream before its worker is asked to pause it
+DEFAULT_STREAM_BUFFER_SIZE = 1024
+# how often a worker reads the set of paused streams
+PAUSE_POLL_INTERVAL = 0.01
+# a batch stops waiting for a paused stream after this many seconds, so one stuck client can't hold it forever
+STREAM_MAX_PAUSE = 30.0
+
+
+def _chunk_size(chunk: Any) -> int:
+    return len(chunk) if isinstance(chunk, (str, bytes)) else 1
+
+
+class ChunkCoalescer:
+    """Buffers the stream chunks of a worker per request and sends them as one message.
+
+    A request's chunks are flushed once they add up to `max_bytes`, or `interval` seconds after the
+    first of them was buffered, and always before the stream's final message. A single buffered
+    chunk is sent as is, several as a `BubbleAPIStatus.CHUNKS` list. `close` flushes what is left and
+    stops the flush thread.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[int, Any, List[Any]], None],
+        max_bytes: Optional[int] = None,
+        interval: Optional[float] = None,
+    ):
+        self.send = send
+        self.max_bytes = max_bytes
+        self.interval = interval if interval is not None else STREAM_FLUSH_INTERVAL
+        # uid -> [response_queue_id, first buffered at, size, chunks]
+        self._buffers: Dict[Any, list] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._flush_expired, name="bubble-chunk-flush", daemon=True)
+        self._thread.start()
+
+    def add(self, response_queue_id: int, uid, chunk: Any):
+        with self._lock:
+            buffer = self._buffers.get(uid)
+            if buffer is None:
+                buffer = self._buffers[uid] = [response_queue_id, time.monotonic(), 0, []]
+            buffer[2] += _chunk_size(chunk)
+            buffer[3].append(chunk)
+            if self.max_bytes is not None and buffer[2] >= self.max_bytes:
+                self._flush_locked(uid)
+
+    def flush(self, uid):
+        with self._lock:
+            self._flush_locked(uid)
+
+    def _flush_locked(self, uid):
+        buffer = self._buffers.pop(uid, None)
+        if buffer is not None:
+            self.send(buffer[0], uid, buffer[3])
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        with self._lock:
+            for uid in list(self._buffers):
+                self._flush_locked(uid)
+
+    def _flush_expired(self):
+        while not self._stopped.wait(self.interval):
+            deadline = time.monotonic() - self.interval
+            with self._lock:
+                for uid in [uid for uid, buffer in self._buffers.items() if buffer[1] <= deadline]:
+                    self._flush_locked(uid)
+
+
+class PausedStreams(SharedUids):
+    """Worker-side view of the streams whose API server asked to pause them."""
+
+    def __init__(self, shared: Mapping, poll_interval: float = PAUSE_POLL_INTERVAL):
+        super().__init__(shared, poll_interval)
+
+    async def wait(self, uids: Iterable, max_pause: float = STREAM_MAX_PAUSE):
+        """Wait while any of `uids` is paused, for at most `max_pause` seconds."""
+        uids = list(uids)
+        if not self.any_of(uids):
+            return
+        deadline = time.monotonic() + max_pause
+        while self.any_of(uids):
+            if time.monotonic() >= deadline:
+                logger.warning(f"Resuming a batch of streams paused for more than {max_pause}s")
+                return
+            await asyncio.sleep(self.poll_interval)
+
+
+class StreamBackpressure:
+    """API-side watermarks of the per-stream response buffers.
+
+    A stream whose client lags more than `buffer_size` chunks behind is paused in the shared dict the
+    workers read, and resumed once the client has read everything buffered.
+    """
+
+    def __init__(self, shared: Mapping, buffer_size: int = DEFAULT_STREAM_BUFFER_SIZE):
+        self.shared = shared
+        self.buffer_size = buffer_size
+        self.paused: Set = set()
+        self.pauses = 0
+        self.writer = SharedDictWriter(shared, "bubble-backpressure")
+
+    def observe(self, response_buffer: Mapping, responses: List[tuple]):
+        """Pause the streams whose buffer grew past `buffer_size`. Runs on the event loop."""
+        for uid, _ in responses:
+            entry = response_buffer.get(uid)
+            if uid in self.paused or not isinstance(entry, tuple):
+                continue
+            if len(entry[0]) > self.buffer_size:
+                self.paused.add(uid)
+                self.pauses += 1
+                self.writer.add(uid)
+
+    def drained(self, uid):
+        """Resume `uid` after its client read everything buffered. Runs on the event loop."""
+        if uid in self.paused:
+            self.paused.discard(uid)
+            self.writer.discard(uid)
+
+    def metrics(self) -> dict:
+        return {
+            "gauges": {"streams_paused": len(self.paused)},
+            "counters": {"stream_pauses_total": self.pauses},
+        }
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Set
+
+from .metrics import metric_key
+
+logger = logging.getLogger(__name__)
+
+# how often the liveness of the inference workers is checked
+SUPERVISE_INTERVAL = 0.5
+# delay before restarting a worker that crashed again soon after a restart, doubled on every crash that follows
+RESTART_BACKOFF = 1.0
+MAX_RESTART_BACKOFF = 60.0
+# a worker that stayed up this many seconds is restarted without delay when it crashes again
+STABLE_AFTER = 60.0
+# time for the responses a crashed worker sent before it died to reach their waiters
+EXIT_GRACE = 0.1
+
+
+class WorkerSupervisor:
+    """Restarts worker processes or threads that exited, from the event loop of the server process.
+
+    `workers` holds the running workers by id, and is updated in place. When one of them is no
+    longer alive, `on_exit(worker_id)` is called, then `spawn(worker_id)` starts a replacement after
+    a backoff that grows while the worker keeps crashing. The restart is complete once
+    `ready(worker_id)` reports that the replacement finished its setup.
+    """
+
+    def __init__(
+        self,
+        workers: List[Any],
+        spawn: Callable[[int], Any],
+        on_exit: Optional[Callable[[int], None]] = None,
+        ready: Optional[Callable[[int], bool]] = None,
+        name: str = "Inference worker",
+        interval: float = SUPERVISE_INTERVAL,
+        backoff: float = RESTART_BACKOFF,
+        max_backoff: float = MAX_RESTART_BACKOFF,
+        stable_after: float = STABLE_AFTER,
+    ):
+        self.workers = workers
+        self.spawn = spawn
+        self.on_exit = on_exit
+        self.ready = ready
+        self.name = name
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.restarts: Dict[int, int] = {}
+        self._crashes: Dict[int, int] = {}
+        self._started_at = {worker_id: time.monotonic() for worker_id in range(len(workers))}
+        self._restarting: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    def stop(self):
+        for task in [self._task, *self._tasks]:
+            if task is not None:
+                task.cancel()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for worker_id, worker in enumerate(self.workers):
+                if worker_id in self._restarting or worker.is_alive():
+                    continue
+                self._restarting.add(worker_id)
+                task = asyncio.get_running_loop().create_task(self._restart(worker_id, worker))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _restart(self, worker_id: int, worker):
+        try:
+            uptime = time.monotonic() - self._started_at[worker_id]
+            crashes = 0 if uptime >= self.stable_after else self._crashes.get(worker_id, 0)
+            self._crashes[worker_id] = crashes + 1
+            logger.error(
+                f"{self.name} {worker_id} exited with code {getattr(worker, 'exitcode', None)} after {uptime:.1f}s"
+            )
+            if self.on_exit is not None:
+                await asyncio.sleep(EXIT_GRACE)
+                self.on_exit(worker_id)
+
+            delay = min(self.backoff * 2 ** (crashes - 1), self.max_backoff) if crashes else 0.0
+            if delay:
+                logger.warning(f"{self.name} {worker_id} keeps crashing, restarting it in {delay:.0f}s")
+                await asyncio.sleep(delay)
+            worker = self.workers[worker_id] = self.spawn(worker_id)
+            self._started_at[worker_id] = time.monotonic()
+            self.restarts[worker_id] = self.restarts.get(worker_id, 0) + 1
+            while self.ready is not None and not self.ready(worker_id):
+                if not worker.is_alive():
+                    # crashed during setup, picked up again by the next check
+                    return
+                await asyncio.sleep(self.interval)
+            logger.info(f"{self.name} {worker_id} restarted")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f"Failed to restart {self.name.lower()} {worker_id}")
+        finally:
+            self._restarting.discard(worker_id)
+
+
+class WorkerExits:
+    """Exits of inference workers, published by the supervising process to every API server process.
+
+    `shared` maps a worker id to its number of exits and the uids of the requests that were moved
+    out of its queue. Each API server process `watch`es it to recover the requests it had sent to
+    the worker, and dispatches to the worker again once it is ready.
+    """
+
+    def __init__(self, shared: Mapping):
+        self.shared = shared
+        self.seen: Dict[int, int] = {}
+
+    def publish(self, worker_id: int, requeued: Iterable):
+        exits = self.shared.get(worker_id, (0, ()))[0]
+        self.shared[worker_id] = (exits + 1, tuple(requeued))
+
+    async def watch(
+        self,
+        on_exit: Callable[[int, Set], None],
+        ready: Callable[[int], bool],
+        on_ready: Callable[[int], None],
+        interval: float = SUPERVISE_INTERVAL,
+    ):
+        self.seen = {worker_id: exits for worker_id, (exits, _) in self.shared.copy().items()}
+        restarting: Set[int] = set()
+        while True:
+            await asyncio.sleep(interval)
+            for worker_id, (exits, requeued) in self.shared.copy().items():
+                if exits != self.seen.get(worker_id, 0):
+                    self.seen[worker_id] = exits
+                    restarting.add(worker_id)
+                    on_exit(worker_id, set(requeued))
+            for worker_id in [worker_id for worker_id in restarting if ready(worker_id)]:
+                restarting.discard(worker_id)
+                on_ready(worker_id)
+
+    def metrics(self) -> dict:
+        return {
+            "gauges": {},
+            "counters": {
+                metric_key("worker_exits_total", {"worker_id": str(worker_id)}): exits
+                for worker_id, exits in self.seen.items()
+            },
+        }
@@ -0,0 +1,14 @@
+import importlib.util
+import pathlib
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# the package lives in a `bubble-motor` directory, import it under its distribution name
+if "bubble_motor" not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        "bubble_motor", ROOT / "__init__.py", submodule_search_locations=[str(ROOT)]
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["bubble_motor"] = module
+    spec.loader.exec_module(module)
@@ -0,0 +1,92 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import textwrap
+import time
+
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER = textwrap.dedent(
+    """
+    import asyncio, sys
+
+    from bubble_motor.api import BubbleAPI
+    from bubble_motor.server import BubbleServer
+
+
+    class EchoAPI(BubbleAPI):
+        async def setup(self, device):
+            pass
+
+        def predict(self, x):
+            return x
+
+        def encode_response(self, output):
+            return {"output": output}
+
+
+    if __name__ == "__main__":
+        server = BubbleServer(EchoAPI(), accelerator="cpu", workers_per_device=2)
+        port = int(sys.argv[1])
+        asyncio.run(server.run(port=port, num_api_servers=2, generate_client_file=False, log_level="warning"))
+    """
+)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_healthy(process, url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        assert process.poll() is None, "the server exited during startup"
+        try:
+            if httpx.get(f"{url}/health").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    pytest.fail("the server did not start")
+
+
+@pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"), reason="needs SO_REUSEPORT")
+def test_api_server_processes_share_the_port_and_stop_on_sigterm(tmp_path):
+    # install the package under its name, the spawned workers import it again
+    (tmp_path / "bubble_motor").symlink_to(ROOT)
+    (tmp_path / "serve.py").write_text(SERVER)
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen(
+        [sys.executable, "serve.py", str(port)],
+        cwd=tmp_path,
+        env={**os.environ, "PYTHONPATH": str(tmp_path)},
+        stdout=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    try:
+        _wait_until_healthy(process, url)
+        for i in range(20):
+            # a new connection each time, spread over the API servers by the kernel
+            response = httpx.post(f"{url}/predict", json={"input": i})
+            assert response.json() == {"output": {"input": i}}
+
+        deadline = time.monotonic() + 10
+        metrics = ""
+        while 'api_server="1"' not in metrics or 'api_server="0"' not in metrics:
+            assert time.monotonic() < deadline, metrics
+            time.sleep(0.2)
+            metrics = httpx.get(f"{url}/metrics").text
+
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(30) == 0
+    finally:
+        if process.poll() is None:
+            os.killpg(process.pid, signal.SIGKILL)
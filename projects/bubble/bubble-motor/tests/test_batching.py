@@ -0,0 +1,63 @@
+import pytest
+
+from bubble_motor.batching import AdaptiveBatchPolicy, create_batch_policy
+
+
+def _policy(latency_slo, arrival_rate, latencies, max_batch_size=8, batch_timeout=0.05):
+    policy = AdaptiveBatchPolicy(max_batch_size, batch_timeout, latency_slo, warmup_batches=2)
+    policy.arrivals.rate = arrival_rate
+    for batch_size, latency in latencies:
+        for _ in range(3):
+            policy.observe_predict(batch_size, latency)
+    return policy
+
+
+def test_keeps_the_configured_batch_until_warmed_up():
+    policy = AdaptiveBatchPolicy(8, 0.05, latency_slo=0.1, warmup_batches=10)
+    policy.arrivals.rate = 100
+    for _ in range(9):
+        policy.observe_predict(1, 0.01)
+    assert policy.next_batch() == (8, 0.05)
+
+
+def test_estimates_unobserved_sizes_from_the_closest_observed_ones():
+    policy = _policy(0.1, 100, [(2, 0.02), (6, 0.04)])
+    assert policy._estimate(4, "mean") == pytest.approx(0.03)
+    assert policy._estimate(8, "mean") == pytest.approx(0.04 * 8 / 6)
+    assert policy._estimate(1, "mean") == pytest.approx(0.01)
+
+
+def test_a_size_with_few_samples_is_estimated_from_them_without_neighbours():
+    policy = AdaptiveBatchPolicy(8, 0.05, latency_slo=0.1, warmup_batches=1)
+    policy.observe_predict(4, 0.02)
+    assert policy._estimate(4, "mean") == pytest.approx(0.02)
+    assert policy._estimate(8, "mean") == pytest.approx(0.04)
+
+
+def test_picks_the_smallest_batch_that_keeps_up_with_the_arrivals():
+    # 1 request takes 10 ms and 8 take 30 ms, 100 requests per second with 20% headroom need a batch of 2
+    policy = _policy(0.1, 100, [(1, 0.01), (8, 0.03)])
+    batch_size, timeout = policy.next_batch()
+    assert batch_size == 2
+    # the time it takes the second request to arrive
+    assert timeout == pytest.approx(0.01)
+
+
+def test_uses_the_largest_batch_within_the_slo_when_none_keeps_up():
+    policy = _policy(0.02, 1000, [(1, 0.01), (8, 0.03)])
+    batch_size, timeout = policy.next_batch()
+    assert batch_size == 4
+    # the SLO left after the predicted latency of a batch of 4
+    assert timeout == pytest.approx(0.02 - (0.01 + 3 * 0.02 / 7))
+    assert policy.metrics()["batch_policy_predicted_p99_seconds"] == pytest.approx(0.01 + 3 * 0.02 / 7)
+
+
+def test_falls_back_to_single_requests_when_no_batch_meets_the_slo():
+    policy = _policy(0.005, 100, [(1, 0.01), (8, 0.03)])
+    assert policy.next_batch() == (1, 0.0)
+
+
+def test_adaptive_batching_requires_a_latency_slo():
+    with pytest.raises(ValueError):
+        create_batch_policy("adaptive", 8, 0.05)
+    assert isinstance(create_batch_policy("adaptive", 8, 0.05, latency_slo=0.1), AdaptiveBatchPolicy)
@@ -0,0 +1,41 @@
+import pytest
+
+from bubble_motor.bucketing import BucketBatcher, padding_waste
+
+
+def _batcher(*lengths, boundaries=(8, 32, 128)):
+    batcher = BucketBatcher(len, boundaries)
+    for uid, length in enumerate(lengths):
+        batcher.add((0, uid, "x" * length), "x" * length)
+    return batcher
+
+
+def _uids(payloads):
+    return [uid for _, uid, _ in payloads]
+
+
+def test_padding_waste_is_the_padded_fraction():
+    assert padding_waste([4, 4]) == 0.0
+    assert padding_waste([1, 3]) == pytest.approx(1 / 3)
+    assert padding_waste([0, 0]) == 0.0
+
+
+def test_a_full_bucket_is_served_first():
+    batcher = _batcher(100, 5, 6, 7)
+    payloads, sizes = batcher.next_batch(3)
+    assert _uids(payloads) == [1, 2, 3]
+    assert sizes == [5, 6, 7]
+    assert batcher.pending == 1
+
+
+def test_without_a_full_bucket_the_oldest_request_is_served():
+    batcher = _batcher(100, 5, 120, 6)
+    assert _uids(batcher.next_batch(3)[0]) == [0, 2]
+    assert _uids(batcher.next_batch(3)[0]) == [1, 3]
+    assert batcher.next_batch(3) == ([], [])
+
+
+def test_sizes_above_the_last_boundary_share_a_bucket():
+    batcher = _batcher(1000, 5000, boundaries=(8,))
+    _, sizes = batcher.next_batch(2)
+    assert sizes == [1000, 5000]
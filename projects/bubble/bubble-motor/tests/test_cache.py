@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from bubble_motor.cache import ResultCache
+
+
+def test_identical_requests_share_one_computation():
+    async def run():
+        cache, computed = ResultCache(), []
+
+        async def compute():
+            computed.append(1)
+            await asyncio.sleep(0.01)
+            return "out"
+
+        results = await asyncio.gather(*(cache.get_or_compute("key", compute) for _ in range(3)))
+        assert results == ["out"] * 3
+        assert computed == [1]
+        assert await cache.get_or_compute("key", compute) == "out"
+        assert cache.counters["result_cache_coalesced_total"] == 2
+        assert cache.counters["result_cache_hits_total"] == 1
+
+    asyncio.run(run())
+
+
+def test_the_computation_is_cancelled_with_its_last_waiter():
+    async def run():
+        cache, started, cancelled = ResultCache(), asyncio.Event(), []
+
+        async def compute():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        first = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        second = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        await started.wait()
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled and not second.done()
+        second.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        await asyncio.sleep(0)
+        assert cancelled == [1]
+        assert not cache._inflight
+
+    asyncio.run(run())
@@ -0,0 +1,187 @@
+import asyncio
+import json
+from collections import deque
+
+import pytest
+from fastapi import BackgroundTasks, HTTPException
+
+from bubble_motor.api import BubbleAPI
+from bubble_motor.cancellation import Cancellations
+from bubble_motor.demux import deliver
+from bubble_motor.example_openai_spec import ChatCompletionRequest, OpenAISpec
+from bubble_motor.scheduler import RequestScheduler
+from bubble_motor.server import BubbleServer
+from bubble_motor.utils import BubbleAPIStatus
+
+
+class EchoAPI(BubbleAPI):
+    async def setup(self, device):
+        pass
+
+    def predict(self, x):
+        return x
+
+
+class Client:
+    """ASGI receive channel of a request whose body was read, the client leaves on `disconnect`."""
+
+    def __init__(self):
+        self.messages = asyncio.Queue()
+
+    async def receive(self):
+        return await self.messages.get()
+
+    def disconnect(self):
+        self.messages.put_nowait({"type": "http.disconnect"})
+
+
+class RequestQueue(list):
+    def put_nowait(self, item):
+        self.append(item)
+
+    def put_many(self, items):
+        self.extend(items)
+
+    def qsize(self):
+        return len(self)
+
+
+def _server(**kwargs):
+    server = BubbleServer(EchoAPI(), accelerator="cpu", **kwargs)
+    server.response_queue_id = 0
+    server.scheduler = RequestScheduler(RequestQueue(), None, 8, False, on_drop=server._reject)
+    server.cancellations = Cancellations({}, stream=False)
+    return server
+
+
+def _cancelled(server):
+    server.cancellations.writer.flush()
+    return set(server.cancellations.shared)
+
+
+def test_a_disconnected_prediction_fails_with_499_and_is_cancelled_on_its_worker():
+    async def run():
+        server, client = _server(), Client()
+        prediction = asyncio.ensure_future(server._infer("x", 0, client))
+        await asyncio.sleep(0)
+        client.disconnect()
+        with pytest.raises(HTTPException) as error:
+            await prediction
+        assert error.value.status_code == 499
+        (_, uid, _, _), = server.scheduler.request_queue
+        assert _cancelled(server) == {uid}
+        assert uid not in server.response_buffer
+
+    asyncio.run(run())
+
+
+def test_a_cached_prediction_is_cancelled_once_all_its_clients_disconnected():
+    async def run():
+        server, clients = _server(cache=True), [Client(), Client()]
+        predictions = [
+            asyncio.ensure_future(
+                server._unless_disconnected(
+                    client, server.result_cache.get_or_compute("key", lambda: server._infer("x", 0))
+                )
+            )
+            for client in clients
+        ]
+        await asyncio.sleep(0)
+        clients[0].disconnect()
+        with pytest.raises(HTTPException) as error:
+            await predictions[0]
+        assert error.value.status_code == 499
+        assert not server.cancellations.pending
+
+        clients[1].disconnect()
+        with pytest.raises(HTTPException):
+            await predictions[1]
+        await asyncio.sleep(0)
+        (_, uid, _, _), = server.scheduler.request_queue
+        assert _cancelled(server) == {uid}
+
+    asyncio.run(run())
+
+
+def test_a_cached_prediction_answers_the_clients_still_waiting():
+    async def run():
+        server, clients = _server(cache=True), [Client(), Client()]
+        predictions = [
+            asyncio.ensure_future(
+                server._unless_disconnected(
+                    client, server.result_cache.get_or_compute("key", lambda: server._infer("x", 0))
+                )
+            )
+            for client in clients
+        ]
+        await asyncio.sleep(0)
+        clients[0].disconnect()
+        with pytest.raises(HTTPException):
+            await predictions[0]
+        (_, uid, _, _), = server.scheduler.request_queue
+        deliver(server.response_buffer, [(uid, ("y", BubbleAPIStatus.OK))])
+        assert await predictions[1] == "y"
+        assert not server.cancellations.pending
+
+    asyncio.run(run())
+
+
+def _chat(server, n=1):
+    spec = OpenAISpec()
+    spec._server = server
+    spec.response_queue_id = 0
+    request = ChatCompletionRequest(messages=[{"role": "user", "content": "hi"}], n=n)
+    client = Client()
+    completion = asyncio.ensure_future(spec.chat_completion(request, client, BackgroundTasks()))
+    return completion, client
+
+
+def _reply(server, uid, content):
+    chunk = json.dumps({"role": "assistant", "content": content})
+    deliver(server.response_buffer, [(uid, (chunk, BubbleAPIStatus.OK)), (uid, ("", BubbleAPIStatus.FINISH_STREAMING))])
+
+
+def test_concurrent_chat_completions_get_their_own_choices():
+    async def run():
+        server = _server()
+        (first, _), (second, _) = _chat(server, n=2), _chat(server)
+        await asyncio.sleep(0)
+        uids = [uid for _, uid, _, _ in server.scheduler.request_queue]
+        for uid, content in zip(uids, ["a", "b", "c"]):
+            _reply(server, uid, content)
+        assert [choice.message.content for choice in (await first).choices] == ["a", "b"]
+        assert [choice.message.content for choice in (await second).choices] == ["c"]
+        assert not server.response_buffer
+
+    asyncio.run(run())
+
+
+def test_a_disconnected_chat_completion_fails_with_499_and_is_cancelled_on_its_worker():
+    async def run():
+        server = _server()
+        completion, client = _chat(server, n=2)
+        await asyncio.sleep(0)
+        client.disconnect()
+        with pytest.raises(HTTPException) as error:
+            await completion
+        assert error.value.status_code == 499
+        assert _cancelled(server) == {uid for _, uid, _, _ in server.scheduler.request_queue}
+
+    asyncio.run(run())
+
+
+def test_a_stream_closed_before_its_end_is_cancelled_on_its_worker():
+    async def run():
+        server = _server()
+        server.cancellations = Cancellations({}, stream=True)
+        uid, q, event = "stream", deque(), asyncio.Event()
+        server.response_buffer[uid] = (q, event)
+        server.scheduler.submit((0, uid, 0.0, "x"))
+        deliver(server.response_buffer, [(uid, ("a", BubbleAPIStatus.OK))])
+        stream = server.data_streamer(q, event, uid=uid)
+        assert await stream.__anext__() == "a"
+        await stream.aclose()
+        assert _cancelled(server) == {uid}
+        assert uid not in server.response_buffer
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+import time
+from queue import Queue
+
+from bubble_motor.batching import AdaptiveBatchPolicy, FixedBatchPolicy
+from bubble_motor.loops import collate_requests
+
+
+def _queue(*uids):
+    queue = Queue()
+    for uid in uids:
+        queue.put((0, uid, time.monotonic(), f"payload-{uid}"))
+    return queue
+
+
+def test_drains_queued_requests_up_to_the_batch_size():
+    payloads = collate_requests(_queue(1, 2, 3), 2, 0)
+    assert payloads == [(0, 1, "payload-1"), (0, 2, "payload-2")]
+
+
+def test_waits_out_the_timeout_without_an_arrival_rate():
+    start = time.monotonic()
+    assert len(collate_requests(_queue(1), 4, 0.2)) == 1
+    assert time.monotonic() - start >= 0.2
+
+
+def test_a_lone_request_is_not_held_when_no_other_is_expected():
+    start = time.monotonic()
+    assert len(collate_requests(_queue(1), 4, 5.0, arrival_rate=0.1)) == 1
+    assert time.monotonic() - start < 1.0
+
+
+def test_waits_out_the_timeout_until_a_rate_is_measured():
+    start = time.monotonic()
+    assert len(collate_requests(_queue(1), 4, 0.2, arrival_rate=0.0)) == 1
+    assert time.monotonic() - start >= 0.2
+
+
+def test_waits_for_more_requests_when_they_are_expected():
+    start = time.monotonic()
+    assert len(collate_requests(_queue(1), 4, 0.2, arrival_rate=100)) == 1
+    # stops once less than one request is expected in the rest of the timeout
+    assert 0.15 <= time.monotonic() - start < 0.2
+
+
+def test_batch_policies_measure_the_arrival_rate():
+    policy = FixedBatchPolicy(8, 0.01)
+    policy.arrivals.window = 0
+    policy.observe_arrivals(5)
+    assert policy.arrival_rate > 0
+    assert policy.metrics()["batch_policy_arrival_rate"] == policy.arrival_rate
+
+
+def test_only_policies_that_opt_in_stop_waiting_early():
+    policies = [FixedBatchPolicy(8, 0.01), FixedBatchPolicy(8, 0.01, stop_early=True), AdaptiveBatchPolicy(8, 0.01, 0.1)]
+    for policy in policies:
+        policy.arrivals.window = 0
+        policy.observe_arrivals(5)
+    assert [policy.collation_arrival_rate() is not None for policy in policies] == [False, True, True]
@@ -0,0 +1,86 @@
+import msgpack
+import numpy as np
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.testclient import TestClient
+
+from bubble_motor.content import (
+    MSGPACK,
+    NPY,
+    OCTET_STREAM,
+    NegotiatedRoute,
+    decode_body,
+    encode_body,
+    negotiate,
+    npy_dumps,
+    npy_loads,
+)
+
+
+def test_negotiate_picks_the_preferred_binary_type():
+    assert negotiate(None) is None
+    assert negotiate("application/json") is None
+    assert negotiate("application/x-msgpack") == MSGPACK
+    assert negotiate("application/json;q=0.5, application/x-npy") == NPY
+    # JSON is preferred, so no binary type
+    assert negotiate("application/msgpack;q=0.5, application/json") is None
+    assert negotiate("text/html, application/octet-stream;q=0.1") == OCTET_STREAM
+    assert negotiate("application/msgpack;q=oops, application/x-npy;q=0.2") == NPY
+
+
+@pytest.mark.parametrize("order", ["C", "F"])
+def test_npy_bodies_are_read_without_copying(order):
+    array = np.asarray(np.arange(12, dtype=np.int16).reshape(3, 4), order=order)
+    data = npy_dumps(array)
+    loaded = npy_loads(data)
+    np.testing.assert_array_equal(loaded, array)
+    assert not loaded.flags.writeable
+    assert np.shares_memory(loaded, np.frombuffer(data, dtype=np.uint8))
+
+
+def test_object_arrays_are_rejected():
+    with pytest.raises(ValueError):
+        npy_loads(npy_dumps(np.array([{"a": 1}], dtype=object)))
+
+
+def test_msgpack_carries_arrays_as_npy():
+    body = encode_body(MSGPACK, {"input": np.arange(3.0), "scale": np.float32(2.0)})
+    decoded = decode_body(MSGPACK, body)
+    np.testing.assert_array_equal(decoded["input"], np.arange(3.0))
+    assert decoded["scale"] == 2.0
+
+
+def test_a_response_that_cannot_be_encoded_is_a_406():
+    with pytest.raises(HTTPException) as error:
+        encode_body(MSGPACK, {"input": object()})
+    assert error.value.status_code == 406
+
+
+def _client():
+    app = FastAPI()
+    app.router.route_class = NegotiatedRoute
+
+    @app.post("/predict")
+    async def predict(request: Request):
+        payload = await request.json()
+        return {"sum": float(np.sum(payload["input"]))}
+
+    return TestClient(app)
+
+
+def test_binary_requests_reach_the_endpoint_as_json_and_get_msgpack_back():
+    client = _client()
+    response = client.post(
+        "/predict",
+        content=encode_body(MSGPACK, {"input": np.arange(4.0)}),
+        headers={"Content-Type": MSGPACK, "Accept": MSGPACK},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == MSGPACK
+    assert msgpack.unpackb(response.content) == {"sum": 6.0}
+
+    response = client.post("/predict", json={"input": [1, 2]})
+    assert response.json() == {"sum": 3.0}
+
+    response = client.post("/predict", content=b"\x93NUMPY garbage", headers={"Content-Type": NPY})
+    assert response.status_code == 400
@@ -0,0 +1,61 @@
+import asyncio
+from collections import deque
+from queue import Queue
+
+from bubble_motor.demux import ResponseDemultiplexer, awaiting_response, deliver
+from bubble_motor.utils import BubbleAPIStatus
+
+
+def test_a_response_replaces_the_event_of_its_request():
+    async def run():
+        event = asyncio.Event()
+        response_buffer = {"a": event}
+        deliver(response_buffer, [("a", ("out", BubbleAPIStatus.OK)), ("unknown", ("out", BubbleAPIStatus.OK))])
+        assert event.is_set()
+        assert response_buffer == {"a": ("out", BubbleAPIStatus.OK)}
+        assert not awaiting_response(response_buffer["a"])
+        # a second response, e.g. from a retried request, is dropped
+        deliver(response_buffer, [("a", ("again", BubbleAPIStatus.OK))])
+        assert response_buffer["a"] == ("out", BubbleAPIStatus.OK)
+
+    asyncio.run(run())
+
+
+def test_stream_chunks_are_appended_one_by_one():
+    async def run():
+        stream, event = deque(), asyncio.Event()
+        response_buffer = {"a": (stream, event)}
+        deliver(response_buffer, [("a", (["x", "y"], BubbleAPIStatus.CHUNKS)), ("a", ("z", BubbleAPIStatus.OK))])
+        assert event.is_set()
+        assert list(stream) == [("x", BubbleAPIStatus.OK), ("y", BubbleAPIStatus.OK), ("z", BubbleAPIStatus.OK)]
+        assert awaiting_response(response_buffer["a"])
+        deliver(response_buffer, [("a", ("", BubbleAPIStatus.FINISH_STREAMING))])
+        assert not awaiting_response(response_buffer["a"])
+
+    asyncio.run(run())
+
+
+def test_queued_responses_are_handed_to_the_event_loop_together():
+    async def run():
+        response_queue = Queue()
+        events = {uid: asyncio.Event() for uid in range(3)}
+        response_buffer = dict(events)
+        batches, stolen = [], []
+        demux = ResponseDemultiplexer(
+            response_queue, response_buffer, poll_timeout=0.05, on_responses=batches.append, on_stolen=stolen.extend
+        )
+        for uid in range(3):
+            response_queue.put((uid, (uid * 10, BubbleAPIStatus.OK)))
+        response_queue.put((3, (1, BubbleAPIStatus.STOLEN)))
+        demux.start(asyncio.get_running_loop())
+        try:
+            await asyncio.wait_for(asyncio.gather(*(event.wait() for event in events.values())), 1)
+        finally:
+            demux.stop()
+        assert response_buffer == {uid: (uid * 10, BubbleAPIStatus.OK) for uid in range(3)}
+        assert len(batches) == 1
+        # the notice of a stolen request is not a response
+        assert stolen == [(3, 1)]
+        assert not demux._thread.is_alive()
+
+    asyncio.run(run())
@@ -0,0 +1,117 @@
+from queue import Queue
+
+from bubble_motor.dispatcher import Dispatcher, requeue, steal
+from bubble_motor.loops import collate_requests
+
+
+def _item(uid, response_queue_id=0):
+    return response_queue_id, uid, 0.0, f"payload-{uid}"
+
+
+def _drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def test_requests_go_to_the_worker_with_the_fewest_outstanding():
+    queues = [Queue(), Queue()]
+    dispatcher = Dispatcher(queues)
+    for uid in range(4):
+        dispatcher.put_nowait(_item(uid))
+    assert dispatcher.outstanding == [2, 2]
+    dispatcher.complete(0)
+    dispatcher.put_many([_item(10), _item(11)])
+    assert dispatcher.outstanding == [3, 2]
+    assert [item[1] for item in _drain(queues[0])] == [0, 2, 10, 11]
+
+
+def test_completions_of_stolen_requests_count_for_the_thief():
+    queues = [Queue(), Queue()]
+    dispatcher = Dispatcher(queues, window=0)
+    dispatcher.put_many([_item(uid) for uid in range(3)])
+    assert dispatcher.outstanding == [3, 0]
+    dispatcher.reassign([(1, 1), (2, 1)])
+    assert dispatcher.outstanding == [1, 2]
+    dispatcher.complete(1)
+    dispatcher.complete(2)
+    assert dispatcher.outstanding == [1, 0]
+    assert dispatcher.completions[0].rate == 0
+    assert dispatcher.completions[1].rate > 0
+
+
+def test_evict_returns_the_requests_lost_with_the_worker():
+    queues = [Queue(), Queue()]
+    dispatcher = Dispatcher(queues)
+    dispatcher.put_many([_item(uid) for uid in range(4)])
+    dispatcher.reassign([(3, 1)])
+    # request 2 was still queued and moved to the peer by `requeue`, 3 is served by the peer
+    held = dispatcher.evict(0, requeued={2})
+    assert [item[1] for item in held] == [0, 1]
+    assert dispatcher.outstanding == [0, 1]
+    dispatcher.put_nowait(_item(5))
+    assert dispatcher.outstanding == [0, 2]
+    dispatcher.restore(0)
+    dispatcher.put_nowait(_item(6))
+    assert dispatcher.outstanding == [1, 2]
+
+
+def test_evicted_worker_is_used_when_no_other_is_available():
+    dispatcher = Dispatcher([Queue()])
+    dispatcher.evict(0)
+    dispatcher.put_nowait(_item(1))
+    assert dispatcher.outstanding == [1]
+
+
+def test_retry_gives_up_after_max_retries():
+    queues = [Queue(), Queue()]
+    dispatcher = Dispatcher(queues)
+    item = _item(1)
+    dispatcher.put_nowait(item)
+    assert dispatcher.evict(0) == [item]
+    assert dispatcher.retry(item, max_retries=2)
+    assert _drain(queues[1]) == [item]
+    assert dispatcher.evict(1) == [item]
+    assert dispatcher.retry(item, max_retries=2)
+    dispatcher.evict(0)
+    assert not dispatcher.retry(item, max_retries=2)
+
+
+def test_completion_forgets_the_retries():
+    dispatcher = Dispatcher([Queue(), Queue()])
+    item = _item(1)
+    dispatcher.put_nowait(item)
+    dispatcher.evict(0)
+    assert dispatcher.retry(item, max_retries=1)
+    dispatcher.complete(1)
+    dispatcher.put_nowait(item)
+    dispatcher.evict(1)
+    assert dispatcher.retry(item, max_retries=1)
+
+
+def test_requeue_moves_queued_requests_to_the_peers():
+    queues = [Queue(), Queue(), Queue()]
+    for uid in range(4):
+        queues[0].put(_item(uid))
+    assert requeue(queues, 0) == [0, 1, 2, 3]
+    assert [item[1] for item in _drain(queues[1])] == [0, 2]
+    assert [item[1] for item in _drain(queues[2])] == [1, 3]
+
+
+def test_steal_only_takes_what_the_owner_cannot_batch():
+    victim = Queue()
+    for uid in range(6):
+        victim.put(_item(uid))
+    assert [item[1] for item in steal([Queue(), victim], 4)] == [0, 1]
+    assert steal([victim], 4) == []
+
+
+def test_an_idle_worker_announces_the_requests_it_stole():
+    own, peer = Queue(), Queue()
+    for uid in range(6):
+        peer.put(_item(uid))
+    stolen = []
+    payloads = collate_requests(own, 4, 0, idle_timeout=0, steal_queues=[peer], on_steal=stolen.extend)
+    assert [uid for _, uid, _ in payloads] == [0, 1]
+    assert stolen == [_item(0), _item(1)]
@@ -0,0 +1,221 @@
+import asyncio
+import threading
+import time
+from queue import Queue
+
+import pytest
+
+from bubble_motor.api import BubbleAPI
+from bubble_motor.demux import ResponseDemultiplexer
+from bubble_motor.loops import InferenceEngine
+from bubble_motor.metrics import WorkerMetrics
+from bubble_motor.transport import LoopQueue
+from bubble_motor.utils import BubbleAPIStatus
+
+
+class EchoAPI(BubbleAPI):
+    def __init__(self, predict_time: float = 0.0):
+        self.predict_time = predict_time
+
+    async def setup(self, device):
+        pass
+
+    async def predict(self, x, **kwargs):
+        await asyncio.sleep(self.predict_time)
+        return x
+
+
+def _start(api, max_batch_size=4, stream=False, batch_timeout=0.001, **kwargs):
+    api.request_timeout = -1
+    api._sanitize(max_batch_size, spec=None, continuous=kwargs.get("continuous", False))
+    request_queue, response_queue = Queue(), Queue()
+    engine = InferenceEngine(
+        api, None, request_queue, [response_queue], max_batch_size, batch_timeout, stream, **kwargs
+    )
+    thread = threading.Thread(target=asyncio.run, args=(engine.run(),), daemon=True)
+    thread.start()
+    return engine, thread, request_queue, response_queue
+
+
+@pytest.mark.parametrize("concurrent_batches", [1, 2])
+def test_stop_serves_the_collected_requests_and_shuts_down(concurrent_batches):
+    engine, thread, request_queue, response_queue = _start(EchoAPI(0.1), concurrent_batches=concurrent_batches)
+    for uid in range(3):
+        request_queue.put((0, uid, time.monotonic(), uid))
+    time.sleep(0.05)
+    engine.stop()
+    thread.join(3)
+    assert not thread.is_alive()
+    responses = sorted(response_queue.get_nowait() for _ in range(3))
+    assert responses == [(uid, (uid, BubbleAPIStatus.OK)) for uid in range(3)]
+    assert engine._executor._shutdown
+
+
+def test_stop_stops_reading_the_cancelled_requests():
+    engine, thread, request_queue, response_queue = _start(EchoAPI(), cancelled_requests={})
+    request_queue.put((0, 0, time.monotonic(), 0))
+    assert response_queue.get(timeout=1) == (0, (0, BubbleAPIStatus.OK))
+    assert engine._shared_uids._thread.is_alive()
+    engine.stop()
+    thread.join(3)
+    assert not engine._shared_uids._thread.is_alive()
+
+
+def test_stop_stops_the_chunk_flush_thread():
+    engine, thread, _, _ = _start(EchoAPI(), stream=True, stream_flush_interval=0.01)
+    assert engine.coalescer._thread.is_alive()
+    engine.stop()
+    thread.join(3)
+    assert not engine.coalescer._thread.is_alive()
+
+
+class CountingAPI(EchoAPI):
+    def __init__(self):
+        super().__init__()
+        self.inputs = []
+
+    async def predict(self, x, **kwargs):
+        self.inputs.append(list(x))
+        return x
+
+
+def test_identical_requests_in_a_batch_are_predicted_once():
+    api, metrics = CountingAPI(), WorkerMetrics(0)
+    engine, thread, request_queue, response_queue = _start(api, batch_timeout=1.0, coalesce=True, metrics=metrics)
+    for uid, x in enumerate(["a", "b", "a", "a"]):
+        request_queue.put((0, uid, time.monotonic(), x))
+    responses = sorted(response_queue.get(timeout=3) for _ in range(4))
+    engine.stop()
+    thread.join(3)
+    assert api.inputs == [["a", "b"]]
+    assert responses == [(uid, (x, BubbleAPIStatus.OK)) for uid, x in enumerate(["a", "b", "a", "a"])]
+    assert metrics.counters["inferences_saved_total"] == 2
+
+
+class CountdownAPI(BubbleAPI):
+    """Generates `n` tokens for a request of `n`, one per step."""
+
+    def __init__(self, step_time: float = 0.0):
+        self.step_time = step_time
+        self.steps = []
+        self.released = []
+
+    async def setup(self, device):
+        pass
+
+    def decode_request(self, request):
+        return {"uid": request["uid"], "left": request["n"]}
+
+    async def predict(self, x, **kwargs):
+        pass
+
+    def step(self, states):
+        time.sleep(self.step_time)
+        self.steps.append([state["uid"] for state in states])
+        for state in states:
+            state["left"] -= 1
+        return [state["left"] for state in states]
+
+    def is_finished(self, state):
+        return state["left"] == 0
+
+    def release(self, state):
+        self.released.append(state["uid"])
+
+    def encode_response(self, output):
+        return output
+
+
+def _stream_until_finished(response_queue, uids):
+    outputs = {uid: [] for uid in uids}
+    finished = []
+    while len(finished) < len(uids):
+        uid, (data, status) = response_queue.get(timeout=3)
+        if status == BubbleAPIStatus.FINISH_STREAMING:
+            finished.append(uid)
+        else:
+            outputs[uid].append(data)
+    return outputs, finished
+
+
+def test_finished_sequences_leave_the_continuous_batch():
+    api = CountdownAPI()
+    engine, thread, request_queue, response_queue = _start(api, stream=True, continuous=True, batch_timeout=1.0)
+    for uid, n in enumerate([4, 2, 3, 1]):
+        request_queue.put((0, uid, time.monotonic(), {"uid": uid, "n": n}))
+    outputs, finished = _stream_until_finished(response_queue, range(4))
+    engine.stop()
+    thread.join(3)
+    assert outputs == {0: [3, 2, 1, 0], 1: [1, 0], 2: [2, 1, 0], 3: [0]}
+    assert finished == [3, 1, 2, 0]
+    assert api.steps == [[0, 1, 2, 3], [0, 1, 2], [0, 2], [0]]
+    assert api.released == finished
+
+
+def test_a_request_joins_the_continuous_batch_between_steps():
+    api = CountdownAPI(step_time=0.01)
+    engine, thread, request_queue, response_queue = _start(api, stream=True, continuous=True)
+    request_queue.put((0, 0, time.monotonic(), {"uid": 0, "n": 30}))
+    assert response_queue.get(timeout=3) == (0, (29, BubbleAPIStatus.OK))
+    request_queue.put((0, 1, time.monotonic(), {"uid": 1, "n": 2}))
+    _, finished = _stream_until_finished(response_queue, [0, 1])
+    engine.stop()
+    thread.join(3)
+    # the short request doesn't wait for the long one to finish
+    assert finished == [1, 0]
+    assert [0, 1] in api.steps
+
+
+class ConcurrencyAPI(EchoAPI):
+    def __init__(self, predict_time: float):
+        super().__init__(predict_time)
+        self.running = 0
+        self.max_running = 0
+
+    async def predict(self, x, **kwargs):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.predict_time)
+        self.running -= 1
+        return x
+
+
+@pytest.mark.parametrize("concurrent_batches", [1, 3])
+def test_up_to_concurrent_batches_are_in_predict_at_once(concurrent_batches):
+    api = ConcurrencyAPI(0.05)
+    engine, thread, request_queue, response_queue = _start(api, max_batch_size=1, concurrent_batches=concurrent_batches)
+    for uid in range(6):
+        request_queue.put((0, uid, time.monotonic(), uid))
+    responses = sorted(response_queue.get(timeout=3) for _ in range(6))
+    engine.stop()
+    thread.join(3)
+    assert responses == [(uid, (uid, BubbleAPIStatus.OK)) for uid in range(6)]
+    assert api.max_running == concurrent_batches
+
+
+def test_a_thread_worker_delivers_its_responses_on_the_event_loop():
+    async def run():
+        api = EchoAPI()
+        api.request_timeout = -1
+        api._sanitize(4, spec=None)
+        request_queue, response_queue = Queue(), LoopQueue()
+        events = {uid: asyncio.Event() for uid in range(3)}
+        response_buffer = dict(events)
+        demux = ResponseDemultiplexer(response_queue, response_buffer)
+        demux.start(asyncio.get_running_loop())
+        # bound to the loop, no reader thread
+        assert demux._thread is None
+        engine = InferenceEngine(api, None, request_queue, [response_queue], 4, 0.001, False)
+        thread = threading.Thread(target=asyncio.run, args=(engine.run(),), daemon=True)
+        thread.start()
+        inputs = [{"x": uid} for uid in range(3)]
+        for uid, x in enumerate(inputs):
+            request_queue.put((0, uid, time.monotonic(), x))
+        await asyncio.wait_for(asyncio.gather(*(event.wait() for event in events.values())), 3)
+        engine.stop()
+        thread.join(3)
+        # nothing was copied on the way
+        assert all(response_buffer[uid] == (x, BubbleAPIStatus.OK) for uid, x in enumerate(inputs))
+        assert all(response_buffer[uid][0] is x for uid, x in enumerate(inputs))
+
+    asyncio.run(run())
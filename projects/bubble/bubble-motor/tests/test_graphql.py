@@ -0,0 +1,46 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from graphql import GraphQLError
+
+from bubble_motor.results import PROCESSING, PredictionLoader
+from bubble_motor.scheduler import RequestScheduler
+from bubble_motor.server import resolve_predict_batch
+
+
+def _info(scheduler, priority=0):
+    enqueued = []
+    server = SimpleNamespace(scheduler=scheduler)
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(bubble_server=server)))
+    context = {"request": request, "priority": priority, "predictions": PredictionLoader(enqueued.append)}
+    return SimpleNamespace(context=context), enqueued
+
+
+def _scheduler(**kwargs):
+    return RequestScheduler(None, None, 8, False, on_drop=lambda uid, error: None, **kwargs)
+
+
+def test_predict_batch_is_admitted_at_once():
+    async def run():
+        info, enqueued = _info(_scheduler(max_pending=3))
+        results = await resolve_predict_batch(None, info, ["a", "b", "c"])
+        assert [result["status"] for result in results] == [PROCESSING] * 3
+        await asyncio.sleep(0)
+        assert [input_data for _, input_data in enqueued[0]] == ["a", "b", "c"]
+
+    asyncio.run(run())
+
+
+def test_shed_predict_batch_fails_with_the_retry_hint():
+    async def run():
+        scheduler = _scheduler(max_pending=2)
+        info, enqueued = _info(scheduler)
+        with pytest.raises(GraphQLError) as error:
+            await resolve_predict_batch(None, info, ["a", "b", "c"])
+        assert error.value.extensions == {"status": 503, "retry_after": 1}
+        assert scheduler.shed["queue_full"] == 1
+        await asyncio.sleep(0)
+        assert not enqueued
+
+    asyncio.run(run())
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from bubble_motor.api import BubbleAPI
+from bubble_motor.cancellation import Cancellations
+from bubble_motor.jobs import CANCELLED, COMPLETED, QUEUED, JobStore
+from bubble_motor.server import BubbleServer
+from bubble_motor.utils import BubbleAPIStatus
+
+
+def test_temporary_store_is_deleted_by_cleanup():
+    store = JobStore.temporary_store()
+    assert not os.path.exists(store.path)
+    store.create("job")
+    assert store.get("job")["status"] == QUEUED
+    store.finish("job", BubbleAPIStatus.OK, {"output": 1})
+    assert store.get("job")["status"] == COMPLETED
+    store.cleanup()
+    assert not any(os.path.exists(store.path + suffix) for suffix in ("", "-wal", "-shm"))
+
+
+def test_cleanup_keeps_a_store_with_a_path(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.create("job")
+    store.cleanup()
+    assert os.path.exists(store.path)
+
+
+def test_a_cancelled_job_keeps_its_status(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.create("job")
+    assert store.cancel("job")["status"] == CANCELLED
+    store.finish("job", BubbleAPIStatus.OK, {"output": 1})
+    assert store.get("job")["status"] == CANCELLED
+    assert store.result("job") is None
+
+
+class EchoAPI(BubbleAPI):
+    async def setup(self, device):
+        pass
+
+    def predict(self, x):
+        return x
+
+
+def test_jobs_keep_their_results_at_the_given_path(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    server = BubbleServer(EchoAPI(), accelerator="cpu", jobs=path)
+    server.job_store.create("job")
+    server.job_store.cleanup()
+    assert JobStore(path).get("job")["status"] == QUEUED
+
+
+def test_jobs_need_a_path():
+    with pytest.raises(ValueError):
+        BubbleServer(EchoAPI(), accelerator="cpu", jobs=True)
+
+
+def test_a_job_submitted_through_another_api_server_is_cancelled_on_its_worker(tmp_path):
+    server = BubbleServer(EchoAPI(), accelerator="cpu", jobs=str(tmp_path / "jobs.sqlite3"))
+    server.cancellations = Cancellations({}, stream=False)
+    server._cancel_job("job")
+    server.cancellations.writer.flush()
+    assert server.cancellations.shared == {"job": True}
+    assert server.cancellations.cancelled["dispatched"] == 1
@@ -0,0 +1,57 @@
+from bubble_motor.metrics import WorkerMetrics, metric_key, render_prometheus, size_buckets
+
+
+def test_size_buckets_end_at_the_max_batch_size():
+    assert size_buckets(1) == (1,)
+    assert size_buckets(8) == (1, 2, 4, 8)
+    assert size_buckets(12) == (1, 2, 4, 8, 12)
+
+
+def test_workers_publish_snapshots_at_most_every_interval():
+    snapshots = {}
+    metrics = WorkerMetrics(0, snapshots, interval=3600)
+    metrics.inc("requests_total")
+    metrics.maybe_publish()
+    metrics.inc("requests_total", 2)
+    metrics.maybe_publish()
+    assert snapshots[0]["counters"]["requests_total"] == 1
+    metrics.maybe_publish(force=True)
+    assert snapshots[0]["counters"]["requests_total"] == 3
+
+
+def test_render_prometheus_labels_the_series_of_each_worker():
+    worker = WorkerMetrics(1)
+    worker.set_gauge("queue_depth", 2)
+    worker.inc("requests_total", 5, {"status": "ok"})
+    worker.observe("batch_size", 3, buckets=(1, 2, 4))
+    worker.observe("batch_size", 8, buckets=(1, 2, 4))
+    server = {
+        "gauges": {"scheduler_pending": 0.5},
+        "counters": {metric_key("requests_shed_total", {"reason": "slo"}): 1},
+    }
+
+    text = render_prometheus({1: worker.snapshot()}, server)
+    assert text.splitlines() == [
+        "# TYPE bubble_batch_size histogram",
+        'bubble_batch_size_bucket{worker_id="1",le="1"} 0',
+        'bubble_batch_size_bucket{worker_id="1",le="2"} 0',
+        'bubble_batch_size_bucket{worker_id="1",le="4"} 1',
+        'bubble_batch_size_bucket{worker_id="1",le="+Inf"} 2',
+        'bubble_batch_size_sum{worker_id="1"} 11',
+        'bubble_batch_size_count{worker_id="1"} 2',
+        "# TYPE bubble_queue_depth gauge",
+        'bubble_queue_depth{worker_id="1"} 2',
+        "# TYPE bubble_requests_shed_total counter",
+        'bubble_requests_shed_total{reason="slo"} 1',
+        "# TYPE bubble_requests_total counter",
+        'bubble_requests_total{worker_id="1",status="ok"} 5',
+        "# TYPE bubble_scheduler_pending gauge",
+        "bubble_scheduler_pending 0.5",
+    ]
+
+
+def test_render_prometheus_labels_the_series_of_each_api_server():
+    snapshots = {i: {"gauges": {"scheduler_pending": i}} for i in range(2)}
+    text = render_prometheus({}, api_server_snapshots=snapshots)
+    assert 'bubble_scheduler_pending{api_server="0"} 0' in text
+    assert 'bubble_scheduler_pending{api_server="1"} 1' in text
@@ -0,0 +1,44 @@
+import os
+import pickle
+
+import numpy as np
+
+from bubble_motor.payloads import PayloadSegments, SharedPayload, discard_payload, unpack_payload
+
+
+def test_small_payloads_cross_the_queue_as_they_are(tmp_path):
+    segments = PayloadSegments(directory=str(tmp_path))
+    payload = {"input": np.zeros(16)}
+    assert segments.pack(payload) is payload
+    assert segments.pack("text") == "text"
+    assert not os.listdir(tmp_path)
+
+
+def test_large_arrays_are_mapped_from_a_segment_that_is_unlinked_on_receipt(tmp_path):
+    segments = PayloadSegments(directory=str(tmp_path))
+    array = np.arange(100_000, dtype=np.float32)
+    handle = segments.pack({"input": array, "id": 7})
+    assert isinstance(handle, SharedPayload)
+    # the handle carries no array data
+    assert len(pickle.dumps(handle)) < 1024
+    assert len(os.listdir(tmp_path)) == 1
+
+    payload = unpack_payload(pickle.loads(pickle.dumps(handle)))
+    assert payload["id"] == 7
+    np.testing.assert_array_equal(payload["input"], array)
+    # the array is a view of the mapping, not a copy
+    assert not payload["input"].flags.owndata
+    assert not os.listdir(tmp_path)
+
+
+def test_unclaimed_segments_are_removed(tmp_path):
+    segments = PayloadSegments(directory=str(tmp_path))
+    other = PayloadSegments(directory=str(tmp_path))
+    handles = [segments.pack(np.ones(100_000)) for _ in range(2)]
+    other.pack(np.ones(100_000))
+    discard_payload(handles[0])
+    assert segments.sweep(max_age=3600) == 0
+    segments.cleanup()
+    # only the segment of the other server is left
+    [name] = os.listdir(tmp_path)
+    assert other.token in name
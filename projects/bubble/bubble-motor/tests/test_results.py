@@ -0,0 +1,88 @@
+import asyncio
+from collections import UserDict
+
+from bubble_motor import results
+from bubble_motor.results import COMPLETED, ERROR, NOT_FOUND, PROCESSING, ResultStore
+
+
+def test_the_size_limit_counts_the_bytes_of_a_result():
+    async def run():
+        store = ResultStore(max_bytes=10)
+        await store.put("ascii", COMPLETED, "a" * 10)
+        # four characters, twelve bytes in UTF-8
+        await store.put("wide", COMPLETED, "€" * 4)
+        assert (await store.get("ascii"))["status"] == COMPLETED
+        assert (await store.get("wide"))["status"] == ERROR
+
+    asyncio.run(run())
+
+
+def test_trimming_counts_the_bytes_of_the_results():
+    async def run():
+        store = ResultStore(max_bytes=8)
+        await store.put("first", COMPLETED, "é" * 3)
+        await store.put("second", COMPLETED, "é" * 3)
+        store.trim_backend()
+        assert list(store.backend) == ["second"]
+        assert store.counters["graphql_results_evicted_total"] == 1
+
+    asyncio.run(run())
+
+
+class SharedBackend(UserDict):
+    """Stands in for the dict of the transport that API server processes share."""
+
+
+def test_a_waiter_is_woken_by_a_result_of_its_own_api_server():
+    async def run():
+        store = ResultStore(poll_interval=60)
+        await store.submit_many(["a"])
+        waiter = asyncio.ensure_future(store.wait("a"))
+        await asyncio.sleep(0)
+        await store.put("a", COMPLETED, "out")
+        found = await asyncio.wait_for(waiter, 1)
+        assert found == {"request_id": "a", "status": COMPLETED, "result": "out"}
+        assert not store._waiters
+
+    asyncio.run(run())
+
+
+def test_a_result_completed_by_another_api_server_is_read_from_the_shared_backend():
+    async def run():
+        backend = SharedBackend()
+        submitting, completing = ResultStore(poll_interval=0.01), ResultStore(poll_interval=0.01)
+        submitting.backend = completing.backend = backend
+        await submitting.submit_many(["a", "b"])
+        assert (await completing.get("b"))["status"] == PROCESSING
+        waiter = asyncio.ensure_future(completing.wait("a"))
+        await asyncio.sleep(0.02)
+        await submitting.put("a", COMPLETED, "out")
+        assert (await asyncio.wait_for(waiter, 1))["result"] == "out"
+
+    asyncio.run(run())
+
+
+def test_an_unknown_request_is_not_found_after_the_submit_grace(monkeypatch):
+    monkeypatch.setattr(results, "SUBMIT_GRACE", 0.05)
+
+    async def run():
+        store = ResultStore(poll_interval=0.01)
+        assert (await asyncio.wait_for(store.wait("unknown"), 1))["status"] == NOT_FOUND
+
+    asyncio.run(run())
+
+
+def test_expired_and_oldest_results_are_dropped():
+    async def run():
+        store = ResultStore(ttl=0.05, max_entries=2)
+        await store.put("expired", COMPLETED, "out")
+        await asyncio.sleep(0.06)
+        assert (await store.get("expired"))["status"] == NOT_FOUND
+        for request_id in ["first", "second", "third"]:
+            await store.put(request_id, COMPLETED, "out")
+        store.trim_backend()
+        assert list(store.backend) == ["second", "third"]
+        # only results that were still valid count as evicted
+        assert store.counters["graphql_results_evicted_total"] == 1
+
+    asyncio.run(run())
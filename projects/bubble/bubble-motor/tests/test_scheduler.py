@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from bubble_motor.scheduler import RequestScheduler
+from bubble_motor.utils import BubbleAPIStatus
+
+
+class WorkerQueue:
+    """Request queue whose requests are taken by a simulated worker."""
+
+    def __init__(self):
+        self.items = []
+        self.taken = 0
+
+    def put_nowait(self, item):
+        self.items.append(item)
+
+    def put_many(self, items):
+        self.items.extend(items)
+
+    def take(self):
+        taken = self.items[self.taken:]
+        self.taken = len(self.items)
+        return taken
+
+    def qsize(self):
+        return len(self.items) - self.taken
+
+
+def _scheduler(request_timeout, max_in_flight=8, **kwargs):
+    dropped = []
+    queue = WorkerQueue()
+    scheduler = RequestScheduler(
+        queue, request_timeout, max_in_flight, False, on_drop=lambda uid, error: dropped.append((uid, error)), **kwargs
+    )
+    return scheduler, queue, dropped
+
+
+def _item(uid):
+    return 0, uid, time.monotonic(), f"payload-{uid}"
+
+
+def test_slow_inference_does_not_count_against_the_deadline():
+    async def run():
+        # each predict takes longer than the timeout, but a worker takes every request right away
+        scheduler, queue, dropped = _scheduler(0.1, smoothing=0.5)
+        for uid in range(4):
+            scheduler.submit(_item(uid))
+            assert [item[1] for item in queue.take()] == [uid]
+            await asyncio.sleep(0.15)
+            scheduler.observe_responses([(uid, ("done", BubbleAPIStatus.OK))])
+        scheduler.submit_many([_item(10), _item(11)])
+        assert [item[1] for item in queue.take()] == [10, 11]
+        assert not dropped
+        assert scheduler.dropped == {"deadline": 0, "doomed": 0}
+
+    asyncio.run(run())
+
+
+def test_requests_queued_past_their_deadline_are_dropped():
+    async def run():
+        scheduler, queue, dropped = _scheduler(0.1)
+        scheduler.completions.rate = 10.0
+        scheduler.submit(_item(0))
+        # the worker would take request 1 only after request 0, 0.1s from now
+        scheduler.submit(_item(1))
+        assert [uid for uid, _ in dropped] == [1]
+        assert dropped[0][1].status_code == 504
+        assert scheduler.dropped["doomed"] == 1
+        queue.take()
+        scheduler.submit(_item(2))
+        assert [item[1] for item in queue.take()] == [2]
+
+    asyncio.run(run())
+
+
+def test_waiting_requests_expire_at_their_deadline():
+    async def run():
+        scheduler, queue, dropped = _scheduler(0.05, max_in_flight=1)
+        scheduler.submit(_item(0))
+        scheduler.submit(_item(1))
+        await asyncio.sleep(0.1)
+        assert [uid for uid, _ in dropped] == [1]
+        assert scheduler.dropped["deadline"] == 1
+        scheduler.observe_responses([(0, ("done", BubbleAPIStatus.OK))])
+        assert [item[1] for item in queue.take()] == [0]
+
+    asyncio.run(run())
+
+
+def test_slow_inference_does_not_shed_requests():
+    async def run():
+        # the reported lockout: every request was shed once predict had been slower than the timeout
+        scheduler, queue, _ = _scheduler(0.1, smoothing=0.5)
+        for uid in range(4):
+            scheduler.admit()
+            scheduler.submit(_item(uid))
+            queue.take()
+            await asyncio.sleep(0.15)
+            scheduler.observe_responses([(uid, ("done", BubbleAPIStatus.OK))])
+        assert scheduler.shed == {"slo": 0, "queue_full": 0}
+
+    asyncio.run(run())
+
+
+def test_requests_waiting_past_the_slo_are_shed():
+    async def run():
+        scheduler, queue, _ = _scheduler(None, max_in_flight=1, slo=0.5)
+        scheduler.completions.rate = 4.0
+        scheduler.submit(_item(0))
+        scheduler.submit(_item(1))
+        scheduler.submit(_item(2))
+        scheduler.admit()
+        scheduler.submit(_item(3))
+        # three requests ahead at 4 per second
+        with pytest.raises(HTTPException) as error:
+            scheduler.admit()
+        assert error.value.status_code == 429
+        assert error.value.headers["Retry-After"] == "1"
+        assert scheduler.shed["slo"] == 1
+        # a higher priority request only waits behind its own
+        scheduler.admit(priority=-1)
+
+    asyncio.run(run())
+
+
+def test_a_request_is_admitted_when_none_is_in_flight():
+    scheduler, _, _ = _scheduler(None, slo=0.1)
+    # a stale throughput from a past burst
+    scheduler.completions.rate = 0.01
+    scheduler.admit()
+
+
+def test_a_batch_of_requests_is_admitted_all_or_none():
+    scheduler, _, _ = _scheduler(None, max_pending=4)
+    scheduler.admit(count=4)
+    with pytest.raises(HTTPException) as error:
+        scheduler.admit(count=5)
+    assert error.value.status_code == 503
+    assert error.value.headers["Retry-After"] == "1"
+    assert scheduler.shed["queue_full"] == 1
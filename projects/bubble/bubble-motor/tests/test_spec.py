@@ -0,0 +1,14 @@
+import pickle
+import threading
+
+from bubble_motor.example_openai_spec import OpenAISpec
+
+
+def test_the_spec_is_sent_to_the_workers_without_its_server():
+    spec = OpenAISpec()
+    # the API server holds locks, threads and the app, none of which can be pickled
+    spec._server = threading.Lock()
+    copy = pickle.loads(pickle.dumps(spec))
+    assert copy._server is None
+    assert [path for path, _, _ in copy.endpoints] == ["/v1/chat/completions"] * 2
+    assert spec._server is not None
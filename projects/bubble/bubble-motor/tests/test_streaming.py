@@ -0,0 +1,96 @@
+import asyncio
+import time
+from collections import deque
+
+from bubble_motor.streaming import ChunkCoalescer, PausedStreams, StreamBackpressure
+
+
+def _coalescer(sent, **kwargs):
+    return ChunkCoalescer(lambda response_queue_id, uid, chunks: sent.append((uid, chunks)), **kwargs)
+
+
+def test_chunks_are_sent_together_once_they_reach_max_bytes():
+    sent = []
+    coalescer = _coalescer(sent, max_bytes=4, interval=60)
+    coalescer.add(0, "a", "xy")
+    coalescer.add(0, "b", "z")
+    assert sent == []
+    coalescer.add(0, "a", "zz")
+    assert sent == [("a", ["xy", "zz"])]
+    coalescer.flush("b")
+    assert sent == [("a", ["xy", "zz"]), ("b", ["z"])]
+    coalescer.close()
+
+
+def test_buffered_chunks_are_sent_after_the_interval():
+    sent = []
+    coalescer = _coalescer(sent, interval=0.01)
+    coalescer.add(0, "a", "x")
+    coalescer.add(0, "a", "y")
+    deadline = time.monotonic() + 1
+    while not sent and time.monotonic() < deadline:
+        time.sleep(0.01)
+    coalescer.close()
+    assert sent == [("a", ["x", "y"])]
+
+
+def test_close_flushes_the_buffered_chunks_and_stops_the_flush_thread():
+    sent = []
+    coalescer = _coalescer(sent, interval=60)
+    coalescer.add(0, "a", "x")
+    coalescer.add(0, "a", "y")
+    start = time.monotonic()
+    coalescer.close()
+    assert time.monotonic() - start < 1
+    assert not coalescer._thread.is_alive()
+    assert sent == [("a", ["x", "y"])]
+
+
+def test_a_stream_is_paused_past_its_buffer_size_until_it_is_drained():
+    shared = {}
+    backpressure = StreamBackpressure(shared, buffer_size=2)
+    response_buffer = {"a": (deque(["x", "y"]), asyncio.Event()), "b": asyncio.Event()}
+    backpressure.observe(response_buffer, [("a", None), ("b", None)])
+    assert not backpressure.paused
+    response_buffer["a"][0].append("z")
+    backpressure.observe(response_buffer, [("a", None)])
+    backpressure.observe(response_buffer, [("a", None)])
+    backpressure.writer.flush()
+    assert shared == {"a": True}
+    assert backpressure.metrics() == {"gauges": {"streams_paused": 1}, "counters": {"stream_pauses_total": 1}}
+    backpressure.drained("a")
+    backpressure.writer.flush()
+    assert shared == {}
+    assert backpressure.metrics()["gauges"]["streams_paused"] == 0
+
+
+def test_a_batch_waits_while_any_of_its_streams_is_paused():
+    async def run():
+        shared = {"a": True}
+        paused = PausedStreams(shared, poll_interval=0.01)
+        paused.read()
+        start = time.monotonic()
+        await paused.wait(["b"])
+        assert time.monotonic() - start < 0.01
+
+        async def resume():
+            await asyncio.sleep(0.05)
+            del shared["a"]
+            paused.read()
+
+        asyncio.get_running_loop().create_task(resume())
+        await asyncio.wait_for(paused.wait(["a", "b"]), 1)
+        assert time.monotonic() - start >= 0.05
+
+    asyncio.run(run())
+
+
+def test_a_paused_batch_resumes_after_max_pause():
+    async def run():
+        paused = PausedStreams({"a": True}, poll_interval=0.01)
+        paused.read()
+        start = time.monotonic()
+        await paused.wait(["a"], max_pause=0.05)
+        assert 0.05 <= time.monotonic() - start < 1
+
+    asyncio.run(run())
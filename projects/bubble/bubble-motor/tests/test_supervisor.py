@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+import pytest
+
+from bubble_motor.supervisor import WorkerExits, WorkerSupervisor
+
+
+class FakeWorker:
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.exitcode = None if alive else 1
+
+    def is_alive(self):
+        return self.alive
+
+
+async def _wait_for_spawns(spawned, count, timeout=3):
+    deadline = time.monotonic() + timeout
+    while len(spawned) < count:
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def _spawn_crashing(spawned):
+    def spawn(worker_id):
+        spawned.append((worker_id, time.monotonic()))
+        return FakeWorker(alive=False)
+
+    return spawn
+
+
+def test_a_worker_that_keeps_crashing_is_restarted_with_a_growing_backoff():
+    async def run():
+        spawned = []
+        supervisor = WorkerSupervisor(
+            [FakeWorker(alive=False), FakeWorker()],
+            _spawn_crashing(spawned),
+            interval=0.01,
+            backoff=0.1,
+            max_backoff=0.15,
+        )
+        start = time.monotonic()
+        supervisor.start()
+        await _wait_for_spawns(spawned, 4)
+        supervisor.stop()
+        times = [start] + [at for _, at in spawned]
+        gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+        assert [worker_id for worker_id, _ in spawned] == [0, 0, 0, 0]
+        # the first crash is restarted at once, then 0.1s, 0.2s capped at 0.15s
+        assert gaps[0] < 0.1
+        assert gaps[1] == pytest.approx(0.1, abs=0.05)
+        assert gaps[2] == pytest.approx(0.15, abs=0.05)
+        assert gaps[3] == pytest.approx(0.15, abs=0.05)
+        assert supervisor.restarts[0] >= 4
+
+    asyncio.run(run())
+
+
+def test_a_worker_that_stayed_up_is_restarted_at_once():
+    async def run():
+        spawned, exited = [], []
+        workers = [FakeWorker(alive=False)]
+        supervisor = WorkerSupervisor(
+            workers, _spawn_crashing(spawned), on_exit=exited.append, interval=0.01, backoff=10, stable_after=0
+        )
+        supervisor.start()
+        # a backoff of 10s would time out
+        await _wait_for_spawns(spawned, 3)
+        supervisor.stop()
+        assert exited[:3] == [0, 0, 0]
+
+    asyncio.run(run())
+
+
+def test_api_servers_recover_the_requests_of_an_exited_worker_until_it_is_ready():
+    async def run():
+        exits = WorkerExits({})
+        recovered, resumed, ready = [], [], set()
+        watcher = asyncio.get_running_loop().create_task(
+            exits.watch(
+                lambda worker_id, uids: recovered.append((worker_id, uids)), ready.__contains__, resumed.append, 0.01
+            )
+        )
+        await asyncio.sleep(0.02)
+        exits.publish(1, ["a", "b"])
+        await asyncio.sleep(0.05)
+        assert recovered == [(1, {"a", "b"})]
+        assert resumed == []
+        ready.add(1)
+        await asyncio.sleep(0.05)
+        assert resumed == [1]
+        watcher.cancel()
+        assert exits.metrics()["counters"] == {("worker_exits_total", (("worker_id", "1"),)): 1}
+
+    asyncio.run(run())
@@ -0,0 +1,187 @@
+import asyncio
+import multiprocessing as mp
+import threading
+import time
+from queue import Empty, Full
+
+import pytest
+
+from bubble_motor.transport import (
+    _LOCKED_COPY_SIZE,
+    _RECORD,
+    LoopQueue,
+    SharedDictWriter,
+    SharedUids,
+    SharedUidsReader,
+    ShmRingQueue,
+    ThreadTransport,
+)
+
+# copied outside of the lock
+LARGE = _LOCKED_COPY_SIZE + 1000
+
+
+@pytest.fixture
+def ring():
+    queues = []
+
+    def make(capacity=4096, maxsize=0):
+        queue = ShmRingQueue(capacity, maxsize=maxsize)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.close()
+
+
+def _stall_copy(queue, method, copying, *args):
+    """Run `method` of `queue` in a child process and stall it in the middle of copying the payload."""
+    name = "_write" if method == "put" else "_read"
+    copy = getattr(queue, name)
+
+    def stalling_copy(offset, data_or_size):
+        # message headers and states are smaller than a record, payloads are larger
+        if (len(data_or_size) if name == "_write" else data_or_size) > _RECORD.size:
+            copying.set()
+            time.sleep(60)
+        return copy(offset, data_or_size)
+
+    setattr(queue, name, stalling_copy)
+    getattr(queue, method)(*args)
+
+
+def _kill_mid_copy(queue, method, *args):
+    ctx = mp.get_context("fork")
+    copying = ctx.Event()
+    process = ctx.Process(target=_stall_copy, args=(queue, method, copying, *args))
+    process.start()
+    assert copying.wait(5)
+    process.kill()
+    process.join()
+
+
+def test_messages_wrap_around_the_end_of_the_ring(ring):
+    queue = ring(capacity=256)
+    payloads = [bytes([i]) * (40 + i * 7) for i in range(12)]
+    for payload in payloads:
+        queue.put(payload)
+        assert queue.get(timeout=1) == payload
+    assert queue.qsize() == 0
+
+
+def test_get_many_keeps_the_order_across_the_wraparound(ring):
+    queue = ring(capacity=512)
+    for round_ in range(10):
+        items = [(round_, i, b"x" * 30) for i in range(5)]
+        for item in items:
+            queue.put(item)
+        assert queue.get_many(10, timeout=1) == items
+
+
+def test_full_ring_blocks_until_space_is_freed(ring):
+    queue = ring(capacity=256)
+    queue.put(b"a" * 150)
+    with pytest.raises(Full):
+        queue.put(b"b" * 150, block=False)
+    with pytest.raises(Full):
+        queue.put(b"b" * 150, timeout=0.05)
+    assert queue.get(timeout=1) == b"a" * 150
+    queue.put(b"b" * 150, timeout=1)
+    assert queue.get(timeout=1) == b"b" * 150
+
+
+def test_maxsize_limits_the_number_of_messages(ring):
+    queue = ring(maxsize=2)
+    queue.put(1)
+    queue.put(2)
+    with pytest.raises(Full):
+        queue.put_nowait(3)
+    assert queue.get_nowait() == 1
+    queue.put_nowait(3)
+    assert queue.get_many(5) == [2, 3]
+    with pytest.raises(Empty):
+        queue.get(timeout=0.01)
+
+
+def test_large_messages_are_copied_outside_the_lock(ring):
+    queue = ring(capacity=LARGE * 3)
+    for i in range(7):
+        queue.put(bytes([i]) * LARGE)
+        queue.put(i)
+        assert queue.get_many(2, timeout=1) == [bytes([i]) * LARGE, i]
+
+
+def test_a_writer_killed_mid_put_does_not_stall_the_ring(ring):
+    queue = ring(capacity=LARGE * 3 // 2)
+    _kill_mid_copy(queue, "put", b"x" * LARGE)
+    # messages behind the dead writer's are delivered
+    queue.put(b"y" * 100, timeout=1)
+    assert queue.get(timeout=1) == b"y" * 100
+    # and its space is reclaimed once the ring needs it
+    queue.put(b"z" * LARGE, timeout=1)
+    assert queue.get(timeout=1) == b"z" * LARGE
+    assert queue.qsize() == 0
+
+
+def test_a_reader_killed_mid_get_does_not_stall_the_ring(ring):
+    queue = ring(capacity=LARGE * 3 // 2)
+    queue.put(b"x" * LARGE)
+    _kill_mid_copy(queue, "get")
+    queue.put(b"y" * LARGE, timeout=1)
+    assert queue.get(timeout=1) == b"y" * LARGE
+
+
+def test_one_thread_reads_every_shared_dict():
+    paused, cancelled = {}, {}
+    reader = SharedUidsReader()
+    fast = reader.watch(SharedUids(paused, 0.01))
+    slow = reader.watch(SharedUids(cancelled, 0.05))
+    threads = threading.active_count()
+    reader.start()
+    assert threading.active_count() == threads + 1
+    paused["a"] = cancelled["b"] = True
+    time.sleep(0.1)
+    assert fast.any_of(["a"]) and slow.any_of(["x", "b"])
+    assert not fast.any_of(["b"])
+    reader.stop()
+    assert threading.active_count() == threads
+
+
+def test_writes_to_a_shared_dict_keep_their_order():
+    shared = {}
+    writer = SharedDictWriter(shared, "test-writer")
+    for uid in range(100):
+        writer.add(uid)
+        if uid % 2:
+            writer.discard(uid)
+    writer.flush()
+    assert sorted(shared) == list(range(0, 100, 2))
+
+
+def test_a_loop_queue_hands_what_was_put_meanwhile_to_the_event_loop_at_once():
+    async def run():
+        queue, handled = LoopQueue(), []
+        # responses put before the API server started wait for it
+        queue.put(1)
+        queue.put(2)
+        queue.bind(asyncio.get_running_loop(), handled.append)
+        await asyncio.sleep(0)
+        assert handled == [[1, 2]]
+        queue.put(3)
+        thread = threading.Thread(target=queue.put, args=(4,))
+        thread.start()
+        thread.join()
+        assert queue.qsize() == 2
+        await asyncio.sleep(0.01)
+        assert handled == [[1, 2], [3, 4]]
+        assert queue.empty()
+
+    asyncio.run(run())
+
+
+def test_thread_transport_shares_plain_objects():
+    transport = ThreadTransport()
+    assert type(transport.dict()) is dict
+    assert isinstance(transport.response_queue(), LoopQueue)
+    assert transport._manager is None
@@ -0,0 +1,55 @@
+import multiprocessing as mp
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from bubble_motor.weights import SharedWeights
+
+
+@pytest.fixture
+def weights():
+    shared = SharedWeights.create(
+        {"embedding": np.arange(12, dtype=np.float32).reshape(3, 4), "bias": np.array([1, 2, 3], dtype=np.int8)}
+    )
+    yield shared
+    shared.close()
+
+
+def _attach(weights: SharedWeights, results):
+    arrays = weights.attach()
+    results.put({name: array.tolist() for name, array in arrays.items()})
+
+
+def test_workers_map_the_same_read_only_arrays(weights):
+    # only the path and the layout cross to the workers
+    weights = pickle.loads(pickle.dumps(weights))
+    arrays = weights.attach()
+    np.testing.assert_array_equal(arrays["embedding"], np.arange(12, dtype=np.float32).reshape(3, 4))
+    np.testing.assert_array_equal(arrays["bias"], [1, 2, 3])
+    assert all(not array.flags.writeable for array in arrays.values())
+    # arrays start on cache line boundaries
+    assert all(offset % 64 == 0 for offset, _, _ in weights.layout.values())
+
+    results = mp.get_context("fork").Queue()
+    worker = mp.get_context("fork").Process(target=_attach, args=(weights, results))
+    worker.start()
+    assert results.get(timeout=10) == {name: array.tolist() for name, array in arrays.items()}
+    worker.join(10)
+
+
+def test_close_removes_the_shared_file(weights):
+    assert os.path.exists(weights.path)
+    weights.close()
+    assert not os.path.exists(weights.path)
+    weights.close()
+
+
+def test_empty_weights_need_no_mapping():
+    weights = SharedWeights.create({"empty": np.zeros((0, 4))})
+    try:
+        assert weights.size == 0
+        assert weights.attach()["empty"].shape == (0, 4)
+    finally:
+        weights.close()
@@ -0,0 +1,484 @@
+import logging
+import multiprocessing as mp
+import os
+import pickle
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from queue import Empty, Full, Queue
+from typing import Any, Callable, FrozenSet, Iterable, List, Mapping, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RING_CAPACITY = 16 * 1024 * 1024
+# a producer waiting for space in a full ring re-checks it this often, even without a wakeup
+_FULL_POLL_INTERVAL = 0.05
+# messages up to this size are copied while the lock is held, which takes about as long as the index updates
+_LOCKED_COPY_SIZE = 64 * 1024
+
+# head offset, bytes in use, number of messages, producers waiting for space
+_HEADER = struct.Struct("QQQQ")
+_LENGTH = struct.Struct("I")
+# message header: payload length, state, pid of the process writing or reading the message
+_RECORD = struct.Struct("IIi")
+_STATE = struct.Struct("Ii")
+
+_WRITING = 0
+_READY = 1
+_READING = 2
+_DONE = 3
+
+
+def _alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ShmRingQueue:
+    """Multi-producer/multi-consumer queue backed by a shared-memory ring buffer.
+
+    Messages are pickled once straight into the ring and unpickled once by the reader, without a
+    proxy process in between. Readers sleep on a POSIX semaphore (futex-backed on Linux) that
+    producers release per message.
+
+    The process-shared lock guards the ring indices and the state of each message. Large messages
+    are copied outside of it: a producer reserves space under the lock and copies the message in
+    after releasing it, a consumer claims a ready message under the lock and copies it out after
+    releasing it. Space is freed from the head once its messages are read. A message whose writer
+    or reader died mid-copy is skipped, so a process killed while it copies a message doesn't stall
+    the others.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_RING_CAPACITY, maxsize: int = 0, ctx=None):
+        ctx = ctx or mp.get_context("spawn")
+        self._capacity = capacity
+        self._maxsize = maxsize
+        self._shm = shared_memory.SharedMemory(create=True, size=_HEADER.size + capacity)
+        _HEADER.pack_into(self._shm.buf, 0, 0, 0, 0, 0)
+        self._lock = ctx.Lock()
+        self._space = ctx.Semaphore(0)
+        self._items = ctx.Semaphore(0)
+        self._owner = True
+
+    def __getstate__(self):
+        return (self._shm.name, self._capacity, self._maxsize, self._lock, self._space, self._items)
+
+    def __setstate__(self, state):
+        name, self._capacity, self._maxsize, self._lock, self._space, self._items = state
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._owner = False
+
+    def _write(self, offset: int, data: Union[bytes, memoryview]) -> int:
+        buf = self._shm.buf
+        data = memoryview(data)
+        start = _HEADER.size + offset
+        first = min(len(data), self._capacity - offset)
+        buf[start:start + first] = data[:first]
+        if first < len(data):
+            buf[_HEADER.size:_HEADER.size + len(data) - first] = data[first:]
+        return (offset + len(data)) % self._capacity
+
+    def _read(self, offset: int, size: int) -> bytes:
+        buf = self._shm.buf
+        start = _HEADER.size + offset
+        first = min(size, self._capacity - offset)
+        data = bytes(buf[start:start + first])
+        if first < size:
+            data += bytes(buf[_HEADER.size:_HEADER.size + size - first])
+        return data
+
+    def _record(self, offset: int) -> tuple:
+        if offset + _RECORD.size <= self._capacity:
+            return _RECORD.unpack_from(self._shm.buf, _HEADER.size + offset)
+        return _RECORD.unpack(self._read(offset, _RECORD.size))
+
+    def _set_state(self, offset: int, state: int, pid: int = 0):
+        offset = (offset + _LENGTH.size) % self._capacity
+        if offset + _STATE.size <= self._capacity:
+            _STATE.pack_into(self._shm.buf, _HEADER.size + offset, state, pid)
+        else:
+            self._write(offset, _STATE.pack(state, pid))
+
+    def _reserve_locked(self, needed: int, state: int) -> Optional[int]:
+        """Offset of a new message of `needed` bytes, or None if it does not fit."""
+        head, used, count, waiting = _HEADER.unpack_from(self._shm.buf, 0)
+        if self._capacity - used < needed or 0 < self._maxsize <= count:
+            self._free_locked()
+            head, used, count, waiting = _HEADER.unpack_from(self._shm.buf, 0)
+            if self._capacity - used < needed or 0 < self._maxsize <= count:
+                return None
+        offset = (head + used) % self._capacity
+        self._write(offset, _RECORD.pack(needed - _RECORD.size, state, os.getpid()))
+        _HEADER.pack_into(self._shm.buf, 0, head, used + needed, count + 1, waiting)
+        return offset
+
+    def _claim_locked(self, n: int) -> List[list]:
+        """Take the `n` oldest ready messages as `[offset, size, data]`.
+
+        Small messages are copied out at once, larger ones are marked as being read and their data is
+        None until the caller copied them.
+        """
+        offset, _, count, _ = _HEADER.unpack_from(self._shm.buf, 0)
+        claimed = []
+        pid = os.getpid()
+        for _ in range(count):
+            size, state, _ = self._record(offset)
+            if state == _READY:
+                payload = (offset + _RECORD.size) % self._capacity
+                if size <= _LOCKED_COPY_SIZE:
+                    claimed.append([offset, size, self._read(payload, size)])
+                    self._set_state(offset, _DONE)
+                else:
+                    claimed.append([offset, size, None])
+                    self._set_state(offset, _READING, pid)
+                if len(claimed) == n:
+                    break
+            offset = (offset + _RECORD.size + size) % self._capacity
+        self._free_locked()
+        return claimed
+
+    def _free_locked(self):
+        """Advance the head past the messages that were read, or whose writer or reader died."""
+        head, used, count, waiting = _HEADER.unpack_from(self._shm.buf, 0)
+        freed = 0
+        while count:
+            size, state, pid = self._record(head)
+            if state == _READY or (state != _DONE and _alive(pid)):
+                break
+            if state != _DONE:
+                logger.warning(f"Process {pid} died while it copied a message of the ring buffer, dropping it")
+            consumed = _RECORD.size + size
+            head, used, count = (head + consumed) % self._capacity, used - consumed, count - 1
+            freed += 1
+        if freed:
+            _HEADER.pack_into(self._shm.buf, 0, head, used, count, waiting)
+            if waiting:
+                self._space.release()
+
+    def _finish(self, offsets: List[int]):
+        with self._lock:
+            for offset in offsets:
+                self._set_state(offset, _DONE)
+            self._free_locked()
+
+    def _add_waiting(self, delta: int):
+        head, used, count, waiting = _HEADER.unpack_from(self._shm.buf, 0)
+        _HEADER.pack_into(self._shm.buf, 0, head, used, count, waiting + delta)
+
+    def put(self, obj: Any, block: bool = True, timeout: Optional[float] = None):
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        needed = _RECORD.size + len(data)
+        if needed > self._capacity:
+            raise ValueError(
+                f"message of {len(data)} bytes does not fit in a ring of {self._capacity} bytes, "
+                "increase `transport_capacity` or use transport='manager'"
+            )
+        offset = self._reserve(data, block, timeout)
+        if len(data) > _LOCKED_COPY_SIZE:
+            try:
+                self._write((offset + _RECORD.size) % self._capacity, data)
+            except BaseException:
+                self._finish([offset])
+                raise
+            with self._lock:
+                self._set_state(offset, _READY)
+        self._items.release()
+
+    def _reserve(self, data: bytes, block: bool, timeout: Optional[float]) -> int:
+        """Offset of the space reserved for `data`, which is copied in right away if it is small."""
+        needed = _RECORD.size + len(data)
+        locked_copy = len(data) <= _LOCKED_COPY_SIZE
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waiting = False
+        try:
+            while True:
+                with self._lock:
+                    offset = self._reserve_locked(needed, _READY if locked_copy else _WRITING)
+                    if offset is not None:
+                        if locked_copy:
+                            self._write((offset + _RECORD.size) % self._capacity, data)
+                        return offset
+                    if block and not waiting:
+                        self._add_waiting(1)
+                        waiting = True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Full
+                # a consumer that died mid-read frees no space and wakes nobody, so wait in slices
+                self._space.acquire(True, min(remaining, _FULL_POLL_INTERVAL) if remaining else _FULL_POLL_INTERVAL)
+        finally:
+            if waiting:
+                with self._lock:
+                    self._add_waiting(-1)
+
+    def put_nowait(self, obj: Any):
+        self.put(obj, block=False)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        return self.get_many(1, block, timeout)[0]
+
+    def get_nowait(self) -> Any:
+        return self.get(block=False)
+
+    def get_many(self, max_items: int, block: bool = True, timeout: Optional[float] = None) -> List[Any]:
+        """Wait for the first message, then take up to `max_items` already queued ones in one read."""
+        if not self._items.acquire(block, timeout):
+            raise Empty
+        n = 1
+        while n < max_items and self._items.acquire(False):
+            n += 1
+        with self._lock:
+            claimed = self._claim_locked(n)
+        pending = [message for message in claimed if message[2] is None]
+        if pending:
+            try:
+                for message in pending:
+                    offset, size, _ = message
+                    message[2] = self._read((offset + _RECORD.size) % self._capacity, size)
+            finally:
+                self._finish([offset for offset, _, _ in pending])
+        return [pickle.loads(data) for _, _, data in claimed]
+
+    def qsize(self) -> int:
+        return _HEADER.unpack_from(self._shm.buf, 0)[2]
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        return 0 < self._maxsize <= self.qsize()
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def get_many(queue, max_items: int, block: bool = True, timeout: Optional[float] = None) -> List[Any]:
+    """Bulk read that works for both ring queues and plain/Manager queues."""
+    if hasattr(queue, "get_many"):
+        return queue.get_many(max_items, block, timeout)
+    items = [queue.get(block, timeout)]
+    while len(items) < max_items:
+        try:
+            items.append(queue.get_nowait())
+        except Empty:
+            break
+    return items
+
+
+class Transport:
+    """Creates the queues that carry requests and responses between API servers and inference workers."""
+
+    def __init__(self):
+        self._manager = None
+
+    @property
+    def manager(self):
+        if self._manager is None:
+            self._manager = mp.Manager()
+        return self._manager
+
+    def dict(self):
+        """Shared dict for control-plane state such as worker setup status."""
+        return self.manager.dict()
+
+    def queue(self, maxsize: int = 0):
+        raise NotImplementedError
+
+    def response_queue(self):
+        """Queue the inference workers send one API server's responses on."""
+        return self.queue()
+
+    def shutdown(self):
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+
+class SharedDictWriter:
+    """Writes to a dict shared with the workers from a single thread, so the writes of the event loop
+    keep their order and never block it."""
+
+    def __init__(self, shared: Mapping, name: str):
+        self.shared = shared
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def add(self, key):
+        self._executor.submit(self.shared.__setitem__, key, True)
+
+    def discard(self, key):
+        self._executor.submit(self.shared.pop, key, None)
+
+    def flush(self):
+        """Wait until every write submitted so far is done."""
+        self._executor.submit(lambda: None).result()
+
+
+class SharedUids:
+    """Worker-side copy of the uids listed in a dict shared by the API servers.
+
+    It is refreshed every `poll_interval` seconds by a `SharedUidsReader`, so checking a uid costs no IPC.
+    """
+
+    def __init__(self, shared: Mapping, poll_interval: float):
+        self.shared = shared
+        self.poll_interval = poll_interval
+        self.uids: FrozenSet = frozenset()
+        self.next_read = 0.0
+
+    def any_of(self, uids: Iterable) -> bool:
+        current = self.uids
+        return bool(current) and any(uid in current for uid in uids)
+
+    def read(self):
+        # copy() is one call for a Manager dict and atomic for a plain one shared by threads
+        self.uids = frozenset(self.shared.copy())
+        self.next_read = time.monotonic() + self.poll_interval
+
+
+class SharedUidsReader:
+    """Refreshes the `SharedUids` of a worker from one background thread, each at its own interval."""
+
+    def __init__(self, name: str = "bubble-shared-uids"):
+        self.name = name
+        self._watched: List[SharedUids] = []
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def watch(self, shared_uids: SharedUids) -> SharedUids:
+        """Refresh `shared_uids` once started."""
+        self._watched.append(shared_uids)
+        return shared_uids
+
+    def start(self):
+        if self._watched and self._thread is None:
+            self._thread = threading.Thread(target=self._read, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _read(self):
+        watched = list(self._watched)
+        while watched and not self._stopped.is_set():
+            now = time.monotonic()
+            for shared_uids in [shared_uids for shared_uids in watched if shared_uids.next_read <= now]:
+                try:
+                    shared_uids.read()
+                except (EOFError, OSError):
+                    logger.debug("A dict of the API servers is no longer shared, stop reading it")
+                    shared_uids.uids = frozenset()
+                    watched.remove(shared_uids)
+            if watched:
+                self._stopped.wait(max(0.0, min(shared_uids.next_read for shared_uids in watched) - time.monotonic()))
+
+
+class ManagerTransport(Transport):
+    """`multiprocessing.Manager` queues, every message goes through the manager process."""
+
+    def queue(self, maxsize: int = 0):
+        return self.manager.Queue(maxsize)
+
+
+class SharedMemoryTransport(Transport):
+    """Shared-memory ring buffers, messages go straight from producer to consumer."""
+
+    def __init__(self, capacity: int = DEFAULT_RING_CAPACITY):
+        super().__init__()
+        self.capacity = capacity
+        self._ctx = mp.get_context("spawn")
+        self._queues: List[ShmRingQueue] = []
+
+    def queue(self, maxsize: int = 0):
+        q = ShmRingQueue(self.capacity, maxsize=maxsize, ctx=self._ctx)
+        self._queues.append(q)
+        return q
+
+    def shutdown(self):
+        for q in self._queues:
+            try:
+                q.close()
+            except (FileNotFoundError, BufferError):
+                logger.debug("Shared memory queue already released")
+        self._queues = []
+        super().shutdown()
+
+
+class LoopQueue:
+    """Response queue of inference workers running as threads of the API server.
+
+    `put` hands responses to `handler` on the API server's event loop, without a reader thread and
+    without pickling. Responses put while the loop is busy are handed over together.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._handler: Optional[Callable[[List[Any]], None]] = None
+        self._pending: List[Any] = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def bind(self, loop, handler: Callable[[List[Any]], None]):
+        with self._lock:
+            self._loop = loop
+            self._handler = handler
+            if self._pending and not self._scheduled:
+                self._scheduled = True
+                loop.call_soon_threadsafe(self._flush)
+
+    def put(self, item: Any, block: bool = True, timeout: Optional[float] = None):
+        with self._lock:
+            self._pending.append(item)
+            if self._scheduled or self._loop is None:
+                return
+            self._scheduled = True
+        self._loop.call_soon_threadsafe(self._flush)
+
+    put_nowait = put
+
+    def _flush(self):
+        with self._lock:
+            items, self._pending = self._pending, []
+            self._scheduled = False
+        self._handler(items)
+
+    def qsize(self) -> int:
+        return len(self._pending)
+
+    def empty(self) -> bool:
+        return not self._pending
+
+
+class ThreadTransport(Transport):
+    """In-process queues for inference workers running as threads of the API server, nothing is pickled."""
+
+    def dict(self):
+        return {}
+
+    def queue(self, maxsize: int = 0):
+        return Queue(maxsize)
+
+    def response_queue(self):
+        return LoopQueue()
+
+
+def create_transport(transport: Union[str, Transport], capacity: int = DEFAULT_RING_CAPACITY) -> Transport:
+    if isinstance(transport, Transport):
+        return transport
+    if transport == "shm":
+        return SharedMemoryTransport(capacity)
+    if transport == "manager":
+        return ManagerTransport()
+    raise ValueError("transport must be one of 'shm' or 'manager'")
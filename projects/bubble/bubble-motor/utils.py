@@ -14,6 +14,10 @@ class BubbleAPIStatus:
     OK = "OK"
     ERROR = "ERROR"
     FINISH_STREAMING = "FINISH_STREAMING"
+    # several stream chunks of one request in one message
+    CHUNKS = "CHUNKS"
+    # a peer took the request from its worker's queue, the data is the id of the peer
+    STOLEN = "STOLEN"
 
 def load_and_raise(response):
     try:
@@ -0,0 +1,77 @@
+import logging
+import mmap
+import os
+import tempfile
+from typing import Any, Dict, Mapping, Tuple
+
+from .payloads import _shared_memory_dir
+
+logger = logging.getLogger(__name__)
+
+WEIGHTS_PREFIX = "bubble-weights"
+# arrays start on cache line boundaries
+_ALIGNMENT = 64
+
+
+def _as_numpy(value: Any):
+    import numpy as np
+
+    if type(value).__module__.startswith("torch") and hasattr(value, "__torch_function__"):
+        value = value.detach().cpu().numpy()
+    return np.ascontiguousarray(value)
+
+
+class SharedWeights:
+    """Model weights written once by the server to a file that every worker maps read-only.
+
+    The file lives in `/dev/shm` when available, so the workers' arrays share the same physical
+    pages instead of holding one copy of the model each. Only the path and the layout are pickled
+    to the workers.
+    """
+
+    def __init__(self, path: str, layout: Dict[str, Tuple[int, Tuple[int, ...], str]], size: int):
+        self.path = path
+        self.layout = layout
+        self.size = size
+
+    @classmethod
+    def create(cls, arrays: Mapping[str, Any]) -> "SharedWeights":
+        arrays = {name: _as_numpy(value) for name, value in arrays.items()}
+        layout, offset = {}, 0
+        for name, array in arrays.items():
+            offset = -(-offset // _ALIGNMENT) * _ALIGNMENT
+            layout[name] = (offset, array.shape, array.dtype.str)
+            offset += array.nbytes
+        fd, path = tempfile.mkstemp(prefix=f"{WEIGHTS_PREFIX}-", dir=_shared_memory_dir())
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for name, array in arrays.items():
+                    f.seek(layout[name][0])
+                    f.write(array.data)
+                f.truncate(offset)
+        except BaseException:
+            os.unlink(path)
+            raise
+        logger.info(f"Shared {len(arrays)} weight arrays, {offset / 2**20:.1f} MiB, in {path}")
+        return cls(path, layout, offset)
+
+    def attach(self) -> Dict[str, Any]:
+        """Read-only NumPy arrays over the shared file, mapped into this process."""
+        import numpy as np
+
+        if not self.size:
+            return {name: np.empty(shape, dtype) for name, (_, shape, dtype) in self.layout.items()}
+        with open(self.path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+        arrays = {}
+        for name, (offset, shape, dtype) in self.layout.items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape, dtype=np.int64))
+            arrays[name] = np.frombuffer(mapping, dtype, count, offset).reshape(shape)
+        return arrays
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass